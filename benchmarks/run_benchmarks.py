@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the parser, the code generator and clang-format on synthetic state diagrams
+
+Each benchmark case generates a synthetic .puml file and measures the individual stages of the code generation
+separately. With --compile, the time it takes to compile the generated header and the runtime performance of the
+generated class (measured by the generated benchmark driver) are included as well. The results are written as JSON so
+that they can be compared across commits, e.g.:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    git checkout my-branch
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+"""
+
+import gc
+import os
+import sys
+import json
+import time
+import shutil
+import pathlib
+import shlex
+import argparse
+import platform
+import datetime
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+from typing import NamedTuple, List, Optional, Callable, Dict, Any, Tuple
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from plantuml2cpp.parser import PlantUmlStateDiagram  # noqa: E402
+from plantuml2cpp.codegen import CodeGenerator, GeneratorOptions  # noqa: E402
+from plantuml2cpp.codegen import STRATEGIES, DISPATCH_MODES, OPTIMIZATION_GOALS  # noqa: E402
+from plantuml2cpp.formatter import run_clang_format  # noqa: E402
+from plantuml2cpp.benchmark import BENCH_BASE_CLASS_NAME, BENCH_BASE_HEADER_MACRO  # noqa: E402
+from plantuml2cpp.benchmark import generate_benchmark_driver, make_bench_file_path  # noqa: E402
+
+from synthetic import DiagramParams, make_synthetic_diagram  # noqa: E402
+
+RESULTS_FORMAT_VERSION = 1
+STAGES = ['parse', 'generate', 'clang_format', 'compile']
+CLASS_NAME = 'SyntheticFsm'
+
+# Base class for the generated code providing the functions called by the synthetic guards and actions
+BENCH_BASE_HEADER = f'''
+struct {BENCH_BASE_CLASS_NAME} {{
+    bool check(int n) const {{ return n % 2 == 0; }}
+    void act(int) {{}}
+}};
+'''
+
+
+class CompilerSettings(NamedTuple):
+    """How to compile the generated code and how many events to post when running the benchmark driver"""
+    compiler: str
+    flags: List[str]
+    runtime_events: int
+
+
+class BenchmarkResult(NamedTuple):
+    """Measurements for a single benchmark case; times are in seconds"""
+    name: str
+    params: DiagramParams
+    options: GeneratorOptions
+    puml_lines: int
+    num_transitions: int
+    output_lines: int
+    times: Dict[str, Optional[List[float]]]  # All measured times for each stage; None if the stage was skipped
+    peak_memory_bytes: int  # Peak memory allocated by Python while parsing and generating the code
+    runtime: Optional[Dict[str, Any]]  # Output of the benchmark driver; None if the code has not been compiled
+
+    def to_json(self) -> Dict[str, Any]:
+        """Returns the result as a JSON-serializable dict"""
+        return {
+            'name': self.name,
+            'params': self.params._asdict(),
+            'strategy': self.options.strategy,
+            'dispatch': self.options.dispatch if self.options.strategy == 'table' else None,
+            'optimize': self.options.optimize,
+            'puml_lines': self.puml_lines,
+            'num_transitions': self.num_transitions,
+            'output_lines': self.output_lines,
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'stages': {stage: _summarize(times) for stage, times in self.times.items()},
+            'runtime': self.runtime,
+        }
+
+
+def run_benchmark(params: DiagramParams, work_dir: pathlib.Path, repeat: int, with_clang_format: bool,
+                  options: GeneratorOptions = GeneratorOptions(),
+                  compiler_settings: Optional[CompilerSettings] = None) -> BenchmarkResult:
+    """Runs a single benchmark case"""
+    name = f'{params.name}-{options.strategy}'
+    if options.strategy == 'table':
+        name += f'-{options.dispatch}'
+    if options.optimize != 'size':
+        name += f'-{options.optimize}'
+    puml_file = work_dir / f'{name}.puml'
+    puml_content = make_synthetic_diagram(params)
+    puml_file.write_text(puml_content)
+
+    diagram = PlantUmlStateDiagram(puml_file)
+    code = CodeGenerator(diagram, options).generate('', CLASS_NAME)
+    header_file = work_dir / f'{name}.h'
+    header_file.write_text(code)
+
+    times = {
+        'parse': _measure(lambda: PlantUmlStateDiagram(puml_file), repeat),
+        'generate': _measure(lambda: CodeGenerator(diagram, options).generate('', CLASS_NAME), repeat),
+        'clang_format': None,
+        'compile': None,
+    }
+
+    if with_clang_format:
+        times['clang_format'] = _measure(lambda: run_clang_format(code, header_file), repeat)
+
+    runtime = None
+    if compiler_settings:
+        try:
+            times['compile'], runtime = _measure_compiled_code(header_file, options, repeat, compiler_settings)
+        except subprocess.CalledProcessError as e:
+            print(f'{name}: compiling or running the generated code failed: {e}', file=sys.stderr)
+
+    # Measure memory separately since tracing allocations slows down the code considerably
+    gc.collect()
+    tracemalloc.start()
+    try:
+        CodeGenerator(PlantUmlStateDiagram(puml_file), options).generate('', CLASS_NAME)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return BenchmarkResult(name, params, options, puml_content.count('\n'), len(diagram.transitions),
+                           code.count('\n'), times, peak_memory, runtime)
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """Returns lines describing the change of the median times between two result files"""
+    baseline_results = {x['name']: x for x in baseline['results']}
+    lines = []
+    for result in current['results']:
+        base = baseline_results.get(result['name'])
+        if not base:
+            continue
+
+        changes = []
+        for stage in STAGES:
+            old, new = base['stages'].get(stage), result['stages'].get(stage)
+            if old and new and old['median']:
+                changes.append(f'{stage} {new["median"] / old["median"]:.2f}x')
+
+        old_mem, new_mem = base['peak_memory_bytes'], result['peak_memory_bytes']
+        changes.append(f'memory {new_mem / old_mem:.2f}x' if old_mem else 'memory n/a')
+
+        old_runtime, new_runtime = base.get('runtime'), result.get('runtime')
+        if old_runtime and new_runtime and old_runtime['ns_per_event']:
+            changes.append(f'runtime {new_runtime["ns_per_event"] / old_runtime["ns_per_event"]:.2f}x')
+
+        lines.append(f'{result["name"]}: {", ".join(changes)}')
+
+    return lines
+
+
+def main() -> None:
+    """Main entry point"""
+    default_params = DiagramParams()
+
+    parser = argparse.ArgumentParser(description='Benchmarks for plantuml2cpp on synthetic state diagrams')
+    parser.add_argument('--states', type=int, nargs='+', default=[125, 250, 500, 1000, 2000],
+                        help='number of states of the diagrams; one benchmark case per value; default is %(default)s')
+    parser.add_argument('--depth', type=int, default=default_params.nesting_depth,
+                        help='maximum nesting depth of the states; default is %(default)s')
+    parser.add_argument('--fan-out', type=int, default=default_params.fan_out,
+                        help='number of child states of composite states; default is %(default)s')
+    parser.add_argument('--transitions-per-state', type=int, default=default_params.transitions_per_state,
+                        help='number of transitions leaving each state; default is %(default)s')
+    parser.add_argument('--events', type=int, default=default_params.num_events,
+                        help='number of distinct events; default is %(default)s')
+    parser.add_argument('--guard-ratio', type=float, default=default_params.guard_ratio,
+                        help='fraction of transitions with a guard; default is %(default)s')
+    parser.add_argument('--actions', type=int, default=default_params.num_actions,
+                        help='number of actions per transition and per state entry/exit; default is %(default)s')
+    parser.add_argument('--seed', type=int, default=default_params.seed,
+                        help='seed for the random choices in the diagrams; default is %(default)s')
+    parser.add_argument('--strategy', choices=STRATEGIES, nargs='+', default=['table'],
+                        help='code generation strategies to benchmark; one benchmark case per strategy and number of'
+                             ' states; default is %(default)s')
+    parser.add_argument('--dispatch', choices=DISPATCH_MODES, nargs='+', default=['scan'],
+                        help='dispatch modes to benchmark for the table strategy; one benchmark case per mode and'
+                             ' number of states; default is %(default)s')
+    parser.add_argument('--optimize', choices=OPTIMIZATION_GOALS, nargs='+', default=['size'],
+                        help='optimization goals to benchmark; one benchmark case per goal; default is %(default)s')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of times each stage gets measured; default is %(default)s')
+    parser.add_argument('--no-clang-format', action='store_true', default=False,
+                        help='do not measure clang-format (also skipped if clang-format is not installed)')
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='also measure the time it takes to compile the generated header and the time per event'
+                             ' of the generated class using the generated benchmark driver')
+    parser.add_argument('--compiler', type=str, default=os.environ.get('CXX', 'c++'),
+                        help='C++ compiler to use with --compile; default is $CXX or c++')
+    parser.add_argument('--cxxflags', type=str, default='-std=c++11 -O2',
+                        help='flags for compiling the generated code; default is "%(default)s"')
+    parser.add_argument('--runtime-events', type=int, default=1000000,
+                        help='number of random events to post in the runtime benchmark; default is %(default)s')
+    parser.add_argument('--output', '-o', type=pathlib.Path,
+                        help='file to write the results to as JSON; default is to only print a summary')
+    parser.add_argument('--compare', type=pathlib.Path,
+                        help='results file of an earlier run to compare the results against')
+    args = parser.parse_args()
+
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+
+    with_clang_format = not args.no_clang_format and shutil.which('clang-format') is not None
+    if not args.no_clang_format and not with_clang_format:
+        print('clang-format not found; skipping clang-format measurements', file=sys.stderr)
+
+    compiler_settings = None
+    if args.compile:
+        compiler_settings = CompilerSettings(args.compiler, shlex.split(args.cxxflags), args.runtime_events)
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for num_states in args.states:
+            params = DiagramParams(num_states, args.depth, args.fan_out, args.transitions_per_state, args.events,
+                                   args.guard_ratio, args.actions, args.seed)
+            for options in _make_generator_options(args.strategy, args.dispatch, args.optimize):
+                result = run_benchmark(params, pathlib.Path(work_dir), args.repeat, with_clang_format, options,
+                                       compiler_settings)
+                results.append(result)
+                print(_format_result(result))
+
+    report = {
+        'format_version': RESULTS_FORMAT_VERSION,
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'commit': _get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': [x.to_json() for x in results],
+    }
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + '\n')
+
+    if args.compare:
+        for line in compare_results(json.loads(args.compare.read_text()), report):
+            print(line)
+
+
+def _make_generator_options(strategies: List[str], dispatch_modes: List[str],
+                            optimization_goals: List[str]) -> List[GeneratorOptions]:
+    """Returns the generator options for all combinations of the given options that make a difference"""
+    options = []
+    for strategy in strategies:
+        for dispatch in dispatch_modes if strategy == 'table' else dispatch_modes[:1]:
+            for optimize in optimization_goals:
+                options.append(GeneratorOptions(strategy=strategy, dispatch=dispatch, optimize=optimize))
+
+    return options
+
+
+def _measure_compiled_code(header_file: pathlib.Path, options: GeneratorOptions, repeat: int,
+                           settings: CompilerSettings) -> Tuple[List[float], Dict[str, Any]]:
+    """Measures the compile time of the given generated header and runs the benchmark driver for it"""
+    work_dir = header_file.parent
+    (work_dir / 'bench_base.h').write_text(BENCH_BASE_HEADER)
+
+    # Explicitly instantiate the class so that all of its member functions get compiled
+    instantiation_file = header_file.with_name(f'{header_file.stem}_instantiation.cc')
+    instantiation_file.write_text(f'#include "bench_base.h"\n#include "{header_file.name}"\n'
+                                  f'template class {CLASS_NAME}<{BENCH_BASE_CLASS_NAME}>;\n')
+    compile_cmd = [settings.compiler] + settings.flags + ['-c', instantiation_file,
+                                                          '-o', instantiation_file.with_suffix('.o')]
+    compile_times = _measure(lambda: subprocess.run(compile_cmd, stderr=subprocess.DEVNULL, check=True), repeat)
+
+    bench_file = make_bench_file_path(header_file)
+    bench_file.write_text(generate_benchmark_driver(header_file, '', CLASS_NAME, options.style))
+    executable = bench_file.with_suffix('')
+    subprocess.run([settings.compiler] + settings.flags + [f'-D{BENCH_BASE_HEADER_MACRO}="bench_base.h"',
+                                                           bench_file, '-o', executable],
+                   stderr=subprocess.DEVNULL, check=True)
+
+    res = subprocess.run([executable, '--events', str(settings.runtime_events), '--repeat', str(repeat)],
+                         stdout=subprocess.PIPE, check=True)
+    return compile_times, json.loads(res.stdout.decode())
+
+
+def _measure(func: Callable[[], Any], repeat: int) -> List[float]:
+    """Returns the wall-clock times of running the given function the given number of times"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def _summarize(times: Optional[List[float]]) -> Optional[Dict[str, Any]]:
+    """Returns the statistics for the given times"""
+    if times is None:
+        return None
+
+    return {'min': min(times), 'median': statistics.median(times), 'max': max(times), 'runs': times}
+
+
+def _format_result(result: BenchmarkResult) -> str:
+    """Returns a single line summary of a benchmark result"""
+    stages = ', '.join(f'{stage} {min(times) * 1000:.1f} ms' for stage, times in result.times.items() if times)
+    runtime = f', {result.runtime["ns_per_event"]:.1f} ns/event' if result.runtime else ''
+    return (f'{result.name}: {result.num_transitions} transitions, {stages},'
+            f' peak memory {result.peak_memory_bytes / 1e6:.1f} MB{runtime}')
+
+
+def _get_git_commit() -> Optional[str]:
+    """Returns the hash of the checked out commit or None if it cannot be determined"""
+    try:
+        res = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=pathlib.Path(__file__).parent,
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return res.stdout.decode().strip()
+
+
+if __name__ == '__main__':
+    main()
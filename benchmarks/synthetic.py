@@ -0,0 +1,123 @@
+"""
+Generator for synthetic PlantUML state diagrams of arbitrary size and shape
+"""
+
+import random
+from typing import NamedTuple, List, Optional
+
+
+class DiagramParams(NamedTuple):
+    """Parameters describing the shape of a synthetic state diagram"""
+    num_states: int = 100
+    nesting_depth: int = 3  # Maximum nesting level of states; 1 means no composite states at all
+    fan_out: int = 4  # Number of child states of each composite state
+    transitions_per_state: int = 3  # External transitions leaving each state
+    num_events: int = 16
+    guard_ratio: float = 0.25  # Fraction of transitions that have a guard
+    num_actions: int = 1  # Actions per transition and per state entry/exit
+    seed: int = 0
+
+    @property
+    def name(self) -> str:
+        """Short name identifying the parameters in benchmark results"""
+        return (f's{self.num_states}-d{self.nesting_depth}-f{self.fan_out}-t{self.transitions_per_state}'
+                f'-e{self.num_events}-g{self.guard_ratio:g}-a{self.num_actions}')
+
+
+class _SyntheticState(NamedTuple):
+    name: str
+    depth: int
+    children: List['_SyntheticState']
+
+
+def make_synthetic_diagram(params: DiagramParams) -> str:
+    """Returns the content of a .puml file with a state diagram of the given shape
+
+    States are distributed breadth-first over a tree with the given fan-out until the nesting depth is reached, then a
+    new tree is started at the top level. Transition targets, events and guards are chosen randomly but
+    deterministically based on the seed. Guards call this->check(n) and actions call this->act(n), so the generated
+    code can be compiled against a base class providing these two functions.
+    """
+    assert params.num_states >= 1, 'At least one state is required'
+    assert params.nesting_depth >= 1, 'The nesting depth must be at least 1'
+    assert params.fan_out >= 1, 'The fan-out must be at least 1'
+    assert params.num_events >= 1, 'At least one event is required'
+
+    rng = random.Random(params.seed)
+    top_level_states = _make_state_tree(params)
+    states = _flatten(top_level_states)
+
+    lines = ['@startuml', f'title Synthetic FSM {params.name}', '', f'[*] --> {top_level_states[0].name}']
+    for state in top_level_states:
+        _add_state_declaration(lines, state, '')
+
+    action_counter = [0]
+
+    def make_actions() -> str:
+        actions = []
+        for _ in range(params.num_actions):
+            actions.append(f'this->act({action_counter[0]})')
+            action_counter[0] += 1
+        return ''.join(f' / {x}' for x in actions)
+
+    lines += ['', "' Entry and exit actions"]
+    for state in states:
+        if params.num_actions:
+            lines.append(f'{state.name} : entry{make_actions()}')
+            lines.append(f'{state.name} : exit{make_actions()}')
+
+    lines += ['', "' Transitions"]
+    for i, state in enumerate(states):
+        for j in range(params.transitions_per_state):
+            target = rng.choice(states)
+            event = f'Event{rng.randrange(params.num_events)}'
+            guard_id = i * params.transitions_per_state + j
+            guard = f' [this->check({guard_id})]' if rng.random() < params.guard_ratio else ''
+            lines.append(f'{state.name} --> {target.name} : {event}{guard}{make_actions()}')
+
+    lines.append('@enduml')
+    return '\n'.join(lines) + '\n'
+
+
+def _make_state_tree(params: DiagramParams) -> List[_SyntheticState]:
+    """Creates the tree of states, returning the top-level states"""
+    top_level_states = []
+    parents: List[Optional[_SyntheticState]] = [None]
+    for i in range(params.num_states):
+        if not parents:
+            parents.append(None)
+
+        parent = parents[0]
+        state = _SyntheticState(f'State{i}', parent.depth + 1 if parent else 1, [])
+        siblings = parent.children if parent else top_level_states
+        siblings.append(state)
+
+        if len(siblings) % params.fan_out == 0:
+            parents.pop(0)
+        if state.depth < params.nesting_depth:
+            parents.append(state)
+
+    return top_level_states
+
+
+def _add_state_declaration(lines: List[str], state: _SyntheticState, indent: str) -> None:
+    """Appends the declaration of the given state and its children to the lines"""
+    if not state.children:
+        lines.append(f'{indent}state {state.name}')
+        return
+
+    lines.append(f'{indent}state {state.name} {{')
+    lines.append(f'{indent}    [*] --> {state.children[0].name}')
+    for child in state.children:
+        _add_state_declaration(lines, child, indent + '    ')
+    lines.append(f'{indent}}}')
+
+
+def _flatten(states: List[_SyntheticState]) -> List[_SyntheticState]:
+    """Returns the given states and all of their descendants in depth-first order"""
+    result = []
+    for state in states:
+        result.append(state)
+        result += _flatten(state.children)
+
+    return result
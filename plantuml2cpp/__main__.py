@@ -2,53 +2,202 @@
 Command line script for plantuml2cpp
 """
 
+import os
+import sys
+import json
+import glob
+import socket
 import pathlib
-import subprocess
 import argparse
-from typing import NamedTuple
+import contextlib
+import subprocess
+from typing import NamedTuple, List, Optional
 
-from .codegen import CodeGenerator
+from .analysis import analyze_diagram
+from .benchmark import make_bench_file_path
+from .cache import default_cache_dir, MAX_CACHE_SIZE
+from .codegen import (GeneratorOptions, STRATEGIES, DISPATCH_MODES, OPTIMIZATION_GOALS, QUEUE_MODES,
+                      is_valid_class_name, is_valid_namespace)
+from .emitter import CodeStyle, BRACE_STYLES
 from .parser import PlantUmlStateDiagram
+from .pipeline import (GenerationJob, run_jobs, run_timed_jobs, make_depfile_path, generate_text, generate_to_stream,
+                       write_if_changed, write_core_file, write_benchmark_driver)
+from .server import GeneratorServer
+from .timing import profiled
+from .watcher import FileWatcher
+
+STDIO_PATH = pathlib.Path('-')  # Input or output path standing for stdin or stdout
+STDIN_NAME = pathlib.Path('<stdin>')  # Name of the diagram read from stdin in error messages
 
 
 class CommandLineArgs(NamedTuple):
     """Parsed command line arguments"""
-    puml_file: pathlib.Path
-    output_file: pathlib.Path
+    puml_files: List[pathlib.Path]
+    output_file: Optional[pathlib.Path]
     namespace: str
-    classname: str
+    classname: Optional[str]
     noformat: bool
+    emit_bench: bool
+    depfile: bool
+    strategy: str
+    dispatch: str
+    optimize: str
+    queue: str
+    queue_capacity: int
+    trace: bool
+    counters: bool
+    bank: bool
+    split: bool
+    prune: bool
+    analyze: bool
+    indent_width: int
+    brace_style: str
+    column_limit: int
+    jobs: int
+    cache_dir: Optional[pathlib.Path]
+    server: bool
+    socket: Optional[pathlib.Path]
+    watch: bool
+    timings: bool
+    profile: Optional[pathlib.Path]
 
 
 def main() -> None:
     """Main entry point when running as a standalone script"""
     args = parse_command_line()
 
-    diagram = PlantUmlStateDiagram(args.puml_file)
+    with profiled(args.profile) if args.profile else contextlib.nullcontext():
+        run(args)
+
+
+def run(args: CommandLineArgs) -> None:
+    """Runs the mode selected by the given command line arguments"""
+    if args.server or args.socket:
+        server = GeneratorServer(lambda puml_file: make_job(args, puml_file))
+        if args.socket:
+            server.serve_unix_socket(args.socket)
+        else:
+            server.serve(sys.stdin, sys.stdout)
+        return
+
+    if args.analyze:
+        print_analysis_reports(args.puml_files)
+        return
+
+    if args.puml_files == [STDIO_PATH] or args.output_file == STDIO_PATH:
+        generate_stdio(args)
+        return
+
+    jobs = [make_job(args, x) for x in args.puml_files]
+    if args.watch:
+        try:
+            FileWatcher(jobs).run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.timings:
+        errors, timers = run_timed_jobs(jobs, args.jobs)
+        for job, timer in zip(jobs, timers):
+            print(json.dumps({'puml_file': str(job.puml_file), 'output': str(job.output_file),
+                              'phases': timer.to_json()}))
+    else:
+        errors = run_jobs(jobs, args.jobs)
 
-    codegen = CodeGenerator(diagram)
-    content = codegen.generate(args.namespace, args.classname)
+    if errors:
+        print(f'plantuml2cpp: code generation failed for {len(errors)} of {len(jobs)} files:', file=sys.stderr)
+        for error in errors:
+            print(f'  {error}', file=sys.stderr)
+        sys.exit(1)
 
-    with open(args.output_file, 'w') as f:
-        f.write(content)
 
-    if not args.noformat:
-        run_clang_format(args.output_file)
+def print_analysis_reports(puml_files: List[pathlib.Path]) -> None:
+    """Prints the static analysis report of each file as a JSON object on a line of its own"""
+    errors = []
+    for puml_file in puml_files:
+        try:
+            diagram = PlantUmlStateDiagram(STDIN_NAME, sys.stdin) if puml_file == STDIO_PATH else \
+                PlantUmlStateDiagram(puml_file)
+            report = analyze_diagram(diagram)
+            print(json.dumps({'puml_file': str(puml_file), **report.to_json()}))
+        except AssertionError as e:
+            errors.append(f'{puml_file}: {e}')
+        except OSError as e:
+            errors.append(f'{puml_file}: {type(e).__name__}: {e}')
+
+    if errors:
+        print(f'plantuml2cpp: analysis failed for {len(errors)} of {len(puml_files)} files:', file=sys.stderr)
+        for error in errors:
+            print(f'  {error}', file=sys.stderr)
+        sys.exit(1)
+
+
+def generate_stdio(args: CommandLineArgs) -> None:
+    """Generates the code for the single diagram read from stdin and/or written to stdout, bypassing the cache"""
+    [puml_file] = args.puml_files
+    try:
+        diagram = None
+        if puml_file == STDIO_PATH:
+            puml_file = STDIN_NAME
+            diagram = PlantUmlStateDiagram(puml_file, sys.stdin)
+
+        job = make_job(args, puml_file)
+        if args.output_file == STDIO_PATH:
+            generate_to_stream(job, sys.stdout, diagram)
+        else:
+            code, core_code = generate_text(job, diagram)
+            write_benchmark_driver(job)
+            write_core_file(job, core_code)
+            write_if_changed(job.output_file, code)
+    except AssertionError as e:
+        error = str(e)
+    except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+        error = f'{type(e).__name__}: {e}'
+    else:
+        return
+
+    print(f'plantuml2cpp: code generation failed for {puml_file}: {error}', file=sys.stderr)
+    sys.exit(1)
+
+
+def make_job(args: CommandLineArgs, puml_file: pathlib.Path) -> GenerationJob:
+    """Creates the code generation job for the given input file"""
+    if args.output_file is None:
+        output_file = puml_file.with_suffix('.h')
+    elif args.output_file.is_dir():
+        output_file = args.output_file / puml_file.with_suffix('.h').name
+    else:
+        output_file = args.output_file
+
+    classname = args.classname or to_pascal_case(puml_file.stem)
+    style = CodeStyle(indent_width=args.indent_width, brace_style=args.brace_style, column_limit=args.column_limit)
+    options = GeneratorOptions(strategy=args.strategy, dispatch=args.dispatch, optimize=args.optimize,
+                               queue=args.queue, queue_capacity=args.queue_capacity, trace=args.trace,
+                               counters=args.counters, bank=args.bank, split=args.split,
+                               prune=args.prune, clang_format=not args.noformat, style=style)
+
+    bench_file = make_bench_file_path(output_file) if args.emit_bench else None
+    depfile = make_depfile_path(output_file) if args.depfile else None
+
+    return GenerationJob(puml_file, output_file, args.namespace, classname, args.noformat, options, args.cache_dir,
+                         bench_file, depfile)
 
 
 def parse_command_line() -> CommandLineArgs:
     """Parse the command line"""
     parser = argparse.ArgumentParser(prog='plantuml2cpp', description='''
         C++ code generator for finite state machines from PlantUML state diagrams. The generated
-        code will be run through clang-format in the directory of the output file, thereby using
-        any existing .clang-format configuration files to match the code style of the project.''')
+        code is laid out according to the style options and then run through clang-format in the
+        directory of the output file, thereby using any existing .clang-format configuration files
+        to match the code style of the project.''')
 
-    parser.add_argument('puml_file', type=pathlib.Path,
-                        help='PlantUML state machine description file')
-
-    parser.add_argument('output_file', type=pathlib.Path, nargs='?',
-                        help='output file (C++ header) or directory; default is the name of the input file with the'
-                             ' .h extension')
+    parser.add_argument('paths', type=str, nargs='*', metavar='puml_file',
+                        help='PlantUML state machine description files, directories containing .puml files or glob'
+                             ' patterns, optionally followed by the output file (C++ header) or directory; the last'
+                             ' path is used as output if there are several and it is neither a .puml file nor a glob'
+                             ' pattern; default output is the name of the input file with the .h extension; a single'
+                             ' input and the output can be - to read the diagram from stdin (requiring --classname)'
+                             ' and to write the code to stdout, which is the default output for stdin')
 
     parser.add_argument('--namespace', '-n', type=str, default='',
                         help='namespace for the generated code; default is no namespace')
@@ -57,24 +206,212 @@ def parse_command_line() -> CommandLineArgs:
                         help='name of the generated class; default is the stem of the input filename in Pascal case')
 
     parser.add_argument('--noformat', '-f', action='store_true', default=False,
-                        help='do not run clang-format to format the generated code')
+                        help='do not run clang-format to format the generated code; the code is still laid out'
+                             ' according to the style options below')
+
+    parser.add_argument('--emit-bench', action='store_true', default=False,
+                        help='also generate a benchmark driver <output>_bench.cc that measures the time per event and'
+                             ' the transitions per second for random or recorded event sequences; transitions that do'
+                             ' not change the state are only counted with --trace; with --timings, also measure the'
+                             ' time for compiling the generated class with $CXX (default c++) and $CXXFLAGS')
+
+    parser.add_argument('--depfile', action='store_true', default=False,
+                        help='also write a Make/Ninja depfile <output>.d listing the input file and all files included'
+                             ' by it via !include')
+
+    parser.add_argument('--indent-width', type=int, default=CodeStyle().indent_width,
+                        help='number of spaces per indentation level; default is %(default)s')
+
+    parser.add_argument('--brace-style', choices=BRACE_STYLES, default=CodeStyle().brace_style,
+                        help='put opening braces at the end of the line (attach) or on a line of their own (allman);'
+                             ' default is %(default)s')
+
+    parser.add_argument('--column-limit', type=int, default=CodeStyle().column_limit,
+                        help='maximum line length for wrapping lists like enum members; default is %(default)s')
+
+    parser.add_argument('--strategy', '-s', choices=STRATEGIES, default='table',
+                        help='architecture of the generated code: a transition table with switch statements on the'
+                             ' transition index for small code (table), a switch on the state with a nested switch on'
+                             ' the event for fast dispatch (switch), one handler function per state that passes'
+                             ' unhandled events on to the parent state (functions) or one on_<Event>() method per event'
+                             ' with a switch on the state, skipping the event dispatch when called directly (events);'
+                             ' default is table')
+
+    parser.add_argument('--dispatch', '-d', choices=DISPATCH_MODES, default='scan',
+                        help='how the table strategy finds the transition for an event: scan the transition table for'
+                             ' the current state and its ancestors (scan) or look it up in a table with inherited'
+                             ' transitions flattened into each state (flat); default is scan')
+
+    parser.add_argument('--optimize', '-O', choices=OPTIMIZATION_GOALS, default='size',
+                        help='use the smallest integer types that fit the number of states, events and transitions for'
+                             ' the enums and tables (size) or native-width integers (speed); default is size')
+
+    parser.add_argument('--queue', '-q', choices=QUEUE_MODES, default='none',
+                        help='queue events posted by actions and process them once the current event has been'
+                             ' processed completely, adding post_events() for posting several events at once (rtc),'
+                             ' additionally generate a lock-free queue for pushing events from one other thread via'
+                             ' push_event() and processing them via process_events() (spsc) or dispatch events'
+                             ' immediately (none); default is none')
+
+    parser.add_argument('--queue-capacity', type=int, default=GeneratorOptions().queue_capacity,
+                        help='number of events each queue can hold; events posted to a full queue are dropped;'
+                             ' default is %(default)s')
+
+    parser.add_argument('--trace', action='store_true', default=False,
+                        help='call the hooks on_transition(transition_idx), on_guard_rejected(transition_idx) and'
+                             ' on_event_dropped(event) defined in the base class; without this option, the generated'
+                             ' code contains no tracing code at all')
+
+    parser.add_argument('--counters', action='store_true', default=False,
+                        help='count how often each transition gets taken, each state gets entered and each event gets'
+                             ' dropped, adding dump_counters() and reset_counters()')
+
+    parser.add_argument('--bank', action='store_true', default=False,
+                        help='also generate a <classname>Bank class that runs many instances of the state machine,'
+                             ' storing only their states in a contiguous array and sharing everything else')
+
+    parser.add_argument('--split', action='store_true', default=False,
+                        help='move the tables and the transition lookup, which do not depend on the actions and'
+                             ' guards, into a non-template core class defined in <output>_core.cc, which has to be'
+                             ' compiled and linked once; only supported by the table strategy')
+
+    parser.add_argument('--prune', action='store_true', default=False,
+                        help='leave out the transitions that can never be taken, because they leave a state that'
+                             ' cannot be reached or follow a transition without guard for the same state and event,'
+                             ' and the entry and exit actions of unreachable states')
+
+    parser.add_argument('--analyze', action='store_true', default=False,
+                        help='instead of generating code, print a JSON report for each input file listing the'
+                             ' unreachable states, the events that are never handled, the transitions shadowed by an'
+                             ' earlier transition without guard and the transitions repeating an earlier guard')
+
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='number of files to generate in parallel; default is the number of CPUs')
+
+    parser.add_argument('--cache-dir', type=pathlib.Path, default=default_cache_dir(),
+                        help='directory for caching generated code, keyed by a hash of the input file, the options,'
+                             ' the generator version and the clang-format configuration; the least recently used'
+                             f' entries get removed once the cache exceeds {MAX_CACHE_SIZE // (1024 * 1024)} MiB;'
+                             ' default is %(default)s')
+
+    parser.add_argument('--no-cache', dest='cache_dir', action='store_const', const=None,
+                        help='always parse the input files and generate the code')
+
+    parser.add_argument('--watch', '-w', action='store_true', default=False,
+                        help='keep running and regenerate the code whenever one of the input files changes, printing'
+                             ' each generated file and any errors; stop with Ctrl+C')
+
+    parser.add_argument('--server', action='store_true', default=False,
+                        help='instead of generating code for the given files, keep running and answer code generation'
+                             ' requests, one JSON object per line, on stdin and stdout; the other options apply to'
+                             ' all requests unless overridden; see the server module for the protocol')
+
+    parser.add_argument('--socket', type=pathlib.Path,
+                        help='like --server, but answer the requests of clients connecting to this Unix socket')
+
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help='print a JSON object for each input file with the wall time, the CPU time and the peak'
+                             ' memory allocated by Python of each phase (cache_lookup, read, parse, resolve, generate,'
+                             ' clang_format, write and, with --emit-bench, compile) on a line of its own; tracing the'
+                             ' memory slows the phases down somewhat')
+
+    parser.add_argument('--profile', type=pathlib.Path, metavar='FILE',
+                        help='profile the whole run with cProfile and write the statistics to this file for loading'
+                             ' with pstats; worker processes are not profiled, so use --jobs 1 to include the code'
+                             ' generation')
 
     args = parser.parse_args()
 
-    if args.output_file is None:
-        args.output_file = args.puml_file.with_suffix('.h')
-    elif args.output_file.is_dir():
-        args.output_file /= args.puml_file.with_suffix('.h').name
+    inputs = args.paths
+    args.output_file = None
+    args.puml_files = []
+    if args.server or args.socket:
+        if inputs:
+            parser.error('no input files can be given in server mode')
+        if args.watch or args.analyze or args.timings:
+            option = 'watch' if args.watch else 'analyze' if args.analyze else 'timings'
+            parser.error(f'--{option} cannot be combined with server mode')
+        if args.socket and not hasattr(socket, 'AF_UNIX'):
+            parser.error('--socket is not supported on this platform')
+    else:
+        if not inputs:
+            parser.error('the following arguments are required: puml_file')
+
+        if len(inputs) > 1 and pathlib.Path(inputs[-1]).suffix != '.puml' and not _is_glob_pattern(inputs[-1]):
+            args.output_file = pathlib.Path(inputs.pop())
+
+        args.puml_files = expand_input_paths(inputs)
+        if not args.puml_files:
+            parser.error('no .puml files found')
 
-    if args.classname is None:
-        args.classname = to_pascal_case(args.puml_file.stem)
+        if len(args.puml_files) > 1:
+            if args.output_file is not None and not args.output_file.is_dir():
+                parser.error('the output must be an existing directory when generating code for multiple files')
+            if args.classname is not None:
+                parser.error('--classname cannot be used when generating code for multiple files')
+
+    if STDIO_PATH in args.puml_files or args.output_file == STDIO_PATH:
+        check_stdio_args(parser, args)
+
+    if args.classname is not None and not is_valid_class_name(args.classname):
+        parser.error(f'--classname must be a C++ identifier: {args.classname}')
+
+    if not is_valid_namespace(args.namespace):
+        parser.error(f'--namespace must be empty or a C++ namespace name like a::b: {args.namespace}')
+
+    if args.indent_width < 0:
+        parser.error('--indent-width must not be negative')
+
+    if args.timings and (args.watch or args.analyze):
+        parser.error(f'--timings cannot be combined with --{"watch" if args.watch else "analyze"}')
+
+    if args.bank and args.queue == 'spsc':
+        parser.error('--bank cannot be combined with --queue spsc')
+
+    if args.split and args.strategy != 'table':
+        parser.error('--split is only supported by the table strategy')
+
+    if args.queue_capacity < 1:
+        parser.error('--queue-capacity must be at least 1')
+
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
 
     return args
 
 
-def run_clang_format(filename: str) -> None:
-    """Runs clang-format on the given file"""
-    subprocess.check_call(['clang-format', '-assume-filename=fsm.h', '-i', filename])
+def check_stdio_args(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Checks the arguments for reading the diagram from stdin or writing the code to stdout"""
+    if len(args.puml_files) > 1:
+        parser.error('- (stdin or stdout) can only be used with a single input file')
+    if args.watch or args.timings:
+        parser.error(f'--{"watch" if args.watch else "timings"} cannot be combined with - (stdin or stdout)')
+
+    if args.puml_files == [STDIO_PATH]:
+        args.output_file = args.output_file or STDIO_PATH
+        if args.classname is None and not args.analyze:
+            parser.error('--classname is required when reading the diagram from stdin')
+        if args.depfile:
+            parser.error('--depfile cannot be combined with reading the diagram from stdin')
+
+    if args.output_file == STDIO_PATH:
+        for option, is_set in [('split', args.split), ('emit-bench', args.emit_bench), ('depfile', args.depfile)]:
+            if is_set:
+                parser.error(f'--{option} cannot be combined with writing the code to stdout')
+
+
+def expand_input_paths(inputs: List[str]) -> List[pathlib.Path]:
+    """Returns the .puml files given directly, found in the given directories or matching the given glob patterns"""
+    files = []
+    for x in inputs:
+        if _is_glob_pattern(x):
+            files += [pathlib.Path(y) for y in sorted(glob.glob(x, recursive=True))]
+        elif pathlib.Path(x).is_dir():
+            files += sorted(pathlib.Path(x).rglob('*.puml'))
+        else:
+            files.append(pathlib.Path(x))
+
+    return list(dict.fromkeys(files))
 
 
 def to_pascal_case(string: str) -> str:
@@ -82,5 +419,10 @@ def to_pascal_case(string: str) -> str:
     return string.replace("_", " ").title().replace(" ", "")
 
 
+def _is_glob_pattern(string: str) -> bool:
+    """Returns True if the given string contains any glob wildcards"""
+    return any(x in string for x in '*?[')
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,94 @@
+"""
+Module for the static analysis of a parsed state diagram
+"""
+
+from typing import NamedTuple, List, Dict, Tuple, FrozenSet
+
+from .parser import PlantUmlStateDiagram, State, Transition
+
+
+class AnalysisReport(NamedTuple):
+    """Findings of the static analysis of a state diagram
+
+    Guard conditions are assumed to be true sometimes, so only transitions that can never be taken regardless of the
+    guards count as dead. Transitions repeating an earlier guard are not dead as the guard may have side effects.
+    """
+    unreachable_states: Tuple[State, ...]  # States that cannot be entered from the initial state, in diagram order
+    unhandled_events: Tuple[str, ...]  # Events whose transitions are all dead, sorted alphabetically
+    shadowed_transitions: Tuple[Transition, ...]  # Transitions after an unguarded one for the same state and event
+    duplicate_guards: Tuple[Transition, ...]  # Transitions repeating the guard of an earlier one for the same state
+
+    @property
+    def dead_transitions(self) -> FrozenSet[Transition]:
+        """Returns the transitions that can never be taken: the shadowed ones and those leaving unreachable states"""
+        return frozenset(self.shadowed_transitions).union(
+            y for x in self.unreachable_states for y in x.int_transitions + x.ext_transitions)
+
+    def to_json(self) -> dict:
+        """Returns the report as a JSON serializable dict"""
+        return {
+            'unreachable_states': [x.name for x in self.unreachable_states],
+            'unhandled_events': list(self.unhandled_events),
+            'shadowed_transitions': [str(x) for x in self.shadowed_transitions],
+            'duplicate_guards': [str(x) for x in self.duplicate_guards],
+        }
+
+
+def analyze_diagram(diagram: PlantUmlStateDiagram) -> AnalysisReport:
+    """Analyzes the given state diagram in time linear in the number of states and transitions"""
+    # Transitions for each state and event in the order in which they get checked when dispatching an event
+    transitions_by_state_and_event: Dict[Tuple[str, str], List[Transition]] = {}
+    for state in diagram.states.values():
+        for trans in state.int_transitions + state.ext_transitions:
+            transitions_by_state_and_event.setdefault((state.name, trans.event.name), []).append(trans)
+
+    shadowed_transitions = []
+    duplicate_guards = []
+    for transitions in transitions_by_state_and_event.values():
+        guards = set()
+        for i, trans in enumerate(transitions):
+            if not trans.guard:
+                shadowed_transitions += transitions[i + 1:]
+                break
+
+            if trans.guard.code in guards:
+                duplicate_guards.append(trans)
+            guards.add(trans.guard.code)
+
+    shadowed = frozenset(shadowed_transitions)
+    reachable_states = _find_reachable_states(diagram, shadowed)
+    unreachable_states = tuple(x for x in diagram.states.values() if x.name not in reachable_states)
+
+    handled_events = {trans.event.name for state in diagram.states.values() if state.name in reachable_states
+                      for trans in state.int_transitions + state.ext_transitions if trans not in shadowed}
+    all_events = {trans.event.name for state in diagram.states.values()
+                  for trans in state.int_transitions + state.ext_transitions}
+
+    return AnalysisReport(unreachable_states, tuple(sorted(all_events - handled_events)), tuple(shadowed_transitions),
+                          tuple(duplicate_guards))
+
+
+def _find_reachable_states(diagram: PlantUmlStateDiagram,
+                           shadowed_transitions: FrozenSet[Transition]) -> FrozenSet[str]:
+    """Returns the names of all states that can be entered from the initial state
+
+    Entering a state enters its ancestors as well, and the transitions of a state can be taken as soon as any state in
+    its hierarchy is active. Every state gets visited once and every transition gets followed once.
+    """
+    reachable_states = set()
+    pending = []
+
+    def enter(state):
+        while state is not None and state.name not in reachable_states:
+            reachable_states.add(state.name)
+            pending.append(state)
+            state = state.parent_state
+
+    enter(diagram.initial_state)
+    while pending:
+        state = pending.pop()
+        for trans in state.ext_transitions:
+            if trans not in shadowed_transitions:
+                enter(trans.to_state.entry_target_state)
+
+    return frozenset(reachable_states)
@@ -0,0 +1,239 @@
+"""
+Module for generating a runtime benchmark driver for a generated state machine class and measuring its compile time
+"""
+
+import os
+import shlex
+import pathlib
+import tempfile
+import textwrap
+import subprocess
+
+from .emitter import CodeStyle, format_code
+
+BENCH_BASE_CLASS_NAME = 'PlantUml2CppBenchBase'
+BENCH_BASE_HEADER_MACRO = 'PLANTUML2CPP_BENCH_BASE_HEADER'
+DEFAULT_COMPILER = 'c++'  # Compiler for measuring the compile time unless $CXX is set
+COMPILE_FLAGS = ['-std=c++11', '-O2']  # Flags for measuring the compile time, followed by those in $CXXFLAGS
+
+
+def make_bench_file_path(output_file: pathlib.Path) -> pathlib.Path:
+    """Returns the path of the benchmark driver belonging to the given generated header"""
+    return output_file.with_name(f'{output_file.stem}_bench.cc')
+
+
+def generate_benchmark_driver(header_file: pathlib.Path, namespace: str, class_name: str,
+                              style: CodeStyle = CodeStyle(), trace: bool = False) -> str:
+    """Generates a self-contained C++ program that measures how fast the generated class processes events
+
+    The driver only uses the public interface of the generated class, so it does not depend on the diagram itself.
+    It posts a seeded random sequence of events (or a sequence recorded in a file) and prints the results as JSON.
+    Transitions that do not change the state can only be counted if the class has been generated with the trace hooks.
+    """
+    qualified_name = f'{namespace}::{class_name}' if namespace else class_name
+
+    if trace:
+        transitions_doc = ('Every transition taken gets counted via the on_transition() trace hook, including self\n'
+                           '// and internal transitions.')
+        counting_fsm_code = f'''\
+            // Counts every transition taken via the trace hook
+            struct CountingBase : public {BENCH_BASE_CLASS_NAME} {{
+                long num_transitions = 0;
+
+                void on_transition(int transition_idx) {{
+                    ++num_transitions;
+                    {BENCH_BASE_CLASS_NAME}::on_transition(transition_idx);
+                }}
+            }};
+
+            typedef {qualified_name}<CountingBase> CountingFsm;'''
+        transitions_code = '''\
+            long num_transitions = counting_fsm.num_transitions;
+            double transitions_per_sec = best_ns > 0 ? num_transitions / (best_ns * 1e-9) : 0;
+            printf("\\"transitions\\": %ld, \\"transitions_per_sec\\": %.1f, ", num_transitions,
+                   transitions_per_sec);'''
+    else:
+        transitions_doc = ('The class has been generated without the trace hooks (--trace), so transitions that do\n'
+                           '// not change the state cannot be observed and the transitions are reported as null.')
+        counting_fsm_code = 'typedef Fsm CountingFsm;'
+        transitions_code = 'printf("\\"transitions\\": null, \\"transitions_per_sec\\": null, ");'
+
+    code = textwrap.dedent(f'''
+        // ============================================================================
+        // AUTO-GENERATED FILE. DO NOT MODIFY!
+        // ============================================================================
+        //
+        // Benchmark driver for {class_name}. Usage:
+        //
+        //   {header_file.stem}_bench [--events N] [--seed S] [--repeat R] [--replay FILE]
+        //
+        // Posts N random events (default 1000000) or the events listed in FILE (one event name per line) and prints
+        // the fastest of R runs (default 5) as JSON. Events that change the current state are counted as state
+        // changes. {transitions_doc}
+        // Actions and guards get compiled against a base class with empty trace hooks unless
+        // {BENCH_BASE_HEADER_MACRO} is defined as the name of a header defining {BENCH_BASE_CLASS_NAME}.
+
+        {_make_bench_preamble_code()}
+
+        #include "{header_file.name}"
+
+        namespace {{
+        typedef {qualified_name}<{BENCH_BASE_CLASS_NAME}> Fsm;
+        {counting_fsm_code}
+
+        bool read_events(const char* filename, std::vector<Fsm::Event>& events) {{
+            std::ifstream f(filename);
+            if (!f) {{
+                fprintf(stderr, "Cannot open %s\\n", filename);
+                return false;
+            }}
+
+            std::string name;
+            while (f >> name) {{
+                int i = 1;
+                while (i <= Fsm::kNumEvents && name != Fsm::to_string(static_cast<Fsm::Event>(i))) {{
+                    ++i;
+                }}
+
+                if (i > Fsm::kNumEvents) {{
+                    fprintf(stderr, "Unknown event: %s\\n", name.c_str());
+                    return false;
+                }}
+
+                events.push_back(static_cast<Fsm::Event>(i));
+            }}
+
+            return true;
+        }}
+
+        void make_random_events(long num_events, unsigned seed, std::vector<Fsm::Event>& events) {{
+            std::mt19937 rng(seed);
+            std::uniform_int_distribution<int> dist(1, Fsm::kNumEvents);
+            for (long i = 0; i < num_events; ++i) {{
+                events.push_back(static_cast<Fsm::Event>(dist(rng)));
+            }}
+        }}
+        }}  // namespace
+
+        int main(int argc, char* argv[]) {{
+            long num_events = 1000000;
+            unsigned seed = 0;
+            int repeat = 5;
+            const char* replay_file = NULL;
+
+            for (int i = 1; i < argc; ++i) {{
+                if (!strcmp(argv[i], "--events") && i + 1 < argc) {{
+                    num_events = atol(argv[++i]);
+                }} else if (!strcmp(argv[i], "--seed") && i + 1 < argc) {{
+                    seed = static_cast<unsigned>(strtoul(argv[++i], NULL, 10));
+                }} else if (!strcmp(argv[i], "--repeat") && i + 1 < argc) {{
+                    repeat = atoi(argv[++i]);
+                }} else if (!strcmp(argv[i], "--replay") && i + 1 < argc) {{
+                    replay_file = argv[++i];
+                }} else {{
+                    fprintf(stderr, "Usage: %s [--events N] [--seed S] [--repeat R] [--replay FILE]\\n", argv[0]);
+                    return 2;
+                }}
+            }}
+
+            std::vector<Fsm::Event> events;
+            if (replay_file) {{
+                if (!read_events(replay_file, events)) {{
+                    return 1;
+                }}
+            }} else {{
+                make_random_events(num_events, seed, events);
+            }}
+
+            Fsm fsm;
+            double best_ns = -1;
+            for (int r = 0; r < repeat; ++r) {{
+                fsm.init();
+                std::chrono::steady_clock::time_point start = std::chrono::steady_clock::now();
+                for (size_t i = 0; i < events.size(); ++i) {{
+                    fsm.post_event(events[i]);
+                }}
+                std::chrono::steady_clock::time_point end = std::chrono::steady_clock::now();
+
+                double ns = std::chrono::duration<double, std::nano>(end - start).count();
+                if (best_ns < 0 || ns < best_ns) {{
+                    best_ns = ns;
+                }}
+            }}
+
+            const char* final_state = Fsm::to_string(fsm.current_state());
+
+            // Count the transitions and state changes in a separate run to keep the timed loop free of any
+            // instrumentation
+            CountingFsm counting_fsm;
+            long num_state_changes = 0;
+            counting_fsm.init();
+            for (size_t i = 0; i < events.size(); ++i) {{
+                CountingFsm::State state = counting_fsm.current_state();
+                counting_fsm.post_event(static_cast<CountingFsm::Event>(events[i]));
+                num_state_changes += counting_fsm.current_state() != state;
+            }}
+
+            double ns_per_event = events.empty() ? 0 : best_ns / events.size();
+            printf("{{\\"events\\": %lu, \\"repeat\\": %d, \\"ns_per_event\\": %.3f, \\"state_changes\\": %ld, ",
+                   static_cast<unsigned long>(events.size()), repeat, ns_per_event, num_state_changes);
+            {transitions_code}
+            printf("\\"final_state\\": \\"%s\\"}}\\n", final_state);
+
+            return 0;
+        }}
+        ''')
+
+    return format_code(code, style)
+
+
+def compile_generated_class(header_file: pathlib.Path, namespace: str, class_name: str) -> None:
+    """Compiles the generated header with all members of the class instantiated, e.g. to measure its compile time
+
+    The class gets instantiated with the same base class and after the same standard headers as in the benchmark
+    driver, so the time includes compiling those headers. The compiler is taken from $CXX and additional flags, e.g.
+    for defining PLANTUML2CPP_BENCH_BASE_HEADER, from $CXXFLAGS. Raises CalledProcessError if the compilation fails,
+    leaving the diagnostics of the compiler on stderr.
+    """
+    qualified_name = f'{namespace}::{class_name}' if namespace else class_name
+    code = textwrap.dedent(f'''
+        {_make_bench_preamble_code()}
+
+        #include "{header_file.name}"
+
+        template class {qualified_name}<{BENCH_BASE_CLASS_NAME}>;
+        ''')
+
+    compiler = shlex.split(os.environ.get('CXX') or DEFAULT_COMPILER)
+    flags = COMPILE_FLAGS + shlex.split(os.environ.get('CXXFLAGS', ''))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_file = pathlib.Path(temp_dir) / f'{header_file.stem}_instance.cc'
+        source_file.write_text(format_code(code))
+        subprocess.run(compiler + flags + [f'-I{header_file.parent}', '-c', str(source_file), '-o',
+                                           str(source_file.with_suffix('.o'))], check=True)
+
+
+def _make_bench_preamble_code() -> str:
+    """Returns the standard includes of the benchmark driver and the code defining the base class of the benchmarked
+    class unless the user provides a header for it"""
+    return textwrap.dedent(f'''
+        #include <chrono>
+        #include <cstdio>
+        #include <cstdlib>
+        #include <cstring>
+        #include <fstream>
+        #include <random>
+        #include <string>
+        #include <vector>
+
+        #ifdef {BENCH_BASE_HEADER_MACRO}
+        #include {BENCH_BASE_HEADER_MACRO}
+        #else
+        struct {BENCH_BASE_CLASS_NAME} {{
+            template <typename Event>
+            void on_event_dropped(Event) {{}}
+
+            void on_transition(int) {{}}
+            void on_guard_rejected(int) {{}}
+        }};
+        #endif''')
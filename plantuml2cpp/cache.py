@@ -0,0 +1,156 @@
+"""
+Module for caching generated code on disk
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import pathlib
+import functools
+import tempfile
+from typing import Optional, Iterable, Tuple
+
+CLANG_FORMAT_CONFIG_FILENAMES = ['.clang-format', '_clang-format']
+
+MAX_CACHE_SIZE = 64 * 1024 * 1024  # Bytes the entries of a cache may take up before the least recently used get removed
+PRUNE_INTERVAL = 60  # Minimum number of seconds between two checks of the cache size
+_PRUNE_STAMP_FILENAME = '.last-prune'
+
+
+class GenerationCache:
+    """On-disk cache for generated code, keyed by a hash of everything that influences the generated code
+
+    Using an entry updates its modification time. Storing entries removes the least recently used ones once all entries
+    take up more than the maximum size, checking the size at most once per PRUNE_INTERVAL across all processes.
+    """
+
+    def __init__(self, directory: pathlib.Path, max_size: int = MAX_CACHE_SIZE):
+        """Constructs the cache which stores its entries in the given directory"""
+        self.directory = directory
+        self.max_size = max_size
+
+    def get(self, key: str) -> Optional[str]:
+        """Returns the cached content for the given key or None if there is no such entry"""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'r') as f:
+                content = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return content
+
+    def put(self, key: str, content: str) -> None:
+        """Stores the given content under the given key"""
+        path = self._entry_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so that concurrent readers never see partially written entries
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.replace(tmp_name, path)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+        stamp_path = self.directory / _PRUNE_STAMP_FILENAME
+        stamp_time = file_signature(stamp_path)
+        if stamp_time is None or time.time() - stamp_time[0] / 1e9 >= PRUNE_INTERVAL:
+            stamp_path.touch()
+            self.prune()
+
+    def prune(self) -> None:
+        """Removes the least recently used entries until all entries take up at most the maximum size"""
+        entries = []
+        for path in self.directory.glob('*/*'):
+            if path.name.startswith('.'):  # Temporary file of an entry being stored
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # Removed by a concurrent process
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total_size = sum(x[1] for x in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def _entry_path(self, key: str) -> pathlib.Path:
+        """Returns the path of the file holding the cache entry for the given key"""
+        return self.directory / key[:2] / key
+
+
+def file_signature(filename: pathlib.Path) -> Optional[Tuple[int, int]]:
+    """Returns the modification time and the size of the given file or None if it does not exist"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+def default_cache_dir() -> pathlib.Path:
+    """Returns the default cache directory ($XDG_CACHE_HOME/plantuml2cpp or ~/.cache/plantuml2cpp)"""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(cache_home) / 'plantuml2cpp'
+
+
+def make_cache_key(parts: Iterable[bytes]) -> str:
+    """Returns a hash over the given parts, including the version of the generator itself"""
+    h = hashlib.sha256()
+    for part in [generator_version()] + list(parts):
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def generator_version() -> bytes:
+    """Returns a fingerprint of the generator's own source code, so that changes to it invalidate the cache"""
+    h = hashlib.sha256()
+    for path in sorted(pathlib.Path(__file__).parent.glob('*.py')):
+        h.update(path.name.encode())
+        h.update(path.read_bytes())
+
+    return h.hexdigest().encode()
+
+
+def clang_format_fingerprint(output_file: pathlib.Path) -> bytes:
+    """Returns a fingerprint of the clang-format executable and the config that applies to the given output file"""
+    parts = []
+
+    executable = shutil.which('clang-format')
+    if executable:
+        stat = os.stat(executable)
+        parts.append(f'{executable}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+
+    config_file = find_clang_format_config(output_file.parent)
+    if config_file:
+        parts.append(str(config_file).encode())
+        parts.append(config_file.read_bytes())
+
+    return b'\0'.join(parts)
+
+
+def find_clang_format_config(directory: pathlib.Path) -> Optional[pathlib.Path]:
+    """Returns the .clang-format file that clang-format uses for files in the given directory, if any"""
+    directory = directory.resolve()
+    for parent in [directory] + list(directory.parents):
+        for name in CLANG_FORMAT_CONFIG_FILENAMES:
+            if (parent / name).is_file():
+                return parent / name
+
+    return None
@@ -2,358 +2,1354 @@
 Module for generating C++ code from the parsed state diagram
 """
 
+import re
+import pathlib
 import textwrap
+from typing import NamedTuple, List, Dict, Tuple, Optional, Callable, Iterator, TextIO
 
-from .parser import PlantUmlStateDiagram, Transition
+from .emitter import CodeStyle, CodeFormatter, format_code
+from .parser import PlantUmlStateDiagram, State
+from .analysis import analyze_diagram
+from .model import compile_diagram, CompiledTransition
+
+
+STRATEGIES = ['table', 'switch', 'functions', 'events']
+DISPATCH_MODES = ['scan', 'flat']
+OPTIMIZATION_GOALS = ['size', 'speed']
+QUEUE_MODES = ['none', 'rtc', 'spsc']
+
+# Integer types to choose from for enums and table entries, from smallest to native width, with their maximum values
+_UNSIGNED_TYPES = [('unsigned char', 0xff), ('unsigned short', 0xffff), ('unsigned int', 0xffffffff)]
+_SIGNED_TYPES = [('signed char', 0x7f), ('short', 0x7fff), ('int', 0x7fffffff)]
+
+_IDENTIFIER_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+class GeneratorOptions(NamedTuple):
+    """Options controlling the generated code"""
+    strategy: str = 'table'  # One of STRATEGIES
+    dispatch: str = 'scan'  # One of DISPATCH_MODES; only used by the table strategy
+    optimize: str = 'size'  # One of OPTIMIZATION_GOALS; size uses the smallest integer types, speed native ones
+    queue: str = 'none'  # One of QUEUE_MODES; rtc queues events posted by actions, spsc adds a cross-thread queue
+    queue_capacity: int = 16  # Number of events each queue can hold
+    trace: bool = False  # Call the on_transition(), on_guard_rejected() and on_event_dropped() hooks defined in T
+    counters: bool = False  # Count taken transitions, entered states and dropped events
+    bank: bool = False  # Generate a <Class>Bank class storing the states of many instances contiguously
+    split: bool = False  # Move the tables and the dispatch algorithm into a non-template core; table strategy only
+    prune: bool = False  # Leave out transitions that can never be taken and the actions of unreachable states
+    clang_format: bool = True  # The code gets run through clang-format, so aligned lines have to be protected from it
+    style: CodeStyle = CodeStyle()
+
+
+class _Scope(NamedTuple):
+    """Class in which generated member functions get defined: the class template or the non-template core"""
+    template: str  # Template declaration preceding each definition, including the line break
+    name: str  # Name of the class for qualifying its members
+    type_prefix: str  # Prefix for the member types of the class in return types
+
+
+def is_valid_class_name(name: str) -> bool:
+    """Returns True if the given name is a C++ identifier that can be used as the name of the generated class"""
+    return bool(_IDENTIFIER_RE.fullmatch(name))
+
+
+def is_valid_namespace(namespace: str) -> bool:
+    """Returns True if the given namespace is empty (no namespace) or a possibly nested C++ namespace like a::b"""
+    return not namespace or all(_IDENTIFIER_RE.fullmatch(x) for x in namespace.split('::'))
+
+
+def make_core_file_path(output_file: pathlib.Path) -> pathlib.Path:
+    """Returns the path of the source file with the non-template core belonging to the given generated header"""
+    return output_file.with_name(f'{output_file.stem}_core.cc')
 
 
 class CodeGenerator:
     """C++ code generator based on the parsed PlantUML state diagram"""
 
-    def __init__(self, diagram: PlantUmlStateDiagram):
+    def __init__(self, diagram: PlantUmlStateDiagram, options: GeneratorOptions = GeneratorOptions()):
         """Constructs the code generator"""
+        assert options.strategy in STRATEGIES, f'Invalid strategy: {options.strategy}'
+        assert options.dispatch in DISPATCH_MODES, f'Invalid dispatch mode: {options.dispatch}'
+        assert options.optimize in OPTIMIZATION_GOALS, f'Invalid optimization goal: {options.optimize}'
+        assert options.queue in QUEUE_MODES, f'Invalid queue mode: {options.queue}'
+        assert options.queue_capacity >= 1, f'Invalid queue capacity: {options.queue_capacity}'
+        assert not options.bank or options.queue != 'spsc', 'The bank cannot be combined with the spsc queue'
+        assert not options.split or options.strategy == 'table', 'Only the table strategy supports a split output'
         self.diagram = diagram
-
-    def generate(self, namespace: str, class_name: str) -> None:
-        """Generates the C++ code"""
-        code = []
+        self.model = compile_diagram(diagram, analyze_diagram(diagram) if options.prune else None)
+        self.options = options
+
+        # Underlying types of the enums and type of the entries in the transition index tables
+        self._state_type = self._get_integer_type(_UNSIGNED_TYPES, len(self.model.state_names))
+        self._event_type = self._get_integer_type(_UNSIGNED_TYPES, len(self.model.event_names))
+        self._transition_index_type = self._get_integer_type(_SIGNED_TYPES, len(self.model.transitions) - 1)
+
+        # Transitions leaving each state for each event, in the order of the transition table
+        self._transitions_by_state_and_event: Dict[Tuple[str, str], List[CompiledTransition]] = {}
+        for trans in self.model.transitions:
+            key = (trans.transition.from_state.name, trans.transition.event.name)
+            self._transitions_by_state_and_event.setdefault(key, []).append(trans)
+
+    def generate(self, namespace: str, class_name: str) -> str:
+        """Generates the C++ code, laid out according to the code style in the options"""
+        return ''.join(self.generate_chunks(namespace, class_name))
+
+    def write_code(self, stream: TextIO, namespace: str, class_name: str) -> None:
+        """Generates the C++ code and writes it to the given stream chunk by chunk"""
+        for chunk in self.generate_chunks(namespace, class_name):
+            stream.write(chunk)
+
+    def generate_chunks(self, namespace: str, class_name: str) -> Iterator[str]:
+        """Generates the C++ code section by section, laid out according to the code style in the options
+
+        The sections (prologue, class declaration, tables, action switches, dispatch functions, epilogue) are
+        generated and laid out one after another, so only one of them is kept in memory at a time. Large sections are
+        split further, e.g. into the cases of the action switches. The concatenation of the chunks is the whole code.
+        """
+        formatter = CodeFormatter(self.options.style)
+        for section in self._make_sections(namespace, class_name):
+            chunk = formatter.format(section)
+            if chunk:
+                yield chunk
+
+        chunk = formatter.finish()
+        if chunk:
+            yield chunk
+
+    def _make_sections(self, namespace: str, class_name: str) -> Iterator[str]:
+        """Generates the sections of the C++ code before the layout, which are to be joined by line breaks"""
+        _check_names(namespace, class_name)
         nl = '\n'
-        nlnl = '\n\n'
+        template_scope = _Scope('template <typename T>\n', f'{class_name}<T>', f'typename {class_name}<T>::')
+        split = self.options.split
+
+        yield '\n'.join(self._make_copyright_header_code())
+        yield textwrap.dedent(f'''
+            // ============================================================================
+            // AUTO-GENERATED FILE. DO NOT MODIFY!
+            // ============================================================================
+
+            # pragma once{self._make_includes()}
+
+            {f'namespace {namespace} {{' if namespace else ''}
+
+            {self._make_dummy_base_code(class_name)}
+
+            {f'template <typename T>{nl}class {class_name}Bank;' if self.options.bank else ''}
+
+            {self._make_core_declaration(class_name) if self.options.split else ''}
+        ''')
+
+        yield textwrap.dedent(f'''
+            template <typename T = {class_name}DummyBase>  // Define actions and guards in T
+            class {class_name} : public T{f', public {class_name}Core' if self.options.split else ''} {{
+              public:{self._make_class_type_declarations()}
+                void init();
+                void post_event(Event event);{self._make_optional_public_declarations()}
+                State current_state() const;{'' if self.options.split else nl + self._make_to_string_declarations()}
+
+              private:
+                {self._make_private_declarations(class_name)}
+            }};  // class {class_name}
+        ''')
+
+        yield textwrap.dedent(f'''
+            template <typename T>
+            void {class_name}<T>::init() {{
+                {self._make_init_code()}
+            }}
+
+            {self._make_post_event_code(class_name)}
+
+            template <typename T>
+            typename {class_name}<T>::State {class_name}<T>::current_state() const {{
+                return state_;
+            }}
+
+            {self._make_current_instance_code(class_name) if self.options.bank else ''}
+        ''')
+
+        if not split:
+            yield self._make_to_string_code(template_scope)
+        yield self._make_counters_code(class_name)
+        if self.options.strategy == 'table' and not split:
+            yield self._make_table_lookup_code(template_scope)
+
+        yield textwrap.dedent(f'''
+            template <typename T>
+            void {class_name}<T>::call_entry_actions(State state) {{
+                {'++state_entry_counts_[static_cast<int>(state)];' if self.options.counters else ''}
+                switch (state) {{
+        ''')
+        for state_name in self._reachable_state_names:
+            if self.model.states[state_name].state.entry_transitions:
+                yield f'case State::{state_name}: {{\n{self._make_state_entry_code(state_name)}\n}} break;\n'
+        yield textwrap.dedent('''
+                    default:
+                      break;
+                }  // switch (state)
+            }  // call_entry_actions()
+        ''')
+
+        yield textwrap.dedent(f'''
+            template <typename T>
+            void {class_name}<T>::call_exit_actions(State state) {{
+                switch (state) {{
+        ''')
+        for state_name in self._reachable_state_names:
+            if self.model.states[state_name].state.exit_transitions:
+                yield f'case State::{state_name}: {{\n{self._make_state_exit_code(state_name)}\n}} break;\n'
+        yield textwrap.dedent('''
+                    default:
+                      break;
+                }  // switch (state)
+            }  // call_exit_actions()
+        ''')
+
+        yield textwrap.dedent(f'''
+            template <typename T>
+            void {class_name}<T>::call_transition_actions(int transition_idx) {{
+                switch (transition_idx) {{
+        ''')
+        for i, trans in enumerate(self.model.transitions):
+            if trans.transition.actions:
+                yield f'case {i}: {{  // {trans}\n{self._make_transition_actions_code(i)}\n}} break;\n'
+        yield textwrap.dedent('''
+                }  // switch(transition_idx)
+            }  // call_transition_actions()
+        ''')
+
+        yield from self._make_dispatch_sections(class_name)
+        if self.options.bank:
+            yield self._make_bank_code(class_name)
+
+        yield textwrap.dedent(f'''
+            {f'}}  // namespace {namespace}' if namespace else ''}
+
+            // ============================================================================
+            // AUTO-GENERATED FILE. DO NOT MODIFY!
+            // ============================================================================
+        ''')
+
+    def generate_core(self, namespace: str, class_name: str, header_file_name: str) -> str:
+        """Generates the source file defining the non-template core of the split output
+
+        The file repeats the declaration of the core instead of including the header, whose actions and guards may
+        depend on includes only the users of the class template know about.
+        """
+        assert self.options.split, 'The core only gets generated for a split output'
+        _check_names(namespace, class_name)
+        scope = _Scope('', f'{class_name}Core', f'{class_name}Core::')
 
         namespace_begin = f'namespace {namespace} {{' if namespace else ''
         namespace_end = f'}}  // namespace {namespace}' if namespace else ''
 
-        if self.diagram.copyright_header:
-            code += ['/**']
-            code += [f' * {x}' for x in self.diagram.copyright_header.split('\n')]
-            code += [' */']
-
+        code = self._make_copyright_header_code()
         code += textwrap.dedent(f'''
             // ============================================================================
             // AUTO-GENERATED FILE. DO NOT MODIFY!
             // ============================================================================
 
-            # pragma once
-
             {namespace_begin}
 
-            class {class_name}DummyBase {{}};
+            // Identical to the declaration in {header_file_name}
+            {self._make_core_declaration(class_name).strip()}
 
-            template <typename T = {class_name}DummyBase>  // Define actions and guards in T
-            class {class_name} : public T {{
+            {self._make_to_string_code(scope)}
+
+            {self._make_table_lookup_code(scope)}
+
+            int {scope.name}::find_transition_from_cur_state(Event event, GuardCheck check_guard, void* fsm) const {{
+                {self._make_find_transition_code(in_core=True)}
+            }}
+
+            {self._make_common_state_code(scope)}
+
+            {namespace_end}
+
+            // ============================================================================
+            // AUTO-GENERATED FILE. DO NOT MODIFY!
+            // ============================================================================
+        ''').split('\n')
+
+        return format_code('\n'.join(code), self.options.style)
+
+    def _make_copyright_header_code(self) -> List[str]:
+        """Generates the comment lines with the copyright header from the diagram, if any"""
+        if not self.model.copyright_header:
+            return []
+
+        return ['/**'] + [f' * {x}' for x in self.model.copyright_header.split('\n')] + [' */']
+
+    def _make_core_declaration(self, class_name: str) -> str:
+        """Generates the declaration of the non-template core containing the lookup tables and the dispatch
+        algorithm"""
+        return textwrap.dedent(f'''
+            class {class_name}Core {{  // Non-template part of {class_name}, defined in the generated source file
               public:
-                enum class State : unsigned char {{
-                    NONE_,
-                    {''.join(f'{x}, ' for x in self.diagram.state_names)}
+                {self._make_type_declarations(False)}
+
+                {self._make_to_string_declarations()}
+
+              protected:
+                {self._make_transition_struct_declaration()}
+
+                typedef bool (*GuardCheck)(void* fsm, int transition_idx);
+
+                State state_;
+
+                static State get_parent_state(State state);
+                static const Transition& get_transition(int transition_idx);
+                int find_transition_from_cur_state(Event event, GuardCheck check_guard, void* fsm) const;
+                State get_common_state(int transition_idx) const;
+            }};  // class {class_name}Core
+        ''')
+
+    def _make_class_type_declarations(self) -> str:
+        """Generates the declarations of the enums and constants of the class template, which inherits most of them
+        from the core if the output is split; empty or starting with a line break"""
+        has_queue = self.options.queue != 'none'
+        if not self.options.split:
+            return f'\n{self._make_type_declarations(has_queue)}\n\n'
+
+        return f'\nenum {{\nkQueueCapacity = {self.options.queue_capacity},\n}};\n\n' if has_queue else ''
+
+    def _make_type_declarations(self, with_queue_capacity: bool) -> str:
+        """Generates the declarations of the State and Event enums and of the constants"""
+        nl = '\n'
+        constants = [('kNumStates', len(self.model.state_names)),
+                     ('kNumEvents', len(self.model.event_names)),
+                     ('kNumTransitions', len(self.model.transitions))]
+        if with_queue_capacity:
+            constants.append(('kQueueCapacity', self.options.queue_capacity))
+
+        return textwrap.dedent(f'''
+            enum class State : {self._state_type} {{
+                NONE_,
+                {''.join(f'{x}, ' for x in self.model.state_names)}
+            }};
+
+            enum class Event : {self._event_type} {{
+                NONE_,
+                {''.join(f'{x}, ' for x in self.model.event_names)}
+            }};
+
+            enum {{
+                {nl.join(f'{name} = {value},' for name, value in constants)}
+            }};
+        ''').strip()
+
+    @staticmethod
+    def _make_to_string_declarations() -> str:
+        """Generates the declarations of the functions converting states and events to strings"""
+        return 'static const char* to_string(State state);\nstatic const char* to_string(Event event);'
+
+    def _make_to_string_code(self, scope: _Scope) -> str:
+        """Generates the functions converting states and events to strings"""
+        return textwrap.dedent(f'''
+            {scope.template}const char* {scope.name}::to_string(State state) {{
+                static constexpr const char* lut[] = {{
+                    {''.join(f'"{x}", ' for x in self.model.state_names)}
                 }};
 
-                enum class Event : unsigned char {{
-                    NONE_,
-                    {''.join(f'{x}, ' for x in self.diagram.event_names)}
+                int idx = static_cast<int>(state) - 1;
+                const char* s = idx >= 0 && idx < static_cast<int>(sizeof(lut) / sizeof(lut[0])) ? lut[idx] : "INVALID";
+                return s;
+            }}
+
+            {scope.template}const char* {scope.name}::to_string(Event event) {{
+                static constexpr const char* lut[] = {{
+                    {''.join(f'"{x}", ' for x in self.model.event_names)}
                 }};
 
-                enum {{
-                    kNumStates = {len(self.diagram.state_names)},
-                    kNumEvents = {len(self.diagram.event_names)},
-                    kNumTransitions = {len(self.diagram.transitions)},
+                int idx = static_cast<int>(event) - 1;
+                const char* s = idx >= 0 && idx < static_cast<int>(sizeof(lut) / sizeof(lut[0])) ? lut[idx] : "INVALID";
+                return s;
+            }}
+        ''')
+
+    def _make_common_state_code(self, scope: _Scope) -> str:
+        """Generates the function returning the state below which a transition exits and enters states"""
+        entries = []
+        for trans in self.model.transitions:
+            common_state = None
+            if not trans.is_internal:
+                common_state = self.model.get_common_state(trans.transition.from_state, trans.target_state)
+            entries.append(f'State::{common_state.name if common_state else "NONE_"},  // {trans}')
+
+        nl = '\n'
+        return textwrap.dedent(f'''
+            {scope.template}{scope.type_prefix}State {scope.name}::get_common_state(int transition_idx) const {{
+                static constexpr State lut[] = {{
+                    {nl.join(entries)}
                 }};
 
-                void init();
-                void post_event(Event event);
-                State current_state() const;
-                static const char* to_string(State state);
-                static const char* to_string(Event event);
+                // A transition to the current state itself exits and re-enters it
+                State to_state = get_transition(transition_idx).to_state;
+                return to_state == state_ ? get_parent_state(state_) : lut[transition_idx];
+            }}
+        ''')
 
-              private:
-                struct Transition {{
-                    Event event;
-                    State from_state;
-                    State to_state;
+    def _make_transition_struct_declaration(self) -> str:
+        """Generates the declaration of the struct describing an entry of the transition table"""
+        code = ['struct Transition {']
+        code += [f'{field_type} {field_name};' for field_name, field_type, _ in self._transition_fields]
+        code += ['};']
+
+        return '\n'.join(code)
+
+    def _make_private_declarations(self, class_name: str) -> str:
+        """Generates the declarations of the private members, depending on the strategy"""
+        code = []
+        if self.options.strategy == 'table' and not self.options.split:
+            code += [self._make_transition_struct_declaration(), '']
+        elif self.options.strategy == 'functions':
+            code += [f'typedef bool ({class_name}::*StateHandler)(Event event);', '']
+
+        if not self.options.split:
+            code += ['State state_;', '']
+
+        if self.options.bank:
+            code += ['size_t instance_ = 0;', f'friend class {class_name}Bank<T>;', '']
+
+        if self.options.queue != 'none':
+            code += ['// Events posted by actions, processed in order once the current event has been processed',
+                     'Event queue_[kQueueCapacity];',
+                     'size_t queue_head_ = 0;',
+                     'size_t queue_size_ = 0;',
+                     'bool processing_ = false;',
+                     '']
+
+        if self.options.queue == 'spsc':
+            code += ['// Events pushed by the producer thread; the indices only ever increase and wrap around',
+                     'Event spsc_queue_[kQueueCapacity];',
+                     'alignas(64) std::atomic<size_t> spsc_head_{0};  // Written by the consumer thread only',
+                     'alignas(64) std::atomic<size_t> spsc_tail_{0};  // Written by the producer thread only',
+                     '']
+
+        if self.options.counters:
+            code += ['// Number of times each transition has been taken, each state has been entered and each event',
+                     '// has been dropped; the states and events are indexed by their value, including NONE_',
+                     'unsigned long long transition_counts_[kNumTransitions] = {};',
+                     'unsigned long long state_entry_counts_[kNumStates + 1] = {};',
+                     'unsigned long long event_dropped_counts_[kNumEvents + 1] = {};',
+                     '']
+
+        if self.options.queue != 'none':
+            code += ['void dispatch_event(Event event);',
+                     'void process_queued_events();']
+
+        if self.options.strategy == 'table' and not self.options.split:
+            code += ['static State get_parent_state(State state);',
+                     'static const Transition& get_transition(int transition_idx);']
+
+        code += ['void call_entry_actions(State state);',
+                 'void call_exit_actions(State state);',
+                 'void call_transition_actions(int transition_idx);']
+
+        if self.options.split:
+            code += ['void execute_transition(int transition_idx);',
+                     'void enter_states(State common_state, State state);',
+                     'bool check_transition_guard(int transition_idx) const;',
+                     'static bool check_guard(void* fsm, int transition_idx);']
+        elif self.options.strategy == 'table':
+            code += ['void execute_transition(int transition_idx);',
+                     f'int find_transition_from_cur_state(Event event){self._find_transition_qualifier};',
+                     'bool check_transition_guard(int transition_idx) const;']
+        elif self.options.strategy == 'functions':
+            code += [f'bool handle_{x}(Event event);' for x in self.model.state_names]
+        elif self.options.strategy == 'events' and self.options.queue != 'none':
+            code += [f'void dispatch_{x}();' for x in self.model.event_names]
+
+        return '\n'.join(code)
+
+    def _make_includes(self) -> str:
+        """Generates the include directives needed by the optional features, starting with a blank line"""
+        includes = []
+        if self.options.queue == 'spsc':
+            includes.append('#include <atomic>')
+        if self.options.queue != 'none' or self.options.bank:
+            includes.append('#include <cstddef>')
+        if self.options.counters:
+            includes.append('#include <cstdio>')
+        if self.options.bank:
+            includes.append('#include <vector>')
+
+        return '\n\n' + '\n'.join(includes) if includes else ''
+
+    def _make_optional_public_declarations(self) -> str:
+        """Generates the declarations of the public functions for the optional features, each starting with a line
+        break"""
+        code = []
+        if self.options.strategy == 'events':
+            code += [f'void on_{x}();' for x in self.model.event_names]
+        if self.options.queue != 'none':
+            code.append('void post_events(const Event* events, size_t count);')
+        if self.options.queue == 'spsc':
+            code += ['bool push_event(Event event);  // The only function that may be called from another thread',
+                     'size_t process_events();']
+        if self.options.trace or self.options.counters:
+            code.append('static const char* transition_to_string(int transition_idx);')
+        if self.options.counters:
+            code += ['void dump_counters(FILE* file) const;', 'void reset_counters();']
+        if self.options.bank:
+            code.append('size_t current_instance() const;  // Instance of the bank being processed')
+
+        return ''.join(f'\n{x}' for x in code)
+
+    def _make_init_code(self) -> str:
+        """Generates the body of init(), processing any events posted by the entry actions afterwards"""
+        code = [self._make_entry_sequence_code(None, self.model.initial_state),
+                f'state_ = State::{self.model.initial_state.name};']
+        if self.options.queue != 'none':
+            code = ['processing_ = true;'] + code + ['process_queued_events();', 'processing_ = false;']
+
+        return '\n'.join(x for x in code if x)
+
+    def _make_post_event_code(self, class_name: str) -> str:
+        """Generates the definition of post_event(), depending on the strategy and the queue mode
+
+        With a queue, the strategy-dependent code goes into dispatch_event() instead and post_event() makes sure that
+        events posted by actions only get dispatched once the current event has been processed completely.
+        """
+        if self.options.strategy == 'switch':
+            body = self._make_switch_dispatch_code()
+        elif self.options.strategy == 'functions':
+            body = textwrap.dedent(f'''
+                static constexpr StateHandler handlers[] = {{
+                    {"".join(f"&{class_name}::handle_{x}, " for x in self.model.state_names)}
                 }};
 
-                State state_;
+                {self._make_handler_call_code()}
+            ''')
+        elif self.options.strategy == 'events':
+            method_prefix = 'on' if self.options.queue == 'none' else 'dispatch'
+            cases = ''.join(f'case Event::{x}:\n{method_prefix}_{x}();\nbreak;\n\n' for x in self.model.event_names)
+            body = f'switch (event) {{\n{cases}default:\nbreak;\n}}  // switch (event)'
+        else:
+            body = textwrap.dedent(f'''
+                // Get transition from the current state
+                int transition_idx = {self._make_find_transition_call(class_name)};
+                if (transition_idx == -1) {{
+                    {self._make_event_dropped_code()}return;
+                }}
 
-                static State get_common_state(State state_a, State state_b);
-                static State get_parent_state(State state);
-                static const Transition& get_transition(int transition_idx);
-                void call_entry_actions(State state);
-                void call_exit_actions(State state);
-                void call_entry_actions_recursively(State cur_state, State new_state);
-                void call_exit_actions_recursively(State cur_state, State new_state);
-                void call_transition_actions(int transition_idx);
-                int find_transition_from_cur_state(Event event) const;
-                bool check_transition_guard(int transition_idx) const;
-            }};  // class {class_name}
+                // Call state exit, transition and state entry actions and update the state
+                {self._make_transition_taken_code('transition_idx')}execute_transition(transition_idx);
+            ''')
 
+        if self.options.queue == 'none':
+            return f'template <typename T>\nvoid {class_name}<T>::post_event(Event event) {{\n{body}\n}}'
+
+        code = [self._make_queue_code(class_name),
+                f'template <typename T>\nvoid {class_name}<T>::dispatch_event(Event event) {{\n{body}\n}}']
+        if self.options.queue == 'spsc':
+            code.append(self._make_spsc_queue_code(class_name))
+
+        return '\n\n'.join(code)
+
+    def _make_queue_code(self, class_name: str) -> str:
+        """Generates the functions posting events with run-to-completion semantics"""
+        return textwrap.dedent(f'''
             template <typename T>
-            void {class_name}<T>::init() {{
-                call_entry_actions_recursively(State::NONE_, State::{self.diagram.initial_state.name});
-                state_ = State::{self.diagram.initial_state.name};
+            void {class_name}<T>::post_event(Event event) {{
+                post_events(&event, 1);
             }}
 
             template <typename T>
-            void {class_name}<T>::post_event(Event event) {{
-                // Get transition from the current state
-                int transition_idx = find_transition_from_cur_state(event);
-                if (transition_idx == -1) {{
+            void {class_name}<T>::post_events(const Event* events, size_t count) {{
+                // Events posted by actions get queued; they are dropped if the queue is full
+                if (processing_) {{
+                    for (size_t i = 0; i < count && queue_size_ < kQueueCapacity; ++i) {{
+                        queue_[(queue_head_ + queue_size_) % kQueueCapacity] = events[i];
+                        ++queue_size_;
+                    }}
+
                     return;
                 }}
 
-                const Transition& transition = get_transition(transition_idx);
-
-                // If it is an internal transition, don't change state
-                if (transition.to_state == State::NONE_) {{
-                    call_transition_actions(transition_idx);
-                    return;
+                processing_ = true;
+                for (size_t i = 0; i < count; ++i) {{
+                    dispatch_event(events[i]);
+                    process_queued_events();
                 }}
 
-                // Find the closest common ancestor between source and target state
-                State common_state = get_common_state(transition.from_state, transition.to_state);
+                processing_ = false;
+            }}
 
-                // Call state exit, transition and state entry actions and update the state
-                if (state_ == transition.to_state) {{
-                    call_exit_actions(state_);
-                    call_transition_actions(transition_idx);
-                    call_entry_actions(state_);
-                }} else {{
-                    call_exit_actions_recursively(state_, common_state);
-                    call_transition_actions(transition_idx);
-                    call_entry_actions_recursively(common_state, transition.to_state);
-                    state_ = transition.to_state;
+            template <typename T>
+            void {class_name}<T>::process_queued_events() {{
+                while (queue_size_ != 0) {{
+                    Event event = queue_[queue_head_];
+                    queue_head_ = (queue_head_ + 1) % kQueueCapacity;
+                    --queue_size_;
+                    dispatch_event(event);
                 }}
             }}
+        ''')
 
+    def _make_spsc_queue_code(self, class_name: str) -> str:
+        """Generates the lock-free single-producer/single-consumer queue functions for handing over events between
+        threads"""
+        return textwrap.dedent(f'''
             template <typename T>
-            typename {class_name}<T>::State {class_name}<T>::current_state() const {{
-                return state_;
+            bool {class_name}<T>::push_event(Event event) {{
+                size_t tail = spsc_tail_.load(std::memory_order_relaxed);
+                if (tail - spsc_head_.load(std::memory_order_acquire) == kQueueCapacity) {{
+                    return false;
+                }}
+
+                spsc_queue_[tail % kQueueCapacity] = event;
+                spsc_tail_.store(tail + 1, std::memory_order_release);
+                return true;
             }}
 
             template <typename T>
-            const char* {class_name}<T>::to_string(State state) {{
-                static const char* lut[] = {{
-                    {''.join(f'"{x}", ' for x in self.diagram.state_names)}
+            size_t {class_name}<T>::process_events() {{
+                size_t head = spsc_head_.load(std::memory_order_relaxed);
+                size_t tail = spsc_tail_.load(std::memory_order_acquire);
+                for (size_t i = head; i != tail; ++i) {{
+                    Event event = spsc_queue_[i % kQueueCapacity];
+                    spsc_head_.store(i + 1, std::memory_order_release);
+                    post_event(event);
+                }}
+
+                return tail - head;
+            }}
+        ''')
+
+    def _make_table_lookup_code(self, scope: _Scope) -> str:
+        """Generates the functions for looking up parent states and transitions used by the table strategy"""
+        nl = '\n'
+
+        return textwrap.dedent(f'''
+            {scope.template}{scope.type_prefix}State {scope.name}::get_parent_state(State state) {{
+                static constexpr State lut[] = {{
+                    {nl.join(f'{self._make_parent_state_enum_member(x)},  // Parent of {x}' for x in self.model.state_names)}
                 }};
-                
-                int idx = static_cast<int>(state) - 1;
-                const char* s = idx < sizeof(lut) / sizeof(lut[0]) ? lut[idx] : "INVALID";
-                return s;
+
+                return lut[static_cast<int>(state) - 1];
             }}
 
-            template <typename T>
-            const char* {class_name}<T>::to_string(Event event) {{
-                static const char* lut[] = {{
-                    {''.join(f'"{x}", ' for x in self.diagram.event_names)}
+            {scope.template}const {scope.type_prefix}Transition& {scope.name}::get_transition(int transition_idx) {{
+                static constexpr Transition transitions[] = {{
+                    {nl.join(self._make_transition_initializer(x) for x in self.model.transitions)}
                 }};
-                
-                int idx = static_cast<int>(event) - 1;
-                const char* s = idx < sizeof(lut) / sizeof(lut[0]) ? lut[idx] : "INVALID";
-                return s;
+
+                return transitions[transition_idx];
             }}
+        ''')
+
+    def _make_dispatch_sections(self, class_name: str) -> Iterator[str]:
+        """Generates the functions that find and execute transitions, depending on the strategy, one by one"""
+        if self.options.strategy == 'functions':
+            yield from (self._make_state_handler_code(class_name, x) + '\n' for x in self.model.state_names)
+            return
+
+        if self.options.strategy == 'events':
+            yield from (self._make_event_method_code(class_name, x) + '\n' for x in self.model.event_names)
+            return
+
+        if self.options.strategy != 'table':
+            return
+
+        if self.options.split:
+            yield self._make_split_dispatch_code(class_name)
+            return
+
+        nl = '\n'
+        nlnl = '\n\n'
+
+        yield textwrap.dedent(f'''
+            template <typename T>
+            void {class_name}<T>::execute_transition(int transition_idx) {{
+                switch (transition_idx) {{
+                    {nlnl.join(f'case {i}: {{  // {x}{nl}{self._make_transition_sequence_code(i)}{nl}}} break;'
+                     for i, x in enumerate(self.model.transitions))}
+                }}  // switch(transition_idx)
+            }}  // execute_transition()
 
             template <typename T>
-            typename {class_name}<T>::State {class_name}<T>::get_common_state(State state_a, State state_b) {{
-                State sequence[{self._state_nesting_depth}];
-                int idx = 0;
+            int {class_name}<T>::find_transition_from_cur_state(Event event){self._find_transition_qualifier} {{
+                {self._make_find_transition_code()}
+            }}
 
-                for (State st = state_a; st != State::NONE_; st = get_parent_state(st)) {{
-                    sequence[idx] = st;
-                    ++idx;
+            template <typename T>
+            bool {class_name}<T>::check_transition_guard(int transition_idx) const {{
+                switch (transition_idx) {{
+                    {nl.join(self._make_guard_code(i) for i, x in enumerate(self.model.transitions) if x.transition.guard)}
                 }}
 
-                for (State st = state_b; st != State::NONE_; st = get_parent_state(st)) {{
-                    for (int i = 0; i < idx; ++i) {{
-                        if (sequence[i] == st) {{
-                            return st;
-                        }}
-                    }}
+                return true;
+            }}
+        ''')
+
+    def _make_split_dispatch_code(self, class_name: str) -> str:
+        """Generates the functions that execute transitions and check guards around the non-template core
+
+        Instead of straight-line code for each transition, the exit and entry actions get called while walking the
+        hierarchy, which keeps the class template small.
+        """
+        nl = '\n'
+        check_guard_code = 'return self->check_transition_guard(transition_idx);'
+        if self.options.trace:
+            check_guard_code = textwrap.dedent('''
+                if (self->check_transition_guard(transition_idx)) {
+                    return true;
+                }
+
+                self->on_guard_rejected(transition_idx);
+                return false;
+            ''')
+
+        return textwrap.dedent(f'''
+            template <typename T>
+            void {class_name}<T>::execute_transition(int transition_idx) {{
+                // Internal transitions only call the transition actions
+                const Transition& transition = get_transition(transition_idx);
+                if (transition.to_state == State::NONE_) {{
+                    call_transition_actions(transition_idx);
+                    return;
                 }}
 
-                return State::NONE_;
+                State common_state = get_common_state(transition_idx);
+                for (State state = state_; state != common_state; state = get_parent_state(state)) {{
+                    call_exit_actions(state);
+                }}
+
+                call_transition_actions(transition_idx);
+                enter_states(common_state, transition.to_state);
+                state_ = transition.to_state;
             }}
 
             template <typename T>
-            typename {class_name}<T>::State {class_name}<T>::get_parent_state(State state) {{
-                static const State lut[] = {{
-                    {nl.join(f'{self._make_parent_state_enum_member(x)},  // Parent of {x}' for x in self.diagram.state_names)}
-                }};
-                
-                return lut[static_cast<int>(state) - 1];
+            void {class_name}<T>::enter_states(State common_state, State state) {{
+                // Enter the ancestors of the state below the common state first
+                if (state != common_state) {{
+                    enter_states(common_state, get_parent_state(state));
+                    call_entry_actions(state);
+                }}
             }}
 
             template <typename T>
-            const typename {class_name}<T>::Transition& {class_name}<T>::get_transition(int transition_idx) {{
-                static const Transition transitions[] = {{
-                    {nl.join(self._make_transition_initializer(x) for x in self.diagram.transitions)}
-                }};
+            bool {class_name}<T>::check_transition_guard(int transition_idx) const {{
+                switch (transition_idx) {{
+                    {nl.join(self._make_guard_code(i) for i, x in enumerate(self.model.transitions) if x.transition.guard)}
+                }}
 
-                return transitions[transition_idx];
+                return true;
             }}
 
             template <typename T>
-            void {class_name}<T>::call_entry_actions(State state) {{
-                switch (state) {{
-                    {nlnl.join(f'case State::{x}: {{ {self._make_state_entry_code(x)} }} break;'
-                     for x in self.diagram.state_names if self.diagram.states[x].entry_transitions)}
+            bool {class_name}<T>::check_guard(void* fsm, int transition_idx) {{
+                {class_name}* self = static_cast<{class_name}*>(fsm);
+                {check_guard_code}
+            }}
+        ''')
 
-                    default:
-                      break;
-                }}  // switch (state)
-            }}  // call_entry_actions()
+    def _make_find_transition_call(self, class_name: str) -> str:
+        """Generates the call of the function finding the transition for the event in the current state"""
+        if self.options.split:
+            return f'find_transition_from_cur_state(event, &{class_name}::check_guard, this)'
+
+        return 'find_transition_from_cur_state(event)'
 
+    def _make_current_instance_code(self, class_name: str) -> str:
+        """Generates the function returning the instance of the bank that is being processed"""
+        return textwrap.dedent(f'''
             template <typename T>
-            void {class_name}<T>::call_exit_actions(State state) {{
-                switch (state) {{
-                    {nlnl.join(f'case State::{x}: {{ {self._make_state_exit_code(x)} }} break;'
-                     for x in self.diagram.state_names if self.diagram.states[x].exit_transitions)}
+            size_t {class_name}<T>::current_instance() const {{
+                return instance_;
+            }}
+        ''')
+
+    def _make_bank_code(self, class_name: str) -> str:
+        """Generates the class storing the states of many instances of the state machine contiguously
+
+        All instances share the base class, the lookup tables and the dispatch code. For each event, the state of the
+        instance gets swapped into the state machine and back out once the event has been processed. The state machine
+        is a private base, so that only the members not depending on the current instance are accessible.
+        """
+        bank_name = f'{class_name}Bank'
+        constants = ['kNumStates', 'kNumEvents', 'kNumTransitions'] + \
+            (['kQueueCapacity'] if self.options.queue != 'none' else [])
+        shared_members = constants + ['to_string']
+        if self.options.trace or self.options.counters:
+            shared_members.append('transition_to_string')
+        if self.options.counters:
+            shared_members += ['dump_counters', 'reset_counters']
+
+        return textwrap.dedent(f'''
+            template <typename T = {class_name}DummyBase>  // Define actions and guards in T
+            class {bank_name} : private {class_name}<T> {{
+              public:
+                typedef typename {class_name}<T>::State State;
+                typedef typename {class_name}<T>::Event Event;
+                {''.join(f'using {class_name}<T>::{x};{chr(10)}' for x in shared_members)}
 
-                    default:
-                      break;
-                }}  // switch (state)
-            }}  // call_exit_actions()
+                explicit {bank_name}(size_t num_instances);
+
+                size_t size() const;
+                void init();
+                void init(size_t instance_id);
+                void post_event(size_t instance_id, Event event);
+                void post_events(const size_t* instance_ids, const Event* events, size_t count);
+                void broadcast(Event event);
+                State current_state(size_t instance_id) const;
+
+              private:
+                std::vector<State> states_;
+            }};  // class {bank_name}
 
             template <typename T>
-            void {class_name}<T>::call_entry_actions_recursively(State cur_state, State new_state) {{
-                // Collect the (reverse) order in which we have to go through the states
-                State sequence[{self._state_nesting_depth}];
-                int idx = 0;
-                for (State st = new_state; st != cur_state; st = get_parent_state(st)) {{
-                    sequence[idx] = st;
-                    ++idx;
-                }}
+            {bank_name}<T>::{bank_name}(size_t num_instances) : states_(num_instances, State::NONE_) {{
+            }}
 
-                // Call the entry actions in the determined order
-                do {{
-                    idx -= 1;
-                    call_entry_actions(sequence[idx]);
-                }} while (idx > 0);
+            template <typename T>
+            size_t {bank_name}<T>::size() const {{
+                return states_.size();
             }}
 
             template <typename T>
-            void {class_name}<T>::call_exit_actions_recursively(State cur_state, State new_state) {{
-                for (State st = cur_state; st != new_state; st = get_parent_state(st)) {{
-                    call_exit_actions(st);
+            void {bank_name}<T>::init() {{
+                for (size_t i = 0; i < states_.size(); ++i) {{
+                    init(i);
                 }}
             }}
 
             template <typename T>
-            void {class_name}<T>::call_transition_actions(int transition_idx) {{
-                switch (transition_idx) {{
-                    {nlnl.join(f'case {i}: {{  // {x}{nl}{self._make_transition_actions_code(i)} }}break;'
-                     for i, x in enumerate(self.diagram.transitions) if x.actions)}
-                }}  // switch(transition_idx)
-            }}  // call_transition_actions()
+            void {bank_name}<T>::init(size_t instance_id) {{
+                this->instance_ = instance_id;
+                {class_name}<T>::init();
+                states_[instance_id] = this->state_;
+            }}
 
             template <typename T>
-            int {class_name}<T>::find_transition_from_cur_state(Event event) const {{
-                auto state = state_;
-                while (state != State::NONE_) {{
-                    // Go through the whole transition table to find a matching transition
-                    for (int i = 0; i < kNumTransitions; ++i) {{
-                        const Transition& transition = get_transition(i);
-
-                        // Ignore the transition if the "from" state or the event don't match
-                        if (transition.event != event || transition.from_state != state) {{
-                            continue;
-                        }}
-                        
-                        // If the guard condition is met, we have a winner!
-                        if (check_transition_guard(i)) {{
-                            return i;
-                        }}
-                    }}
+            void {bank_name}<T>::post_event(size_t instance_id, Event event) {{
+                this->instance_ = instance_id;
+                this->state_ = states_[instance_id];
+                {class_name}<T>::post_event(event);
+                states_[instance_id] = this->state_;
+            }}
 
-                    // Try the parent state if there is no direct transition from this state
-                    state = get_parent_state(state);
+            template <typename T>
+            void {bank_name}<T>::post_events(const size_t* instance_ids, const Event* events, size_t count) {{
+                for (size_t i = 0; i < count; ++i) {{
+                    post_event(instance_ids[i], events[i]);
                 }}
-
-                // We didn't find any matching transition or the guard condition failed
-                return -1;
             }}
 
             template <typename T>
-            bool {class_name}<T>::check_transition_guard(int transition_idx) const {{
-                switch (transition_idx) {{
-                    {nl.join(self._make_guard_code(i) for i, x in enumerate(self.diagram.transitions) if x.guard)}
+            void {bank_name}<T>::broadcast(Event event) {{
+                for (size_t i = 0; i < states_.size(); ++i) {{
+                    post_event(i, event);
                 }}
+            }}
 
-                return true;
+            template <typename T>
+            typename {bank_name}<T>::State {bank_name}<T>::current_state(size_t instance_id) const {{
+                return states_[instance_id];
             }}
+        ''')
 
-            {namespace_end}
+    def _make_dummy_base_code(self, class_name: str) -> str:
+        """Generates the default base class, defining empty trace hooks if tracing is enabled"""
+        if not self.options.trace:
+            return f'class {class_name}DummyBase {{}};'
 
-            // ============================================================================
-            // AUTO-GENERATED FILE. DO NOT MODIFY!
-            // ============================================================================
-        ''').split('\n')
+        return textwrap.dedent(f'''
+            class {class_name}DummyBase {{
+              public:
+                template <typename Event>
+                void on_event_dropped(Event) {{}}
+
+                void on_transition(int) {{}}
+                void on_guard_rejected(int) {{}}
+            }};
+        ''')
+
+    def _make_counters_code(self, class_name: str) -> str:
+        """Generates the functions for naming transitions and for dumping and resetting the counters"""
+        code = []
+        if self.options.trace or self.options.counters:
+            code.append(textwrap.dedent(f'''
+                template <typename T>
+                const char* {class_name}<T>::transition_to_string(int transition_idx) {{
+                    static constexpr const char* lut[] = {{
+                        {''.join(f'{_to_string_literal(str(x))}, ' for x in self.model.transitions)}
+                    }};
+
+                    return transition_idx >= 0 && transition_idx < kNumTransitions ? lut[transition_idx] : "INVALID";
+                }}
+            '''))
+
+        if self.options.counters:
+            code.append(textwrap.dedent(f'''
+                template <typename T>
+                void {class_name}<T>::dump_counters(FILE* file) const {{
+                    for (int i = 0; i < kNumTransitions; ++i) {{
+                        fprintf(file, "transition %s: %llu\\n", transition_to_string(i), transition_counts_[i]);
+                    }}
+
+                    for (int i = 1; i <= kNumStates; ++i) {{
+                        fprintf(file, "state %s: %llu\\n", to_string(static_cast<State>(i)), state_entry_counts_[i]);
+                    }}
+
+                    for (int i = 1; i <= kNumEvents; ++i) {{
+                        const char* event = to_string(static_cast<Event>(i));
+                        fprintf(file, "dropped %s: %llu\\n", event, event_dropped_counts_[i]);
+                    }}
+                }}
+
+                template <typename T>
+                void {class_name}<T>::reset_counters() {{
+                    for (int i = 0; i < kNumTransitions; ++i) {{
+                        transition_counts_[i] = 0;
+                    }}
+
+                    for (int i = 0; i <= kNumStates; ++i) {{
+                        state_entry_counts_[i] = 0;
+                    }}
+
+                    for (int i = 0; i <= kNumEvents; ++i) {{
+                        event_dropped_counts_[i] = 0;
+                    }}
+                }}
+            '''))
 
         return '\n'.join(code)
 
+    @property
+    def _find_transition_qualifier(self) -> str:
+        """Returns the qualifier of find_transition_from_cur_state(), which calls a non-const hook when tracing"""
+        return '' if self.options.trace else ' const'
+
+    def _make_handler_call_code(self) -> str:
+        """Generates the call of the current state's handler for the functions strategy"""
+        call = '(this->*handlers[static_cast<int>(state_) - 1])(event)'
+        event_dropped_code = self._make_event_dropped_code()
+        if event_dropped_code:
+            return f'if (!{call}) {{\n{event_dropped_code}}}'
+
+        return f'{call};'
+
+    def _make_transition_taken_code(self, transition_idx: str) -> str:
+        """Generates the code counting and tracing the given transition before taking it
+
+        Like the other instrumentation code, the code is either empty or ends with a line break.
+        """
+        code = []
+        if self.options.counters:
+            code.append(f'++transition_counts_[{transition_idx}];\n')
+        if self.options.trace:
+            code.append(f'this->on_transition({transition_idx});\n')
+
+        return ''.join(code)
+
+    def _make_guard_rejected_code(self, transition_idx: str) -> str:
+        """Generates the code tracing that the guard condition of the given transition is not met"""
+        return f'this->on_guard_rejected({transition_idx});\n' if self.options.trace else ''
+
+    def _make_event_dropped_code(self) -> str:
+        """Generates the code counting and tracing that the event cannot be handled in the current state"""
+        code = []
+        if self.options.counters:
+            code.append('++event_dropped_counts_[static_cast<int>(event)];\n')
+        if self.options.trace:
+            code.append('this->on_event_dropped(event);\n')
+
+        return ''.join(code)
+
+    def _make_switch_dispatch_code(self) -> str:
+        """Generates the body of post_event() for the switch strategy
+
+        Every leaf state gets a case with a nested switch on the event. Each event case checks the candidate
+        transitions in the same order as the transition table gets scanned, including the ones inherited from
+        ancestor states, and contains the exit, transition and entry actions for this particular leaf state.
+        """
+        # Taken transitions must return if code for dropped events follows the switch
+        event_dropped_code = self._make_event_dropped_code()
+        return_after_unguarded = bool(event_dropped_code)
+
+        state_cases = []
+        for state_name in self._reachable_state_names:
+            compiled_state = self.model.states[state_name]
+            if compiled_state.leaf_states[0] is not compiled_state.state:
+                continue
+
+            event_cases = [self._make_leaf_case_code(f'Event::{x}', compiled_state.state, x, return_after_unguarded)
+                           for x in self.model.event_names]
+            event_cases = [x for x in event_cases if x]
+
+            if event_cases:
+                state_cases.append(f'case State::{state_name}: {{\nswitch (event) {{\n' +
+                                   '\n\n'.join(event_cases) +
+                                   '\n\ndefault:\nbreak;\n}  // switch (event)\n} break;')
+
+        return 'switch (state_) {\n' + '\n\n'.join(state_cases) + '\n\ndefault:\nbreak;\n}  // switch (state_)\n\n' + \
+            event_dropped_code
+
+    def _make_event_method_code(self, class_name: str, event_name: str) -> str:
+        """Generates the method handling the given event for the events strategy
+
+        The method contains a switch on the current state with a case for each leaf state that can handle the event,
+        checking the candidate transitions like the switch strategy. With a queue, the method is called by
+        dispatch_event() and on_<event>() posts the event instead.
+        """
+        event_dropped_code = self._make_event_dropped_code()
+        state_cases = [self._make_leaf_case_code(f'State::{x}', self.model.states[x].state, event_name,
+                                                 bool(event_dropped_code))
+                       for x in self._reachable_state_names if not self.model.states[x].state.child_states]
+        state_cases = [x for x in state_cases if x]
+
+        code = []
+        if event_dropped_code:
+            code.append(f'const Event event = Event::{event_name};\n')
+        if state_cases:
+            cases = '\n\n'.join(state_cases)
+            code.append(f'switch (state_) {{\n{cases}\n\ndefault:\nbreak;\n}}  // switch (state_)\n')
+        code.append(event_dropped_code)
+
+        body = '\n'.join(code)
+        if self.options.queue == 'none':
+            return f'template <typename T>\nvoid {class_name}<T>::on_{event_name}() {{\n{body}}}'
+
+        return (f'template <typename T>\nvoid {class_name}<T>::on_{event_name}() {{\n'
+                f'post_event(Event::{event_name});\n}}\n\n'
+                f'template <typename T>\nvoid {class_name}<T>::dispatch_{event_name}() {{\n{body}}}')
+
+    def _make_state_handler_code(self, class_name: str, state_name: str) -> str:
+        """Generates the handler function of the given state for the functions strategy
+
+        The handler checks the transitions leaving the state itself in the same order as the transition table gets
+        scanned and passes the event on to the handler of the parent state if none of them can be taken.
+        """
+        state = self.model.states[state_name].state
+        event_cases = []
+        for event_name in self.model.event_names:
+            candidates = self._transitions_by_state_and_event.get((state_name, event_name), [])
+            if candidates:
+                code = self._make_candidates_code(candidates, lambda x: self._make_transition_sequence_code(x.idx),
+                                                  'return true;', True)
+                case_end = '}' if any(not x.transition.guard for x in candidates) else '} break;'
+                event_cases.append(f'case Event::{event_name}: {{\n{code}\n{case_end}')
+
+        code = []
+        if event_cases:
+            code += ['switch (event) {', '\n\n'.join(event_cases), '', 'default:', 'break;', '}  // switch (event)', '']
+
+        if state.parent_state:
+            code.append(f'return handle_{state.parent_state.name}(event);')
+        else:
+            code.append('return false;')
+
+        param = 'Event event' if event_cases or state.parent_state else 'Event'
+        return f'template <typename T>\nbool {class_name}<T>::handle_{state_name}({param}) {{\n' + \
+            '\n'.join(code) + '\n}'
+
+    def _make_candidates_code(self, candidates: List[CompiledTransition],
+                              make_transition_code: Callable[[CompiledTransition], str], return_code: str,
+                              return_after_unguarded: bool) -> str:
+        """Generates the code taking the first of the given candidate transitions whose guard condition is met
+
+        The return code follows each guarded transition and, if requested, the unguarded transition that may end the
+        list of candidates.
+        """
+        code = []
+        for trans in candidates:
+            transition_code = self._make_transition_taken_code(str(trans.idx)) + make_transition_code(trans)
+            if trans.transition.guard:
+                code.append(f'if ({trans.transition.guard.code}) {{\n{transition_code}\n{return_code}\n}}\n' +
+                            self._make_guard_rejected_code(str(trans.idx)))
+            else:
+                code.append(f'{transition_code}\n{return_code}' if return_after_unguarded else transition_code)
+                break
+
+        return '\n\n'.join(code)
+
+    def _make_leaf_case_code(self, case_label: str, leaf_state: State, event_name: str,
+                             return_after_unguarded: bool) -> Optional[str]:
+        """Generates the switch case taking the first possible transition for the given event in the given leaf state
+
+        Returns None if no transition can be taken.
+        """
+        candidates = self._get_candidate_transitions(leaf_state, event_name)
+        if not candidates:
+            return None
+
+        code = self._make_candidates_code(candidates, lambda x: self._make_leaf_transition_code(x, leaf_state),
+                                          'return;', return_after_unguarded)
+        returns = return_after_unguarded and not candidates[-1].transition.guard
+        return f'case {case_label}: {{\n{code}\n}}' + ('' if returns else ' break;')
+
+    def _make_leaf_transition_code(self, transition: CompiledTransition, leaf_state: State) -> str:
+        """Generates the action calls for the given transition if the current state is the given leaf state"""
+        if transition.is_internal:
+            return f'call_transition_actions({transition.idx});'
+
+        return self._make_leaf_transition_sequence_code(transition, leaf_state)
+
+    def _get_candidate_transitions(self, state: State, event_name: str) -> List[CompiledTransition]:
+        """Returns the transitions to check in the given state for the given event, including inherited ones
+
+        The order is the same as when scanning the transition table for the state first and then for each of its
+        ancestors. The list ends with the first transition without a guard since no later transition can be taken.
+        """
+        candidates = []
+        while state is not None:
+            for trans in self._transitions_by_state_and_event.get((state.name, event_name), []):
+                candidates.append(trans)
+                if not trans.transition.guard:
+                    return candidates
+            state = state.parent_state
+
+        return candidates
+
+    @property
+    def _reachable_state_names(self) -> List[str]:
+        """Returns the names of all states, sorted alphabetically, except for the unreachable ones if pruning"""
+        return [x for x in self.model.state_names if x not in self.model.unreachable_state_names]
+
     def _make_state_entry_code(self, state_name: str) -> str:
         """Generates the code that is called when entering the given state"""
-        code = ''
-        for trans in self.diagram.states[state_name].entry_transitions:
-            for act in trans.actions:
-                code += f'{act.code};'
-
-        return code
+        transitions = self.model.states[state_name].state.entry_transitions
+        return '\n'.join(f'{act.code};' for trans in transitions for act in trans.actions)
 
     def _make_state_exit_code(self, state_name: str) -> str:
         """Generates the code that is called when exiting the given state"""
-        code = ''
-        for trans in self.diagram.states[state_name].exit_transitions:
-            for act in trans.actions:
-                code += f'{act.code};'
-
-        return code
+        transitions = self.model.states[state_name].state.exit_transitions
+        return '\n'.join(f'{act.code};' for trans in transitions for act in trans.actions)
 
     def _make_parent_state_enum_member(self, state_name: str) -> str:
         """Returns the name of the State enum member of the given state's parent"""
-        parent = self.diagram.states[state_name].parent_state
+        parent = self.model.states[state_name].state.parent_state
         name = parent.name if parent else 'NONE_'
         return f'State::{name}'
 
-    def _make_transition_initializer(self, transition: Transition) -> str:
-        """Generates the code that initializes the Transition struct"""
-        max_event_len = max(len(x.event.name) for x in self.diagram.transitions)
-        event_code = f'Event::{transition.event.name + ",":{max_event_len + 1}}'
+    @property
+    def _transition_fields(self) -> List[Tuple[str, str, int]]:
+        """Returns the name, type and value width of each field of the Transition struct
 
-        max_from_state_len = max(len(x.from_state.name) for x in self.diagram.transitions)
-        from_state_code = f'State::{transition.from_state.name + ",":{max_from_state_len + 1}}'
+        The fields are ordered by decreasing size so that the struct does not contain any padding between them.
+        """
+        fields = [('event', 'Event', self.model.event_name_width),
+                  ('from_state', 'State', self.model.from_state_name_width),
+                  ('to_state', 'State', self.model.to_state_name_width)]
+        type_names = [x for x, _ in _UNSIGNED_TYPES]
+        sizes = {'Event': type_names.index(self._event_type), 'State': type_names.index(self._state_type)}
 
-        max_to_state_len = max([len(x.to_state.entry_target_state.name)
-                                for x in self.diagram.ext_transitions] + [len('NONE_')])
-        to_state_name = 'NONE_' if transition in transition.from_state.int_transitions else transition.to_state.entry_target_state.name
-        to_state_code = f'State::{to_state_name:{max_to_state_len}}'
-        code = f'/* clang-format off */ {{{event_code} {from_state_code} {to_state_code}}}  /* clang-format on */,'
+        return sorted(fields, key=lambda x: -sizes[x[1]])
 
-        return code
+    def _get_integer_type(self, types: List[Tuple[str, int]], max_value: int) -> str:
+        """Returns the smallest of the given integer types that can hold the given value or the native-width type if
+        optimizing for speed"""
+        if self.options.optimize == 'speed':
+            return types[-1][0]
+
+        return next(name for name, type_max_value in types if max_value <= type_max_value)
+
+    def _make_transition_initializer(self, transition: CompiledTransition) -> str:
+        """Generates the code that initializes the Transition struct"""
+        to_state_name = 'NONE_' if transition.is_internal else transition.target_state.name
+        values = {
+            'event': f'Event::{transition.transition.event.name}',
+            'from_state': f'State::{transition.transition.from_state.name}',
+            'to_state': f'State::{to_state_name}',
+        }
+
+        fields = self._transition_fields
+        columns = [f'{values[name] + ",":{len(field_type) + 2 + width + 1}}' for name, field_type, width in fields[:-1]]
+        columns.append(f'{values[fields[-1][0]]:{len(fields[-1][1]) + 2 + fields[-1][2]}}')
+        code = f'{{{" ".join(columns)}}}'
+        if self.options.clang_format:
+            code = f'/* clang-format off */ {code}  /* clang-format on */'
+
+        return code + ','
 
     def _make_guard_code(self, transition_idx: int) -> str:
         """Generates the code that checks the guard condition for the given transition"""
-        transitions = self.diagram.transitions
-        trans = transitions[transition_idx]
+        trans = self.model.transitions[transition_idx].transition
 
-        max_cond_len = max(len(x.guard.code if x.guard else 'true') for x in transitions)
         cond = trans.guard.code if trans.guard else 'true'
-        case_code = f'case {transition_idx: 3}: {{ return {cond:{max_cond_len}} }}'
+        case_code = f'case {transition_idx: 3}: {{ return {cond + ";":{self.model.guard_width + 1}} }}'
+
+        if not self.options.clang_format:
+            return case_code
+
+        return f'/* clang-format off */ {case_code} /* clang-format on */'
+
+    def _make_transition_sequence_code(self, transition_idx: int) -> str:
+        """Generates the straight-line exit, transition and entry action calls for the given transition
+
+        Since the source state of an external transition can be an ancestor of the current state, the exit actions
+        depend on the current state and get generated for each leaf state below the source state.
+        """
+        trans = self.model.transitions[transition_idx]
+        if trans.is_internal:
+            return f'call_transition_actions({transition_idx});'
+
+        from_state = trans.transition.from_state
+        leaf_states = self.model.states[from_state.name].leaf_states
+        if leaf_states[0] is from_state:
+            return self._make_leaf_transition_sequence_code(trans, from_state)
+
+        cases = ''.join(f'case State::{x.name}: {{\n{self._make_leaf_transition_sequence_code(trans, x)}\n}} break;\n'
+                        for x in leaf_states if x.name not in self.model.unreachable_state_names)
+        return f'switch (state_) {{\n{cases}default:\nbreak;\n}}'
+
+    def _make_leaf_transition_sequence_code(self, transition: CompiledTransition, leaf_state: State) -> str:
+        """Generates the action calls for the given external transition if the current state is the given leaf state"""
+        target_state = transition.target_state
+
+        if leaf_state is target_state:
+            common_state = leaf_state.parent_state
+        else:
+            common_state = self.model.get_common_state(transition.transition.from_state, target_state)
+
+        code = [self._make_exit_sequence_code(leaf_state, common_state),
+                f'call_transition_actions({transition.idx});',
+                self._make_entry_sequence_code(common_state, target_state),
+                f'state_ = State::{target_state.name};']
+
+        return '\n'.join(x for x in code if x)
+
+    def _make_exit_sequence_code(self, state: State, common_state: Optional[State]) -> str:
+        """Generates the exit action calls when leaving the given state up to but excluding the common state"""
+        calls = []
+        while state is not common_state:
+            calls.append(f'call_exit_actions(State::{state.name});')
+            state = state.parent_state
+
+        return '\n'.join(calls)
+
+    def _make_entry_sequence_code(self, common_state: Optional[State], state: State) -> str:
+        """Generates the entry action calls when entering the given state from below the common state"""
+        calls = []
+        while state is not common_state:
+            calls.append(f'call_entry_actions(State::{state.name});')
+            state = state.parent_state
+
+        return '\n'.join(reversed(calls))
+
+    def _make_find_transition_code(self, in_core: bool = False) -> str:
+        """Generates the code that finds the transition to take for the given event in the current state
+
+        The non-template core checks the guard conditions via the callback passed to it, which also takes care of
+        tracing rejected guards.
+        """
+        check_guard = 'check_guard(fsm, i)' if in_core else 'check_transition_guard(i)'
+        guard_rejected_code = '' if in_core else self._make_guard_rejected_code('i')
+        if self.options.dispatch == 'flat':
+            return self._make_flat_find_transition_code(check_guard, guard_rejected_code)
+
+        return textwrap.dedent(f'''
+            auto state = state_;
+            while (state != State::NONE_) {{
+                // Go through the whole transition table to find a matching transition
+                for (int i = 0; i < kNumTransitions; ++i) {{
+                    const Transition& transition = get_transition(i);
+
+                    // Ignore the transition if the "from" state or the event don't match
+                    if (transition.event != event || transition.from_state != state) {{
+                        continue;
+                    }}
+
+                    // If the guard condition is met, we have a winner!
+                    if ({check_guard}) {{
+                        return i;
+                    }}
+
+                    {guard_rejected_code}
+                }}
+
+                // Try the parent state if there is no direct transition from this state
+                state = get_parent_state(state);
+            }}
+
+            // We didn't find any matching transition or the guard condition failed
+            return -1;
+        ''')
+
+    def _make_flat_find_transition_code(self, check_guard: str, guard_rejected_code: str) -> str:
+        """Generates the code that finds the transition via the flattened (state, event) dispatch table"""
+        first_candidates, next_candidates = self._flat_dispatch_tables
+        nl = '\n'
+
+        return textwrap.dedent(f'''
+            // First transition to check for each state (rows) and event (columns), including inherited ones
+            static constexpr {self._transition_index_type} first_candidates[kNumStates][kNumEvents] = {{
+                {nl.join(f'{{{"".join(f"{x:3}," for x in row)}}},  // {name}'
+                         for name, row in zip(self.model.state_names, first_candidates))}
+            }};
+
+            // Next transition to check if the guard condition of a transition is not met
+            static constexpr {self._transition_index_type} next_candidates[kNumTransitions] = {{
+                {''.join(f'{x}, ' for x in next_candidates)}
+            }};
 
-        return f'/* clang-format off */ {case_code} /* clang-format on */;'
+            if (event == Event::NONE_) {{
+                return -1;
+            }}
+
+            int i = first_candidates[static_cast<int>(state_) - 1][static_cast<int>(event) - 1];
+            while (i != -1 && !{check_guard}) {{
+                {guard_rejected_code}i = next_candidates[i];
+            }}
+
+            return i;
+        ''')
+
+    @property
+    def _flat_dispatch_tables(self) -> Tuple[List[List[int]], List[int]]:
+        """Returns the first transition to check for each (state, event) and the next one to check for each transition
+
+        The order in which transitions get checked is the same as when scanning the transition table for the
+        current state first and then for each of its ancestors. Unguarded transitions terminate the chain.
+        """
+        candidates = self._transitions_by_state_and_event
+        next_sibling: List[Optional[int]] = [None] * len(self.model.transitions)
+        for siblings in candidates.values():
+            for trans, next_trans in zip(siblings, siblings[1:]):
+                next_sibling[trans.idx] = next_trans.idx
+
+        def find_first_candidate(state, event_name):
+            while state is not None:
+                if (state.name, event_name) in candidates:
+                    return candidates[(state.name, event_name)][0].idx
+                state = state.parent_state
+            return -1
+
+        first_candidates = [[find_first_candidate(self.model.states[state_name].state, event_name)
+                             for event_name in self.model.event_names]
+                            for state_name in self.model.state_names]
+
+        next_candidates = []
+        for trans in self.model.transitions:
+            if not trans.transition.guard:
+                next_candidates.append(-1)
+            elif next_sibling[trans.idx] is not None:
+                next_candidates.append(next_sibling[trans.idx])
+            else:
+                next_candidates.append(find_first_candidate(trans.transition.from_state.parent_state,
+                                                            trans.transition.event.name))
+
+        return first_candidates, next_candidates
 
     def _make_transition_actions_code(self, transition_idx: int) -> str:
         """Generates the code for the actions associated with the given transition"""
-        trans = self.diagram.transitions[transition_idx]
+        trans = self.model.transitions[transition_idx].transition
 
-        code = ''.join([f'{act.code};' for act in trans.actions])
+        code = '\n'.join([f'{act.code};' for act in trans.actions])
 
         return code
 
-    @property
-    def _state_nesting_depth(self) -> int:
-        """Returns the maximum hierarchical depth of the state machine"""
-        depth = 0
-        states = [x for x in self.diagram.states.values() if x.parent_state is None]
-        while states:
-            depth += 1
-            states = [y for x in states for y in x.child_states]
-
-        return depth
+
+def _check_names(namespace: str, class_name: str) -> None:
+    """Makes sure that the given namespace and class name can be used in the generated code"""
+    assert is_valid_namespace(namespace), f'Invalid namespace: {namespace}'
+    assert is_valid_class_name(class_name), f'Invalid class name: {class_name}'
+
+
+def _to_string_literal(text: str) -> str:
+    """Returns the C++ string literal for the given text"""
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
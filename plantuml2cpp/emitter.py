@@ -0,0 +1,220 @@
+"""
+Module for laying out the generated C++ code without relying on external tools
+"""
+
+import re
+from typing import NamedTuple, List, Tuple, Optional
+
+BRACE_STYLES = ['attach', 'allman']
+
+_ACCESS_SPECIFIER_RE = re.compile(r'^(public|protected|private)\s*:$')
+_LABEL_RE = re.compile(r'^(case\b.*|default\s*):$')
+_BRACE_RE = re.compile(r'[{}]')
+_LITERAL_OR_COMMENT_RE = re.compile(r'"(?:\\.|[^"\\])*"?|\'(?:\\.|[^\'\\])*\'?|//.*|/\*.*?(?:\*/|$)')
+
+
+class CodeStyle(NamedTuple):
+    """Options for the layout of the generated code"""
+    indent_width: int = 4
+    brace_style: str = 'attach'  # One of BRACE_STYLES
+    column_limit: int = 120
+
+
+def format_code(code: str, style: CodeStyle = CodeStyle()) -> str:
+    """Re-indents the given generated code and produces a deterministic layout
+
+    Every line gets indented according to the braces and labels preceding it, regardless of its original indentation.
+    Namespaces do not increase the indentation and access specifiers are outdented by half an indentation level. Blank
+    lines are collapsed and removed at the beginning and end of blocks. Lines consisting of comma-separated lists
+    (e.g. enum members) get wrapped at the column limit. The code is expected to have at most one statement per line.
+    """
+    formatter = CodeFormatter(style)
+    return formatter.format(code) + formatter.finish()
+
+
+class CodeFormatter:
+    """Lays out generated code piece by piece exactly like format_code() lays out the concatenation of the pieces
+
+    The layout state is kept between the pieces, which are joined by line breaks. Blank lines are held back until the
+    next line shows whether they are kept, so the code returned for a piece may lag behind by those.
+    """
+
+    def __init__(self, style: CodeStyle = CodeStyle()):
+        """Constructs the formatter for code starting at the top level"""
+        assert style.brace_style in BRACE_STYLES, f'Invalid brace style: {style.brace_style}'
+        assert style.indent_width >= 0, f'Invalid indent width: {style.indent_width}'
+        self.style = style
+
+        self._brace_stack: List[bool] = []  # One entry per open brace; True if the brace increases the indentation
+        self._label_levels: List[int] = []  # Indentation levels at which a case label is active
+        self._in_block_comment = False
+        self._last_line: Optional[str] = None  # Last line returned that is not blank
+        self._num_blank_lines = 0  # Blank lines after the last line, dropped before closing braces and at the end
+
+    def format(self, code: str) -> str:
+        """Lays out the next piece of code and returns the laid out lines that are final"""
+        lines = []
+        for raw_line in code.split('\n'):
+            self._format_line(raw_line.strip(), lines)
+
+        return ''.join(x + '\n' for x in lines)
+
+    def finish(self) -> str:
+        """Returns the rest of the laid out code after the last piece"""
+        return '' if self._last_line is not None else '\n'
+
+    def _format_line(self, text: str, lines: List[str]) -> None:
+        """Lays out a single line of code with its surrounding whitespace stripped, adding the final lines"""
+        style = self.style
+        brace_stack = self._brace_stack
+
+        if self._in_block_comment:
+            self._in_block_comment = '*/' not in text
+            prefix = ' ' if text.startswith('*') else ''
+            self._add_line(_indent(sum(brace_stack), style) + prefix + text, lines)
+            return
+
+        if not text:
+            if not self._num_blank_lines and self._last_line and not self._last_line.endswith('{'):
+                self._num_blank_lines = 1
+            return
+
+        if text.startswith('#'):
+            self._add_line(text, lines)
+            return
+
+        stripped_text = _strip_literals(text)
+        code_part, comment_part = _split_trailing_comment(text, stripped_text)
+        self._in_block_comment = code_part.startswith('/*') and '*/' not in text
+
+        # Closing braces at the beginning of the line affect the indentation of the line itself
+        num_leading_closing_braces = len(code_part) - len(code_part.lstrip('}'))
+        del brace_stack[max(len(brace_stack) - num_leading_closing_braces, 0):]
+
+        level = sum(brace_stack)
+        if num_leading_closing_braces and self._num_blank_lines:
+            self._num_blank_lines -= 1
+
+        is_label = code_part.endswith(':') and _LABEL_RE.match(code_part)
+        if self._label_levels:
+            self._label_levels = [x for x in self._label_levels if x <= level]
+            indent = _indent(level + len([x for x in self._label_levels if x < level or not is_label]), style)
+        else:
+            indent = _indent(level, style)
+
+        if is_label and level not in self._label_levels:
+            self._label_levels.append(level)
+        elif code_part.endswith(':') and _ACCESS_SPECIFIER_RE.match(code_part):
+            indent = indent[:max(len(indent) - style.indent_width // 2, 0)]
+
+        for c in _BRACE_RE.findall(stripped_text, num_leading_closing_braces, len(code_part)):
+            if c == '{':
+                brace_stack.append(not code_part.startswith('namespace '))
+            elif brace_stack:
+                brace_stack.pop()
+
+        for line in _layout_line(indent, code_part, comment_part, style):
+            self._add_line(line, lines)
+
+    def _add_line(self, line: str, lines: List[str]) -> None:
+        """Adds a laid out line to the final lines, preceded by the blank lines held back, or holds it back if blank"""
+        if not line:
+            self._num_blank_lines += 1
+            return
+
+        lines += [''] * self._num_blank_lines
+        lines.append(line)
+        self._num_blank_lines = 0
+        self._last_line = line
+
+
+def _layout_line(indent: str, code_part: str, comment_part: str, style: CodeStyle) -> List[str]:
+    """Returns the output lines for a single line of code, applying the brace style and the column limit"""
+    if style.brace_style == 'allman' and code_part.endswith('{') and code_part != '{' \
+            and not code_part[:-1].rstrip().endswith('='):
+        header = code_part[:-1].rstrip()
+        return [_join_comment(indent + header, comment_part), indent + '{']
+
+    line = _join_comment(indent + code_part, comment_part)
+    if len(line) <= style.column_limit or comment_part or not code_part.endswith(','):
+        return [line]
+
+    items = _split_list(code_part)
+    if len(items) < 2:
+        return [line]
+
+    wrapped_lines = [indent]
+    for item in items:
+        candidate = f'{wrapped_lines[-1]} {item}' if wrapped_lines[-1] != indent else indent + item
+        if len(candidate) > style.column_limit and wrapped_lines[-1] != indent:
+            wrapped_lines.append(indent + item)
+        else:
+            wrapped_lines[-1] = candidate
+
+    return wrapped_lines
+
+
+def _indent(level: int, style: CodeStyle) -> str:
+    """Returns the whitespace for the given indentation level"""
+    return ' ' * (level * style.indent_width)
+
+
+def _join_comment(line: str, comment_part: str) -> str:
+    """Appends a trailing comment to a line"""
+    return f'{line}  {comment_part}' if comment_part else line
+
+
+def _split_trailing_comment(text: str, stripped_text: str) -> Tuple[str, str]:
+    """Splits a line into the code and a trailing // comment, given the line with its literals stripped"""
+    idx = stripped_text.find('//')
+    if idx <= 0:
+        return text, ''
+
+    return text[:idx].rstrip(), text[idx:]
+
+
+def _split_list(code: str) -> List[str]:
+    """Splits a comma-separated list into its items (including the commas) at the top level of nesting"""
+    stripped = _strip_literals(code)
+    items = []
+    start = 0
+    depth = 0
+    for i, c in enumerate(stripped):
+        if c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            items.append(code[start:i + 1].strip())
+            start = i + 1
+
+    if code[start:].strip():
+        items.append(code[start:].strip())
+
+    return items
+
+
+def _strip_literals(text: str) -> str:
+    """Replaces the contents of string and character literals and of comments with spaces, keeping the length"""
+    if '"' not in text and "'" not in text and '/' not in text:
+        return text
+
+    return _LITERAL_OR_COMMENT_RE.sub(_blank_literal_or_comment, text)
+
+
+def _blank_literal_or_comment(match: re.Match) -> str:
+    """Returns the replacement for a literal or comment found by _LITERAL_OR_COMMENT_RE"""
+    token = match.group()
+    if token[0] in '"\'':
+        closing = token[-1] if len(token) > 1 and token[-1] == token[0] and not _is_escaped(token) else ''
+        return token[0] + ' ' * (len(token) - 1 - len(closing)) + closing
+    if token.startswith('//'):
+        return '//' + ' ' * (len(token) - 2)
+
+    return ' ' * len(token)
+
+
+def _is_escaped(token: str) -> bool:
+    """Returns True if the last character of the given literal is escaped by a backslash"""
+    num_backslashes = len(token[:-1]) - len(token[:-1].rstrip('\\'))
+    return num_backslashes % 2 == 1
@@ -0,0 +1,81 @@
+"""
+Module for formatting generated code with clang-format
+"""
+
+import pathlib
+import subprocess
+import concurrent.futures
+from typing import NamedTuple, List, Optional, Tuple, Dict
+
+from .cache import GenerationCache, make_cache_key, clang_format_fingerprint
+
+
+class FormatResult(NamedTuple):
+    """Result of formatting a single piece of code"""
+    code: Optional[str]  # Formatted code or None if formatting failed
+    error: Optional[str]  # Error message if formatting failed
+
+
+class ClangFormatter:
+    """Formats code with clang-format using a bounded pool of workers and an optional cache of formatted code
+
+    The cache is keyed by the unformatted code and the clang-format executable and configuration that apply to the
+    output file, so identical code never gets formatted twice.
+    """
+
+    def __init__(self, cache_dir: Optional[pathlib.Path] = None, num_workers: int = 1):
+        """Constructs the formatter"""
+        self.cache = GenerationCache(cache_dir) if cache_dir else None
+        self.num_workers = max(num_workers, 1)
+
+    def format(self, code: str, output_file: pathlib.Path) -> str:
+        """Formats the given code using the configuration that applies to the given output file"""
+        [result] = self.format_many([(code, output_file)])
+        if result.error:
+            raise RuntimeError(result.error)
+
+        return result.code
+
+    def format_many(self, requests: List[Tuple[str, pathlib.Path]]) -> List[FormatResult]:
+        """Formats all given (code, output file) pairs; identical requests are only formatted once"""
+        fingerprints: Dict[pathlib.Path, bytes] = {}
+        keys = []
+        for code, output_file in requests:
+            if output_file.parent not in fingerprints:
+                fingerprints[output_file.parent] = clang_format_fingerprint(output_file)
+            keys.append(make_cache_key([b'clang-format', code.encode(), fingerprints[output_file.parent]]))
+
+        results: Dict[str, FormatResult] = {}
+        pending: Dict[str, Tuple[str, pathlib.Path]] = {}
+        for key, request in zip(keys, requests):
+            if key in results or key in pending:
+                continue
+
+            cached_code = self.cache.get(key) if self.cache else None
+            if cached_code is not None:
+                results[key] = FormatResult(cached_code, None)
+            else:
+                pending[key] = request
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = {key: executor.submit(run_clang_format, *request) for key, request in pending.items()}
+
+        for key, future in futures.items():
+            try:
+                results[key] = FormatResult(future.result(), None)
+            except (OSError, subprocess.CalledProcessError) as e:
+                results[key] = FormatResult(None, f'{type(e).__name__}: {e}')
+                continue
+
+            if self.cache:
+                self.cache.put(key, results[key].code)
+
+        return [results[x] for x in keys]
+
+
+def run_clang_format(code: str, output_file: pathlib.Path) -> str:
+    """Runs clang-format on the given code using the configuration that applies to the given output file"""
+    assumed_filename = output_file.parent / 'fsm.h'
+    res = subprocess.run(['clang-format', f'-assume-filename={assumed_filename}'], input=code.encode(),
+                         stdout=subprocess.PIPE, check=True)
+    return res.stdout.decode()
@@ -0,0 +1,136 @@
+"""
+Module for the compiled, indexed representation of a parsed state diagram
+"""
+
+import types
+from typing import NamedTuple, Optional, Tuple, Mapping, FrozenSet
+
+from .analysis import AnalysisReport
+from .parser import PlantUmlStateDiagram, State, Transition
+
+
+class CompiledState(NamedTuple):
+    """Represents a state together with the information derived from the state hierarchy"""
+    id: int  # Value of the state in the generated State enum
+    state: State
+    depth: int  # Nesting depth; 1 for top level states
+    ancestors: Tuple[State, ...]  # The state itself followed by its parent, grandparent, etc.
+    leaf_states: Tuple[State, ...]  # States without child states in the hierarchy of the state
+    entry_target_state: State
+
+    @property
+    def name(self) -> str:
+        """Returns the name of the state"""
+        return self.state.name
+
+
+class CompiledTransition(NamedTuple):
+    """Represents a transition together with its position in the generated transition table"""
+    idx: int  # Index in the generated transition table
+    transition: Transition
+    event_id: int  # Value of the event in the generated Event enum
+    is_internal: bool
+    target_state: Optional[State]  # Final target state when taking the transition; None for internal transitions
+
+    def __str__(self):
+        return str(self.transition)
+
+
+class CompiledDiagram(NamedTuple):
+    """Frozen, indexed representation of a state diagram that can be queried without any further computation"""
+    copyright_header: str
+    state_names: Tuple[str, ...]  # Sorted alphabetically
+    event_names: Tuple[str, ...]  # Sorted alphabetically
+    states: Mapping[str, CompiledState]  # Sorted by the state name
+    event_ids: Mapping[str, int]  # Sorted by the event name
+    transitions: Tuple[CompiledTransition, ...]  # Sorted by the event and the source state name
+    initial_state: State
+    nesting_depth: int
+    event_name_width: int  # Length of the longest event name used in a transition
+    from_state_name_width: int  # Length of the longest source state name used in a transition
+    to_state_name_width: int  # Length of the longest target state name (or NONE_) used in a transition
+    guard_width: int  # Length of the longest guard condition (or true) used in a transition
+    unreachable_state_names: FrozenSet[str] = frozenset()  # States whose actions have been pruned
+
+    def get_common_state(self, state_a: State, state_b: State) -> Optional[State]:
+        """Returns the closest common ancestor of the two given states (including the states themselves)"""
+        depth_a = self.states[state_a.name].depth
+        depth_b = self.states[state_b.name].depth
+
+        while depth_a > depth_b:
+            state_a, depth_a = state_a.parent_state, depth_a - 1
+        while depth_b > depth_a:
+            state_b, depth_b = state_b.parent_state, depth_b - 1
+        while state_a is not state_b:
+            state_a, state_b = state_a.parent_state, state_b.parent_state
+
+        return state_a
+
+
+def compile_diagram(diagram: PlantUmlStateDiagram, analysis: Optional[AnalysisReport] = None) -> CompiledDiagram:
+    """Creates the compiled representation of the given state diagram
+
+    If the analysis of the diagram is given, the transitions that can never be taken are left out. The states and
+    events are kept, so that the generated enums do not depend on the analysis.
+    """
+    dead_transitions = analysis.dead_transitions if analysis else frozenset()
+    state_names = tuple(sorted(diagram.states))
+    states = {name: _compile_state(diagram.states[name], i + 1) for i, name in enumerate(state_names)}
+
+    transitions = []
+    event_names = set()
+    for state in diagram.states.values():
+        transitions += [(x, True) for x in state.int_transitions]
+        transitions += [(x, False) for x in state.ext_transitions]
+        event_names.update(x.event.name for x in state.int_transitions)
+        event_names.update(x.event.name for x in state.ext_transitions)
+
+    transitions = [x for x in transitions if x[0] not in dead_transitions]
+    transitions.sort(key=lambda x: (x[0].event.name, x[0].from_state.name))
+    event_names = tuple(sorted(event_names))
+    event_ids = {name: i + 1 for i, name in enumerate(event_names)}
+
+    compiled_transitions = tuple(
+        CompiledTransition(i, trans, event_ids[trans.event.name], is_internal,
+                           None if is_internal else states[trans.to_state.name].entry_target_state)
+        for i, (trans, is_internal) in enumerate(transitions))
+
+    plain_transitions = [x.transition for x in compiled_transitions]
+
+    return CompiledDiagram(
+        copyright_header=diagram.copyright_header,
+        state_names=state_names,
+        event_names=event_names,
+        states=types.MappingProxyType(states),
+        event_ids=types.MappingProxyType(event_ids),
+        transitions=compiled_transitions,
+        initial_state=diagram.initial_state,
+        nesting_depth=max((x.depth for x in states.values()), default=0),
+        event_name_width=max((len(x.event.name) for x in plain_transitions), default=0),
+        from_state_name_width=max((len(x.from_state.name) for x in plain_transitions), default=0),
+        to_state_name_width=max([len(x.target_state.name) for x in compiled_transitions if x.target_state]
+                                + [len('NONE_')]),
+        guard_width=max((len(x.guard.code if x.guard else 'true') for x in plain_transitions), default=0),
+        unreachable_state_names=frozenset(x.name for x in analysis.unreachable_states) if analysis else frozenset(),
+    )
+
+
+def _compile_state(state: State, state_id: int) -> CompiledState:
+    """Creates the compiled representation of a single state"""
+    ancestors = []
+    ancestor = state
+    while ancestor is not None:
+        ancestors.append(ancestor)
+        ancestor = ancestor.parent_state
+
+    leaf_states = []
+    pending = [state]
+    while pending:
+        st = pending.pop()
+        if st.child_states:
+            pending += reversed(st.child_states)
+        else:
+            leaf_states.append(st)
+
+    return CompiledState(state_id, state, len(ancestors), tuple(ancestors), tuple(leaf_states),
+                         state.entry_target_state)
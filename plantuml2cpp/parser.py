@@ -2,10 +2,13 @@
 Module for parsing PlantUML state diagram files
 """
 
+import io
 import pathlib
-import itertools
 import re
-from typing import NamedTuple, List, Optional, Tuple, Dict, Union
+from typing import NamedTuple, List, Optional, Tuple, Dict, Iterable, Iterator, Match, TextIO, Union
+
+from .cache import file_signature
+from .timing import PhaseTimer, timed_phase
 
 
 class Line(NamedTuple):
@@ -37,13 +40,17 @@ class Action(NamedTuple):
     code: str
 
 
-class Transition(NamedTuple):
+class Transition:
     """Represents a transition in the FSM"""
-    event: str
-    guard: Optional[Guard]
-    from_state: 'State'
-    to_state: 'State'  # Target state as written in the .puml file
-    actions: List[Action]
+    __slots__ = ('event', 'guard', 'from_state', 'to_state', 'actions')
+
+    def __init__(self, event: Event, guard: Optional[Guard], from_state: 'State', to_state: 'State',
+                 actions: List[Action]):
+        self.event = event
+        self.guard = guard
+        self.from_state = from_state
+        self.to_state = to_state  # Target state as written in the .puml file
+        self.actions = actions
 
     def __str__(self):
         guard_str = '' if not self.guard else f' [{self.guard.code}]'
@@ -53,30 +60,45 @@ class Transition(NamedTuple):
         return str(self)
 
 
-class State(NamedTuple):
-    """Represents a state in the FSM"""
-    name: str
-    parent_state: Optional['State']
-    child_states: 'StateDict'
-    is_initial_state: bool
-    ext_transitions: List[Transition]
-    int_transitions: List[Transition]
-    entry_transitions: List[Transition]
-    exit_transitions: List[Transition]
-
-    @property
-    def initial_child_state(self) -> Union['State', None]:
-        """Returns the child state that is the initial state when entering this state"""
-        states = [x for x in self.child_states if x.is_initial_state]
-        return states[0] if states else None
+class State:
+    """Represents a state in the FSM
+
+    States are compared by identity. The attributes and the constructor arguments are the same as for the former
+    NamedTuple representation. In addition, every state created by the parser has a unique integer ID (in the order
+    in which the states appear in the .puml file) and knows its initial child state without searching for it.
+    """
+    __slots__ = ('id', 'name', 'parent_state', 'child_states', 'is_initial_state', 'ext_transitions',
+                 'int_transitions', 'entry_transitions', 'exit_transitions', 'initial_child_state')
+
+    def __init__(self, name: str, parent_state: Optional['State'], child_states: List['State'],
+                 is_initial_state: bool, ext_transitions: List[Transition], int_transitions: List[Transition],
+                 entry_transitions: List[Transition], exit_transitions: List[Transition], id: int = -1):
+        self.id = id
+        self.name = name
+        self.parent_state = parent_state
+        self.child_states = child_states
+        self.is_initial_state = is_initial_state
+        self.ext_transitions = ext_transitions
+        self.int_transitions = int_transitions
+        self.entry_transitions = entry_transitions
+        self.exit_transitions = exit_transitions
+        # Child state that is the initial state when entering this state
+        self.initial_child_state = next((x for x in child_states if x.is_initial_state), None)
+
+    def add_child_state(self, state: 'State') -> None:
+        """Appends the given state to the child states"""
+        self.child_states.append(state)
+        if state.is_initial_state and self.initial_child_state is None:
+            self.initial_child_state = state
 
     @property
     def entry_target_state(self) -> 'State':
         """Returns the state in the hierarchy of this state that is the final target when entering this state"""
-        if not self.initial_child_state:
-            return self
-        else:
-            return self.initial_child_state.entry_target_state
+        state = self
+        while state.initial_child_state is not None:
+            state = state.initial_child_state
+
+        return state
 
     def __str__(self):
         parent = 'None' if not self.parent_state else self.parent_state.name
@@ -99,29 +121,141 @@ class State(NamedTuple):
 StateDict = Dict[str, State]
 
 
+# Line prefixes of things that are irrelevant for the FSM
+_IGNORED_LINE_PREFIXES = ('@', 'title ', 'hide empty ', 'note ')
+
+# Grammar of the (cleaned up) lines and the text describing a transition
+_COLOR_RE = re.compile(r'#\w+')
+_INITIAL_STATE_TRANSITION_RE = re.compile(r'^\[\*\]\s+-+>\s+(\w+)\s*(.*)')
+_STATE_RE = re.compile(r'^(state\s+)?(\w+)\s*(:\s*(.*?)\s*)?(\{?)$')
+_TRANSITION_RE = re.compile(r'^(\w+)\s+-+>\s(\w+)\s*(:\s*(.*?)\s*)?')
+_TRANSITION_TEXT_RE = re.compile(r'^(\w+)\s*(\[\s*(.*?)\s*\]\s*)?(/(.*))?')
+_INCLUDE_RE = re.compile(r'^!include\s+"?(.*?)"?$')
+
+# Kinds of lines that the tokenizer can produce
+_COPYRIGHT_LINE = 'copyright'
+_INITIAL_STATE_TRANSITION_LINE = 'initial'
+_CLOSING_BRACE_LINE = 'closing brace'
+_STATE_LINE = 'state'
+_TRANSITION_LINE = 'transition'
+_UNKNOWN_LINE = 'unknown'
+
+Token = Tuple[str, Line, Optional[Match]]
+
+
+class _Fragment(NamedTuple):
+    """Tokenized lines of an included file"""
+    tokens: Tuple[Token, ...]
+    dependencies: Tuple[pathlib.Path, ...]  # The included file and all files included by it
+
+
+# Included files that have already been tokenized, keyed by their resolved path, with the modification time and size
+# of the file and of each file included by it, so that files included by several diagrams get tokenized only once per
+# process. Each file has only one entry, which gets replaced when the file or a file included by it changes, so
+# long-running processes do not accumulate outdated fragments.
+_fragment_cache: Dict[pathlib.Path, Tuple[Tuple[Optional[Tuple[int, int]], ...], _Fragment]] = {}
+
+
 class PlantUmlStateDiagram:
     """Parser for PlantUML state diagram files"""
 
-    def __init__(self, filename: pathlib.Path):
-        """Constructs the state diagram representation for the given .puml file"""
-        self.states = self.parse_puml_file(filename)
+    def __init__(self, filename: pathlib.Path, text: Optional[Union[str, TextIO]] = None,
+                 timer: Optional[PhaseTimer] = None):
+        """Constructs the state diagram representation for the given .puml file
+
+        If the text is given as a string or a text stream, it gets parsed instead of the file, which then only names
+        the diagram in error messages and locates included files; it does not need to exist. If the timer is given,
+        the pass over the lines and the resolution of the states and transitions get measured.
+        """
+        if text is None:
+            self.states = self.parse_puml_file(filename, timer)
+        elif isinstance(text, str):
+            self.states = self.parse_puml_text(filename, text, timer)
+        else:
+            self.states = self.parse_puml_stream(filename, text, timer)
 
-    def parse_puml_file(self, filename: pathlib.Path) -> StateDict:
+    def parse_puml_file(self, filename: pathlib.Path, timer: Optional[PhaseTimer] = None) -> StateDict:
         """Parses the FSM definition in the given .puml file"""
-        lines = self._read_puml_file(filename)
+        with open(filename, 'r') as f:
+            return self._parse_lines(filename, self._read_puml_file(filename, f), timer)
+
+    def parse_puml_text(self, filename: pathlib.Path, text: str, timer: Optional[PhaseTimer] = None) -> StateDict:
+        """Parses the FSM definition in the given text, naming it after the given file in error messages"""
+        return self.parse_puml_stream(filename, io.StringIO(text), timer)
+
+    def parse_puml_stream(self, filename: pathlib.Path, stream: TextIO,
+                          timer: Optional[PhaseTimer] = None) -> StateDict:
+        """Parses the FSM definition read line by line from the given text stream, naming it after the given file in
+        error messages"""
+        return self._parse_lines(filename, self._read_puml_file(filename, stream), timer)
+
+    def _parse_lines(self, filename: pathlib.Path, lines: Iterable[Line], timer: Optional[PhaseTimer]) -> StateDict:
+        """Parses the FSM definition in a single pass over the given lines of the given file
+
+        The pass over the lines is measured as the parse phase, resolving the states and transitions afterwards as the
+        resolve phase.
+        """
+        self.events: EventDict = {}  # All events (including entry and exit) so that each one is created only once
+        self.dependencies = [filename]  # The .puml file and all files included by it
+
+        copyright_lines = []
+        initial_state_names = {}
+        state_parent_names = {}  # Parent state name for each state, in the order in which they appear
+        child_state_names = {}  # Names of the child states for each composite state
+        state_transitions = []  # Transitions defined inside states (internal, entry and exit)
+        transition_lines = []  # Transitions between states which can only be resolved after all states are known
+        unparsed_lines = []
+        state_stack = [None]
+
+        with timed_phase(timer, 'parse'):
+            for kind, line, m in self._tokenize_lines(lines, self.dependencies, (filename.resolve(),)):
+                if kind == _COPYRIGHT_LINE:
+                    copyright_lines.append(line.text.lstrip(" \t'"))
+
+                elif kind == _INITIAL_STATE_TRANSITION_LINE:
+                    name, trailing_text = m.groups()
+                    assert name not in initial_state_names, f'Duplicate initial transition for state {name} in {line}'
+                    assert not trailing_text, f'Additional text after initial transition in {line}: {line.orig_text}'
+                    initial_state_names[name] = line
+
+                elif kind == _CLOSING_BRACE_LINE:
+                    state_stack.pop()
+                    assert state_stack, f'Closing brace }} in {line} does not match any opening brace'
+
+                elif kind == _STATE_LINE:
+                    _, name, _, trans_txt, open_brace = m.groups()
+                    parent_name = state_stack[-1]
+                    state_parent_names.setdefault(name, parent_name)
+
+                    if parent_name:
+                        child_names = child_state_names.setdefault(parent_name, {})
+                        child_names.setdefault(name)
+
+                    if trans_txt:
+                        state_transitions.append((name, line, self._split_transition_text(line, trans_txt)))
+
+                    if open_brace:
+                        state_stack.append(name)
+
+                elif kind == _TRANSITION_LINE:
+                    transition_lines.append((line, m.groups()))
 
-        self.copyright_header = self._parse_copyright_header(lines)
-        lines = self._cleanup_lines(lines)
+                else:
+                    unparsed_lines.append(line)
+
+        self.copyright_header = '\n'.join(copyright_lines)
+        self.dependencies = list(dict.fromkeys(self.dependencies))
 
-        initial_state_names, lines = self._parse_initial_state_transitions(lines)
-        states, lines = self._parse_states(lines, initial_state_names)
-        self._check_initial_states_exist(initial_state_names, states)
-        self._check_states(states)
+        with timed_phase(timer, 'resolve'):
+            states = self._create_states(state_parent_names, child_state_names, initial_state_names)
+            self._add_state_transitions(states, state_transitions)
+            self._check_initial_states_exist(initial_state_names, states)
+            self._check_states(states)
 
-        lines = self._parse_transitions(states, lines)
+            self._add_transitions(states, transition_lines)
 
-        assert not lines, 'No idea how to parse the following lines:' + \
-            ''.join([f'\n{x}: {x.orig_text}' for x in lines])
+        assert not unparsed_lines, 'No idea how to parse the following lines:' + \
+            ''.join([f'\n{x}: {x.orig_text}' for x in unparsed_lines])
 
         return states
 
@@ -165,96 +299,98 @@ class PlantUmlStateDiagram:
     @property
     def initial_state(self) -> State:
         """Returns the initial state"""
-        state = [x for x in self.states.values() if x.is_initial_state and x.parent_state is None][0]
-        while state.child_states:
-            state = [x for x in state.child_states if x.is_initial_state][0]
-
-        return state
-
-    def _read_puml_file(self, filename: pathlib.Path) -> List[Line]:
-        """Reads the .puml file into a list of lines"""
-        with open(filename, 'r') as f:
-            content = f.read()
-
-        return [Line(filename, i + 1, x, x) for i, x in enumerate(content.split('\n'))]
-
-    def _parse_copyright_header(self, lines: List[Line]) -> str:
-        """Extracts the copyright header at the top of the file (comments starting with a single quote)"""
-        copyright_lines = itertools.takewhile(lambda x: x.text.lstrip().startswith("'"), lines)
-        copyright_header = '\n'.join([x.text.lstrip(" \t'") for x in copyright_lines])
-        return copyright_header
-
-    def _cleanup_lines(self, lines: List[Line]) -> List[Line]:
-        """Removes empty lines and uninteresting things from non-empty lines"""
-        clean_lines = []
+        state = next(x for x in self.states.values() if x.is_initial_state and x.parent_state is None)
+        return state.entry_target_state
+
+    @staticmethod
+    def _read_puml_file(filename: pathlib.Path, f: TextIO) -> Iterator[Line]:
+        """Reads the lines of the .puml file one at a time"""
+        for i, text in enumerate(f):
+            text = text.rstrip('\n')
+            yield Line(filename, i + 1, text, text)
+
+    @staticmethod
+    def _tokenize_lines(lines: Iterable[Line], dependencies: List[pathlib.Path],
+                        include_stack: Tuple[pathlib.Path, ...], in_copyright_header: bool = True) -> Iterator[Token]:
+        """Cleans up the given lines and classifies each non-empty line exactly once
+
+        The copyright header at the top of the file consists of comments starting with a single quote. Included files
+        are replaced by their tokens and appended to the dependencies. The include stack contains the resolved paths
+        of the file the lines belong to and of all files including it.
+        """
         for filename, line_no, orig_text, text in lines:
-            if any(text.startswith(x) for x in ['@', 'title ', 'hide empty ', 'note ']):
-                text = ''
-            else:
-                text = re.sub(r'#\w+', '', text)
-                text = text if "'" not in text else text[:text.index("'")]
-                text = text.strip()
+            if in_copyright_header:
+                if text.lstrip().startswith("'"):
+                    yield _COPYRIGHT_LINE, Line(filename, line_no, orig_text, text), None
+                    continue
+                in_copyright_header = False
 
-            if text:
-                clean_lines.append(Line(filename, line_no, orig_text, text))
+            if text.startswith(_IGNORED_LINE_PREFIXES):
+                continue
 
-        return clean_lines
+            text = _COLOR_RE.sub('', text)
+            text = text if "'" not in text else text[:text.index("'")]
+            text = text.strip()
+            if not text:
+                continue
 
-    def _parse_initial_state_transitions(self, lines: List[Line]) -> Tuple[Dict[str, Line], List[Line]]:
-        """Extracts the initial states and returns only the remaining lines"""
-        remaining_lines = []
-        initial_state_names = {}
+            line = Line(filename, line_no, orig_text, text)
 
-        for line in lines:
-            m = re.fullmatch(r'^\[\*\]\s+-+>\s+(\w+)\s*(.*)', line.text)
-            if not m:
-                remaining_lines.append(line)
+            m = _INCLUDE_RE.fullmatch(text)
+            if m:
+                fragment = _read_fragment(line, filename.parent / m.group(1), include_stack)
+                dependencies += fragment.dependencies
+                yield from fragment.tokens
                 continue
 
-            name, trailing_text = m.groups()
-            assert name not in initial_state_names, f'Duplicate initial transition for state {name} in {line}'
-            assert not trailing_text, f'Additional text after initial transition in {line}: {line.orig_text}'
-            initial_state_names[name] = line
-
-        return initial_state_names, remaining_lines
+            m = _INITIAL_STATE_TRANSITION_RE.fullmatch(text)
+            if m:
+                yield _INITIAL_STATE_TRANSITION_LINE, line, m
+                continue
 
-    def _parse_states(self, lines: List[Line], inital_state_names: Dict[str, Line]) -> Tuple[StateDict, List[Line]]:
-        """Extracts all states and returns only the remaining lines"""
-        remaining_lines = []
-        states = {}
-        state_stack = [None]
+            if text == '}':
+                yield _CLOSING_BRACE_LINE, line, None
+                continue
 
-        for line in lines:
-            if line.text == '}':
-                state_stack.pop()
-                assert state_stack, f'Closing brace }} in {line} does not match any opening brace'
+            m = _STATE_RE.fullmatch(text)
+            if m:
+                yield _STATE_LINE, line, m
                 continue
 
-            m = re.fullmatch(r'^(state\s+)?(\w+)\s*(:\s*(.*?)\s*)?(\{?)$', line.text)
-            if not m:
-                remaining_lines.append(line)
+            m = _TRANSITION_RE.fullmatch(text)
+            if m:
+                yield _TRANSITION_LINE, line, m
                 continue
 
-            _, name, _, trans_txt, open_brace = m.groups()
-            parent_state = state_stack[-1]
-            state = states.setdefault(name, State(name, parent_state, [], name in inital_state_names, [], [], [], []))
+            yield _UNKNOWN_LINE, line, None
 
-            if parent_state and state not in parent_state.child_states:
-                parent_state.child_states.append(state)
+    def _create_states(self, state_parent_names: Dict[str, Optional[str]],
+                       child_state_names: Dict[str, Dict[str, None]], inital_state_names: Dict[str, Line]) -> StateDict:
+        """Creates all states in the order in which they appeared, which guarantees that parents come first"""
+        states = {}
+        for name, parent_name in state_parent_names.items():
+            parent_state = states[parent_name] if parent_name else None
+            states[name] = State(name, parent_state, [], name in inital_state_names, [], [], [], [], id=len(states))
 
-            if trans_txt:
-                transition = self._parse_transition_line(line, trans_txt, state, state)
-                if transition.event.name == 'entry':
-                    state.entry_transitions.append(transition)
-                elif transition.event.name == 'exit':
-                    state.exit_transitions.append(transition)
-                else:
-                    state.int_transitions.append(transition)
+        for parent_name, child_names in child_state_names.items():
+            parent_state = states[parent_name]
+            for child_name in child_names:
+                parent_state.add_child_state(states[child_name])
 
-            if open_brace:
-                state_stack.append(state)
+        return states
 
-        return states, remaining_lines
+    def _add_state_transitions(self, states: StateDict,
+                               state_transitions: List[Tuple[str, Line, Tuple[str, str, List[str]]]]) -> None:
+        """Adds the transitions defined inside states (internal, entry and exit transitions) to the states"""
+        for name, _, trans_parts in state_transitions:
+            state = states[name]
+            transition = self._make_transition(trans_parts, state, state)
+            if transition.event.name == 'entry':
+                state.entry_transitions.append(transition)
+            elif transition.event.name == 'exit':
+                state.exit_transitions.append(transition)
+            else:
+                state.int_transitions.append(transition)
 
     def _check_initial_states_exist(self, inital_state_names: Dict[str, Line], states: StateDict) -> None:
         """Checks that every state in the list of initial state names actually exists"""
@@ -275,17 +411,9 @@ class PlantUmlStateDiagram:
             assert names, f'No initial state specified in composite state {state.name}'
             assert len(names) == 1, f'Multiple initial states specified in composite state {state.name}'
 
-    def _parse_transitions(self, states: StateDict, lines: List[Line]) -> List[Line]:
-        """Extracts all transitions and puts them into the state definitions"""
-        remaining_lines = []
-
-        for line in lines:
-            m = re.fullmatch(r'^(\w+)\s+-+>\s(\w+)\s*(:\s*(.*?)\s*)?', line.text)
-            if not m:
-                remaining_lines.append(line)
-                continue
-
-            from_state, to_state, _, trans_txt = m.groups()
+    def _add_transitions(self, states: StateDict, transition_lines: List[Tuple[Line, Tuple[str, ...]]]) -> None:
+        """Creates the transitions between states and puts them into the state definitions"""
+        for line, (from_state, to_state, _, trans_txt) in transition_lines:
             assert trans_txt, f'Missing event in transition in {line}: {line.orig_text}'
             assert from_state in states, f'State "{from_state}" in {line} has not been defined'
             assert to_state in states, f'State "{to_state}" in {line} has not been defined'
@@ -293,24 +421,85 @@ class PlantUmlStateDiagram:
             transition = self._parse_transition_line(line, trans_txt, states[from_state], states[to_state])
             states[from_state].ext_transitions.append(transition)
 
-        return remaining_lines
-
     def _parse_transition_line(self, line: Line, trans_txt: str, from_state: State, to_state: State) -> Transition:
         """Creates a transition from the text on a transition or inside a state"""
+        return self._make_transition(self._split_transition_text(line, trans_txt), from_state, to_state)
+
+    def _split_transition_text(self, line: Line, trans_txt: str) -> Tuple[str, Optional[str], List[str]]:
+        """Extracts the event name, the guard code and the action code from the text describing a transition"""
 
         # Replace \\ with \ and \n with a space
         trans_txt = '\\'.join([x.replace('\\n', ' ') for x in trans_txt.split('\\\\')])
 
         # Extract the individual parts from the line
-        m = re.fullmatch(r'^(\w+)\s*(\[\s*(.*?)\s*\]\s*)?(/(.*))?', trans_txt)
+        m = _TRANSITION_TEXT_RE.fullmatch(trans_txt)
         assert m, f'Invalid transition format in {line}: {line.orig_text}'
         event_name, _, guard_code, _, actions_txt = m.groups()
         actions_code = [] if not actions_txt else [x.strip() for x in actions_txt.split('/') if x.strip()]
 
-        # Create the transition
-        event = Event(event_name)
+        return event_name, guard_code, actions_code
+
+    def _make_transition(self, trans_parts: Tuple[str, Optional[str], List[str]], from_state: State,
+                         to_state: State) -> Transition:
+        """Creates a transition from the parts extracted from the text describing it"""
+        event_name, guard_code, actions_code = trans_parts
+
+        event = self.events.setdefault(event_name, Event(event_name))
         guard = None if not guard_code else Guard(guard_code)
         actions = [Action(x) for x in actions_code]
         transition = Transition(event, guard, from_state, to_state, actions)
 
         return transition
+
+
+def find_puml_dependencies(filename: pathlib.Path, text: Optional[str] = None) -> List[pathlib.Path]:
+    """Returns the given .puml file and all files included by it, directly or indirectly, without parsing them
+
+    If the text is given, it is used instead of the content of the .puml file. Files that cannot be read or decoded
+    are skipped, as parsing the diagram reports them anyway.
+    """
+    dependencies = [filename]
+    resolved_paths = {filename.resolve()}
+    for i, dependency in enumerate(dependencies):
+        try:
+            if i == 0 and text is not None:
+                lines = text.splitlines()
+            else:
+                with open(dependency, 'r') as f:
+                    lines = f.readlines()
+        except (OSError, ValueError):
+            continue
+
+        for text in lines:
+            text = text if "'" not in text else text[:text.index("'")]
+            m = _INCLUDE_RE.fullmatch(text.strip())
+            if m and (dependency.parent / m.group(1)).resolve() not in resolved_paths:
+                dependencies.append(dependency.parent / m.group(1))
+                resolved_paths.add(dependencies[-1].resolve())
+
+    return dependencies
+
+
+def _read_fragment(line: Line, filename: pathlib.Path, include_stack: Tuple[pathlib.Path, ...]) -> _Fragment:
+    """Returns the tokens of the file included in the given line, tokenizing the file only if it has changed"""
+    resolved_path = filename.resolve()
+    assert resolved_path not in include_stack, f'Recursive include of "{filename}" in {line}'
+    assert filename.is_file(), f'The included file "{filename}" in {line} does not exist'
+
+    signatures, fragment = _fragment_cache.get(resolved_path, ((), None))
+    if fragment is None or any(file_signature(x) != y for x, y in zip(fragment.dependencies, signatures)):
+        dependencies = [filename]
+        signature = file_signature(filename)
+        with open(filename, 'r') as f:
+            tokens = PlantUmlStateDiagram._tokenize_lines(PlantUmlStateDiagram._read_puml_file(filename, f),
+                                                          dependencies, include_stack + (resolved_path,),
+                                                          in_copyright_header=False)
+            fragment = _Fragment(tuple(tokens), tuple(dependencies))
+        signatures = (signature,) + tuple(file_signature(x) for x in fragment.dependencies[1:])
+        _fragment_cache[resolved_path] = (signatures, fragment)
+
+    # A cached fragment may include a file that is including it this time
+    recursive_includes = [x for x in fragment.dependencies if x.resolve() in include_stack]
+    assert not recursive_includes, f'Recursive include of "{recursive_includes[0]}" in {line}'
+
+    return fragment
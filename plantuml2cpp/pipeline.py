@@ -0,0 +1,307 @@
+"""
+Module for running the code generation for one or more .puml files
+"""
+
+import pathlib
+import functools
+import subprocess
+import concurrent.futures
+from typing import NamedTuple, List, Optional, Tuple, TextIO
+
+from .benchmark import generate_benchmark_driver, compile_generated_class
+from .cache import GenerationCache, make_cache_key, clang_format_fingerprint
+from .codegen import CodeGenerator, GeneratorOptions, make_core_file_path
+from .formatter import ClangFormatter
+from .parser import PlantUmlStateDiagram, find_puml_dependencies
+from .timing import PhaseTimer, timed_phase
+
+
+class GenerationJob(NamedTuple):
+    """Everything needed to generate the code for a single .puml file"""
+    puml_file: pathlib.Path
+    output_file: pathlib.Path
+    namespace: str
+    classname: str
+    noformat: bool
+    options: GeneratorOptions
+    cache_dir: Optional[pathlib.Path] = None  # Directory of the generation cache; None disables the cache
+    bench_file: Optional[pathlib.Path] = None  # Where to write the benchmark driver to; None to not generate it
+    depfile: Optional[pathlib.Path] = None  # Where to write the Make dependencies of the output to; None for nowhere
+
+
+class GenerationError(NamedTuple):
+    """Describes why the code generation for a .puml file failed"""
+    job: GenerationJob
+    message: str
+
+    def __str__(self):
+        return f'{self.job.puml_file}: {self.message}'
+
+
+class GeneratedCode(NamedTuple):
+    """Result of the code generation stage for a single job"""
+    code: Optional[str]  # None if the code generation failed
+    is_cached: bool  # True if the code has been taken from the cache and is therefore already formatted
+    error: Optional[str]
+    core_code: Optional[str] = None  # Code of the non-template core if the output is split
+    timer: Optional[PhaseTimer] = None  # Phases measured so far if the job gets timed
+
+
+def generate_code(job: GenerationJob, timer: Optional[PhaseTimer] = None) -> Tuple[str, Optional[str], bool]:
+    """Returns the code and the core code (None unless the output is split) for the given job
+
+    The code is taken from the cache (already formatted) or generated (unformatted).
+    """
+    if job.cache_dir:
+        with timed_phase(timer, 'cache_lookup'):
+            cache = GenerationCache(job.cache_dir)
+            key = make_job_cache_key(job)
+            code = cache.get(key)
+            core_code = cache.get(make_core_cache_key(key)) if job.options.split else None
+        if code is not None and (core_code is not None or not job.options.split):
+            return code, core_code, True
+
+    return generate_uncached_code(job, timer=timer) + (False,)
+
+
+def generate_uncached_code(job: GenerationJob, diagram: Optional[PlantUmlStateDiagram] = None,
+                           timer: Optional[PhaseTimer] = None) -> Tuple[str, Optional[str]]:
+    """Returns the unformatted code and core code for the given job, parsing the diagram unless it is given
+
+    If the timer is given, reading the input file, the phases of the parser and the code generation get measured.
+    """
+    if diagram is None:
+        with timed_phase(timer, 'read'):
+            text = job.puml_file.read_text()
+        diagram = PlantUmlStateDiagram(job.puml_file, text, timer)
+
+    with timed_phase(timer, 'generate'):
+        codegen = CodeGenerator(diagram, job.options)
+        code = codegen.generate(job.namespace, job.classname)
+        if job.options.split:
+            core_code = codegen.generate_core(job.namespace, job.classname, job.output_file.name)
+        else:
+            core_code = None
+
+    return code, core_code
+
+
+def generate_text(job: GenerationJob, diagram: Optional[PlantUmlStateDiagram] = None) -> Tuple[str, Optional[str]]:
+    """Returns the final code and core code for the given job without using the cache or writing any files
+
+    The diagram gets parsed from the input file unless it is given, e.g. parsed from a string or stream. The code gets
+    formatted with clang-format unless the job says otherwise, using the configuration for the output file, which
+    does not need to exist.
+    """
+    code, core_code = generate_uncached_code(job, diagram)
+    if not job.noformat:
+        formatter = ClangFormatter(job.cache_dir)
+        code = formatter.format(code, job.output_file)
+        if core_code is not None:
+            core_code = formatter.format(core_code, make_core_file_path(job.output_file))
+
+    return code, core_code
+
+
+def generate_to_stream(job: GenerationJob, stream: TextIO, diagram: Optional[PlantUmlStateDiagram] = None) -> None:
+    """Writes the final code for the given job to the given text stream instead of the output file
+
+    The diagram gets parsed from the input file unless it is given. Without formatting, the code gets written section
+    by section while it is generated.
+    """
+    assert not job.options.split, 'The code of a split output cannot be written to a stream'
+    if job.noformat:
+        diagram = diagram or PlantUmlStateDiagram(job.puml_file)
+        CodeGenerator(diagram, job.options).write_code(stream, job.namespace, job.classname)
+    else:
+        code, _ = generate_text(job, diagram)
+        stream.write(code)
+
+
+def store_in_cache(job: GenerationJob, code: str, core_code: Optional[str] = None) -> None:
+    """Stores the final code for the given job in the generation cache if the job uses one"""
+    if job.cache_dir:
+        cache = GenerationCache(job.cache_dir)
+        key = make_job_cache_key(job)
+        cache.put(key, code)
+        if core_code is not None:
+            cache.put(make_core_cache_key(key), core_code)
+
+
+def make_job_cache_key(job: GenerationJob) -> str:
+    """Returns the cache key for the given job based on the content of the input file and the files it includes and
+    all relevant options"""
+    puml_contents = []
+    for dependency in find_puml_dependencies(job.puml_file):
+        try:
+            with open(dependency, 'rb') as f:
+                puml_contents += [str(dependency).encode(), f.read()]
+        except OSError:
+            continue  # Left out of the key and reported by the parser with the location of the include
+
+    options = repr((job.namespace, job.classname, job.noformat, job.options))
+    format_config = b'' if job.noformat else clang_format_fingerprint(job.output_file)
+
+    return make_cache_key(puml_contents + [options.encode(), format_config])
+
+
+def make_core_cache_key(job_cache_key: str) -> str:
+    """Returns the cache key for the core code of a split output based on the cache key of the job"""
+    return make_cache_key([job_cache_key.encode(), b'core'])
+
+
+def write_benchmark_driver(job: GenerationJob) -> None:
+    """Writes the benchmark driver for the given job if the job asks for one"""
+    if job.bench_file:
+        code = generate_benchmark_driver(job.output_file, job.namespace, job.classname, job.options.style,
+                                         job.options.trace)
+        write_if_changed(job.bench_file, code)
+
+
+def make_depfile_path(output_file: pathlib.Path) -> pathlib.Path:
+    """Returns the path of the depfile belonging to the given generated header"""
+    return output_file.with_suffix('.d')
+
+
+def write_depfile(job: GenerationJob) -> None:
+    """Writes a Make rule with the input file and all files included by it as prerequisites if the job asks for it"""
+    if job.depfile:
+        dependencies = ' '.join(_escape_make_path(x) for x in find_puml_dependencies(job.puml_file))
+        write_if_changed(job.depfile, f'{_escape_make_path(job.output_file)}: {dependencies}\n')
+
+
+def write_core_file(job: GenerationJob, core_code: Optional[str]) -> bool:
+    """Writes the core code of a split output next to the output file; returns True if written"""
+    if core_code is None:
+        return False
+
+    return write_if_changed(make_core_file_path(job.output_file), core_code)
+
+
+def write_if_changed(filename: pathlib.Path, content: str) -> bool:
+    """Writes the content to the given file unless it already has exactly that content; returns True if written"""
+    data = content.encode()
+    try:
+        with open(filename, 'rb') as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+    return True
+
+
+def run_jobs(jobs: List[GenerationJob], num_workers: int = 1) -> List[GenerationError]:
+    """Runs the given jobs and returns all errors
+
+    The code gets generated using a pool of worker processes if there is more than one job. All code that needs
+    formatting is then passed to clang-format in one batch, using a pool of the same size.
+    """
+    errors, _ = _run_jobs(jobs, num_workers, False)
+    return errors
+
+
+def run_timed_jobs(jobs: List[GenerationJob],
+                   num_workers: int = 1) -> Tuple[List[GenerationError], List[PhaseTimer]]:
+    """Runs the given jobs like run_jobs() and returns all errors and the timer with the measured phases of each job
+
+    The code of each job gets formatted in a batch of its own, so that formatting can be measured per job. The
+    generated class of each job with a benchmark driver then gets compiled to measure its compile time.
+    """
+    return _run_jobs(jobs, num_workers, True)
+
+
+def _run_jobs(jobs: List[GenerationJob], num_workers: int,
+              is_timed: bool) -> Tuple[List[GenerationError], List[Optional[PhaseTimer]]]:
+    """Runs the given jobs, measuring their phases if requested, and returns all errors and the timers"""
+    try_generate_code = functools.partial(_try_generate_code, is_timed=is_timed)
+    if num_workers <= 1 or len(jobs) <= 1:
+        results = [try_generate_code(x) for x in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(try_generate_code, jobs))
+
+    # Format all uncached code in one go, using the format cache of the first job (they all share the same one)
+    format_idxs = [i for i, (job, res) in enumerate(zip(jobs, results))
+                   if not res.error and not res.is_cached and not job.noformat]
+    if format_idxs:
+        formatter = ClangFormatter(jobs[0].cache_dir, num_workers)
+        if is_timed:
+            for i in format_idxs:
+                with results[i].timer.phase('clang_format'):
+                    _format_code(formatter, jobs, results, [i])
+        else:
+            _format_code(formatter, jobs, results, format_idxs)
+
+    errors = []
+    for job, res in zip(jobs, results):
+        if not res.error:
+            with timed_phase(res.timer, 'write'):
+                res = _try_write_code(job, res)
+        if not res.error and is_timed and job.bench_file:
+            with res.timer.phase('compile'):
+                res = _try_compile_code(job, res)
+        if res.error:
+            errors.append(GenerationError(job, res.error))
+
+    return errors, [x.timer for x in results]
+
+
+def _try_generate_code(job: GenerationJob, is_timed: bool = False) -> GeneratedCode:
+    """Runs the code generation stage of a single job and captures any error"""
+    timer = PhaseTimer() if is_timed else None
+    try:
+        code, core_code, is_cached = generate_code(job, timer)
+        return GeneratedCode(code, is_cached, None, core_code, timer)
+    except AssertionError as e:
+        return GeneratedCode(None, False, str(e), timer=timer)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:  # ValueError includes UnicodeDecodeError
+        return GeneratedCode(None, False, f'{type(e).__name__}: {e}', timer=timer)
+
+
+def _format_code(formatter: ClangFormatter, jobs: List[GenerationJob], results: List[GeneratedCode],
+                 idxs: List[int]) -> None:
+    """Formats the code and core code of the results with the given indices in one batch, replacing the results"""
+    core_idxs = [i for i in idxs if results[i].core_code is not None]
+    format_results = formatter.format_many(
+        [(results[i].code, jobs[i].output_file) for i in idxs] +
+        [(results[i].core_code, make_core_file_path(jobs[i].output_file)) for i in core_idxs])
+    core_format_results = dict(zip(core_idxs, format_results[len(idxs):]))
+    for i, format_result in zip(idxs, format_results):
+        core_result = core_format_results.get(i)
+        error = format_result.error or (core_result.error if core_result else None)
+        results[i] = results[i]._replace(code=format_result.code, error=error,
+                                         core_code=core_result.code if core_result else None)
+
+
+def _try_write_code(job: GenerationJob, generated_code: GeneratedCode) -> GeneratedCode:
+    """Stores the code of a single job in the cache and writes it to the output file, capturing any error"""
+    try:
+        if not generated_code.is_cached:
+            store_in_cache(job, generated_code.code, generated_code.core_code)
+        write_if_changed(job.output_file, generated_code.code)
+        write_core_file(job, generated_code.core_code)
+        write_benchmark_driver(job)
+        write_depfile(job)
+    except OSError as e:
+        return GeneratedCode(None, False, f'{type(e).__name__}: {e}')
+
+    return generated_code
+
+
+def _try_compile_code(job: GenerationJob, generated_code: GeneratedCode) -> GeneratedCode:
+    """Compiles the generated class of a single job, capturing any error"""
+    try:
+        compile_generated_class(job.output_file, job.namespace, job.classname)
+    except (OSError, subprocess.CalledProcessError) as e:
+        return GeneratedCode(None, False, f'{type(e).__name__}: {e}')
+
+    return generated_code
+
+
+def _escape_make_path(path: pathlib.Path) -> str:
+    """Escapes the characters in the given path that have a special meaning in Make rules"""
+    return str(path).replace('$', '$$').replace(' ', '\\ ')
@@ -0,0 +1,139 @@
+"""
+Module for serving code generation requests from a long-lived process
+
+Build systems that generate the code for one diagram at a time would otherwise pay for starting the interpreter and
+importing the generator for every single file. The server reads one JSON request per line and answers each one with
+one JSON response line:
+
+    {"id": 1, "puml_file": "fsm.puml", "namespace": "ns", "classname": "Fsm", "output": "fsm.h"}
+    {"id": 1, "ok": true, "output": "fsm.h", "written": true}
+
+Only "puml_file" is required. If "puml_text" is given, it gets parsed instead of the file, which then only names the
+diagram. Without "output", the code is not written but returned as "code" (and "core_code" for a split output).
+All fields except "id" have to be strings; "namespace" and "classname" have to be valid C++ names. Failed and
+malformed requests are answered with "ok": false and an "error" message. The "id" is passed through unchanged.
+"""
+
+import json
+import pathlib
+import hashlib
+import subprocess
+import socketserver
+from typing import Callable, Dict, Hashable, Optional, TextIO
+
+from .benchmark import make_bench_file_path
+from .cache import file_signature
+from .codegen import is_valid_class_name, is_valid_namespace
+from .parser import PlantUmlStateDiagram, find_puml_dependencies
+from .pipeline import (GenerationJob, generate_text, write_if_changed, write_core_file, write_benchmark_driver,
+                       write_depfile, make_depfile_path)
+
+MAX_CACHED_DIAGRAMS = 256
+
+
+class GeneratorServer:
+    """Handles code generation requests, keeping the parsed diagrams in memory across requests"""
+
+    def __init__(self, make_job: Callable[[pathlib.Path], GenerationJob]):
+        """Constructs the server; make_job creates the job with the default settings for a .puml file"""
+        self.make_job = make_job
+        self._diagrams: Dict[Hashable, PlantUmlStateDiagram] = {}
+
+    def serve(self, infile: TextIO, outfile: TextIO) -> None:
+        """Answers the requests read from the given file line by line until the end of the file"""
+        for line in infile:
+            if line.strip():
+                outfile.write(self.handle_line(line) + '\n')
+                outfile.flush()
+
+    def serve_unix_socket(self, path: pathlib.Path) -> None:
+        """Answers the requests of any number of clients, one after another, connecting to the given Unix socket"""
+        server = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        self.wfile.write((server.handle_line(line.decode()) + '\n').encode())
+
+        if path.is_socket():
+            path.unlink()
+
+        try:
+            with socketserver.UnixStreamServer(str(path), RequestHandler) as socket_server:
+                socket_server.serve_forever()
+        finally:
+            if path.is_socket():
+                path.unlink()
+
+    def handle_line(self, line: str) -> str:
+        """Returns the JSON response for the given JSON request line"""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return json.dumps({'id': None, 'ok': False, 'error': f'Invalid request: {e}'})
+
+        if not isinstance(request, dict):
+            return json.dumps({'id': None, 'ok': False, 'error': 'Invalid request: not a JSON object'})
+
+        try:
+            response = self.handle_request(request)
+        except AssertionError as e:
+            response = {'ok': False, 'error': str(e)}
+        except (OSError, ValueError, RuntimeError, subprocess.CalledProcessError) as e:
+            response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+
+        return json.dumps({'id': request.get('id'), **response})
+
+    def handle_request(self, request: dict) -> dict:
+        """Generates the code for the given request and returns the response without the id"""
+        assert isinstance(request.get('puml_file'), str), 'Invalid request: puml_file is missing or not a string'
+        for key in ['puml_text', 'output', 'namespace', 'classname']:
+            assert isinstance(request.get(key, ''), str), f'Invalid request: {key} is not a string'
+        assert is_valid_namespace(request.get('namespace', '')), \
+            f'Invalid request: namespace is not a C++ namespace name: {request["namespace"]}'
+        assert is_valid_class_name(request.get('classname', 'Fsm')), \
+            f'Invalid request: classname is not a C++ identifier: {request["classname"]}'
+
+        puml_file = pathlib.Path(request['puml_file'])
+        puml_text = request.get('puml_text')
+        output_file = pathlib.Path(request['output']) if request.get('output') else None
+
+        job = self.make_job(puml_file)
+        job = job._replace(namespace=request.get('namespace', job.namespace),
+                           classname=request.get('classname', job.classname))
+        if output_file:
+            bench_file = make_bench_file_path(output_file) if job.bench_file else None
+            depfile = make_depfile_path(output_file) if job.depfile else None
+            job = job._replace(output_file=output_file, bench_file=bench_file, depfile=depfile)
+
+        code, core_code = generate_text(job, self._get_diagram(puml_file, puml_text))
+        if not output_file:
+            response = {'ok': True, 'code': code}
+            if core_code is not None:
+                response['core_code'] = core_code
+            return response
+
+        write_benchmark_driver(job)
+        write_depfile(job)
+        is_written = write_core_file(job, core_code)
+        is_written = write_if_changed(job.output_file, code) or is_written
+        return {'ok': True, 'output': str(output_file), 'written': is_written}
+
+    def _get_diagram(self, puml_file: pathlib.Path, puml_text: Optional[str]) -> PlantUmlStateDiagram:
+        """Returns the parsed diagram, which only gets parsed again if the file, the text or an included file changed"""
+        included_files = find_puml_dependencies(puml_file, puml_text)[1:]
+        if puml_text is None:
+            key = (str(puml_file.resolve()), file_signature(puml_file))
+        else:
+            key = (str(puml_file), hashlib.sha256(puml_text.encode()).hexdigest())
+        key += tuple((str(x.resolve()), file_signature(x)) for x in included_files)
+
+        diagram = self._diagrams.pop(key, None) or PlantUmlStateDiagram(puml_file, puml_text)
+
+        # Keep the most recently used diagrams, dropping the least recently used one if there are too many
+        self._diagrams[key] = diagram
+        if len(self._diagrams) > MAX_CACHED_DIAGRAMS:
+            del self._diagrams[next(iter(self._diagrams))]
+
+        return diagram
@@ -0,0 +1,78 @@
+"""
+Module for measuring the time and memory spent in the phases of the code generation
+"""
+
+import os
+import time
+import cProfile
+import pathlib
+import contextlib
+import tracemalloc
+from typing import NamedTuple, ContextManager, Dict, Iterator, Optional
+
+
+class PhaseStats(NamedTuple):
+    """Resources used by a phase; times are in seconds"""
+    wall_time: float
+    cpu_time: float  # CPU time of this process and of the child processes that terminated during the phase
+    peak_memory_bytes: int  # Peak memory allocated by Python during the phase
+
+
+class PhaseTimer:
+    """Collects the resources used by named phases, adding up the times if a phase runs several times
+
+    Memory allocations are traced while a phase runs, which slows it down somewhat. Phases must not be nested.
+    """
+
+    def __init__(self):
+        """Constructs the timer without any measured phases"""
+        self.phases: Dict[str, PhaseStats] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Measures the code run in the context as (another run of) the phase with the given name"""
+        is_tracing = tracemalloc.is_tracing()
+        if not is_tracing:
+            tracemalloc.start()
+        start_cpu_time = _cpu_time()
+        start_wall_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start_wall_time
+            cpu_time = _cpu_time() - start_cpu_time
+            _, peak_memory = tracemalloc.get_traced_memory()
+            if not is_tracing:
+                tracemalloc.stop()
+
+            prev = self.phases.get(name, PhaseStats(0.0, 0.0, 0))
+            self.phases[name] = PhaseStats(prev.wall_time + wall_time, prev.cpu_time + cpu_time,
+                                           max(prev.peak_memory_bytes, peak_memory))
+
+    def to_json(self) -> dict:
+        """Returns the stats of all phases in the order in which they first ran as a JSON serializable dict"""
+        return {name: dict(stats._asdict()) for name, stats in self.phases.items()}
+
+
+def timed_phase(timer: Optional[PhaseTimer], name: str) -> ContextManager[None]:
+    """Returns the context measuring the phase with the given name if a timer is given and doing nothing otherwise"""
+    return timer.phase(name) if timer else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def profiled(stats_file: pathlib.Path) -> Iterator[cProfile.Profile]:
+    """Profiles the code run in the context and then writes the profile to the given file for loading with pstats"""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(str(stats_file))
+
+
+def _cpu_time() -> float:
+    """Returns the CPU time used by this process and its terminated child processes, like clang-format"""
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
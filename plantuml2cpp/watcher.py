@@ -0,0 +1,88 @@
+"""
+Module for regenerating the code whenever one of the input files changes
+"""
+
+import sys
+import time
+import pathlib
+import subprocess
+from typing import Dict, List, Optional, Tuple
+
+from .cache import file_signature
+from .codegen import make_core_file_path
+from .formatter import ClangFormatter
+from .parser import find_puml_dependencies
+from .pipeline import (GenerationJob, GenerationError, generate_uncached_code, write_if_changed, write_core_file,
+                       write_benchmark_driver, write_depfile)
+
+POLL_INTERVAL = 0.2  # Seconds between two checks of the input files
+
+
+class FileWatcher:
+    """Polls the input files and the files they include and regenerates the code for the changed ones
+
+    Files are considered changed if their modification time or size has changed. The included files of each input file
+    are only looked up again once one of its known files has changed. The unformatted code of each file is kept in
+    memory, so changes that do not affect the generated code, like comments or whitespace, neither get
+    formatted nor written.
+    """
+
+    def __init__(self, jobs: List[GenerationJob]):
+        """Constructs the watcher for the input files of the given jobs"""
+        self.jobs = jobs
+        self._signatures: Dict[pathlib.Path, List[Tuple[pathlib.Path, Optional[Tuple[int, int]]]]] = {}
+        self._codes: Dict[pathlib.Path, Tuple[str, Optional[str]]] = {}  # Unformatted code and core per output file
+
+    def run(self, poll_interval: float = POLL_INTERVAL) -> None:
+        """Regenerates the code for the changed files until interrupted, reporting each generated file or error"""
+        while True:
+            for output_file, error in self.poll():
+                if error:
+                    print(error, file=sys.stderr, flush=True)
+                else:
+                    print(f'Generated {output_file}', flush=True)
+
+            time.sleep(poll_interval)
+
+    def poll(self) -> List[Tuple[pathlib.Path, Optional[GenerationError]]]:
+        """Regenerates the code for all files changed since the last poll
+
+        Returns the output file and the error, if any, for each regenerated file whose code has changed or failed.
+        """
+        results = []
+        for job in self.jobs:
+            if job.puml_file in self._signatures and all(file_signature(x) == signature
+                                                          for x, signature in self._signatures[job.puml_file]):
+                continue
+
+            self._signatures[job.puml_file] = [(x, file_signature(x)) for x in find_puml_dependencies(job.puml_file)]
+            try:
+                if self._regenerate(job):
+                    results.append((job.output_file, None))
+            except AssertionError as e:
+                results.append((job.output_file, GenerationError(job, str(e))))
+            except (OSError, ValueError, RuntimeError, subprocess.CalledProcessError) as e:
+                results.append((job.output_file, GenerationError(job, f'{type(e).__name__}: {e}')))
+
+        return results
+
+    def _regenerate(self, job: GenerationJob) -> bool:
+        """Generates the code for the given job and writes it unless it is unchanged; returns True if written"""
+        code, core_code = generate_uncached_code(job)
+        write_depfile(job)
+        if self._codes.get(job.output_file) == (code, core_code):
+            return False
+
+        formatted_code, formatted_core_code = code, core_code
+        if not job.noformat:
+            formatter = ClangFormatter(job.cache_dir)
+            formatted_code = formatter.format(code, job.output_file)
+            if core_code is not None:
+                formatted_core_code = formatter.format(core_code, make_core_file_path(job.output_file))
+
+        write_benchmark_driver(job)
+        write_core_file(job, formatted_core_code)
+        write_if_changed(job.output_file, formatted_code)
+        self._codes[job.output_file] = (code, core_code)
+
+        return True
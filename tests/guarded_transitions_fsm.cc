@@ -0,0 +1,40 @@
+#include <stdio.h>
+
+static int level = 0;
+
+#include "out/guarded_transitions_fsm.h"
+
+int main(int argc, char *argv[])
+{
+    typedef GuardedTransitionsFsm<>::Event Event;
+    GuardedTransitionsFsm<> fsm;
+
+    fsm.init();
+    printf("--- Posting Accelerate with level 0...\n");
+    fsm.post_event(Event::Accelerate);
+    level = 1;
+    printf("--- Posting Accelerate with level 1...\n");
+    fsm.post_event(Event::Accelerate);
+    level = 2;
+    printf("--- Posting Accelerate with level 2...\n");
+    fsm.post_event(Event::Accelerate);
+    printf("--- Posting Brake with level 2...\n");
+    fsm.post_event(Event::Brake);
+    printf("--- Posting Brake with level 2...\n");
+    fsm.post_event(Event::Brake);
+    level = -1;
+    printf("--- Posting Start with level -1...\n");
+    fsm.post_event(Event::Start);
+    printf("--- Posting Accelerate with level -1...\n");
+    fsm.post_event(Event::Accelerate);
+    printf("--- Posting Start with level -1...\n");
+    fsm.post_event(Event::Start);
+    level = 1;
+    printf("--- Posting Start with level 1...\n");
+    fsm.post_event(Event::Start);
+    level = -1;
+    printf("--- Posting Brake with level -1...\n");
+    fsm.post_event(Event::Brake);
+
+    return 0;
+}
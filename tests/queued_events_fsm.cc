@@ -0,0 +1,56 @@
+#include <stdio.h>
+
+#include <thread>
+
+#include "out/queued_events_fsm.h"
+
+struct Base {
+    int ticks = 0;
+};
+
+int main(int argc, char *argv[])
+{
+    typedef QueuedEventsFsm<Base>::Event Event;
+    QueuedEventsFsm<Base> fsm;
+
+    fsm.init();
+    printf("--- Posting Start...\n");
+    fsm.post_event(Event::Start);
+    printf("--- Posting Stop, Start...\n");
+    const Event events[] = {Event::Stop, Event::Start};
+    fsm.post_events(events, 2);
+
+    printf("--- Pushing Stop...\n");
+    fsm.push_event(Event::Stop);
+    printf("--- Processing events...\n");
+    printf("--- Processed %d event(s)\n", static_cast<int>(fsm.process_events()));
+
+    int num_pushed = 0;
+    while (fsm.push_event(Event::Start)) {
+        ++num_pushed;
+    }
+    printf("--- Pushed %d events before the queue was full\n", num_pushed);
+    printf("--- Processed %d event(s)\n", static_cast<int>(fsm.process_events()));
+
+    // Hand over events from another thread while processing them
+    const int kNumTicks = 10000;
+    std::thread producer([&fsm] {
+        for (int i = 0; i < kNumTicks; ++i) {
+            while (!fsm.push_event(Event::Tick)) {
+                std::this_thread::yield();
+            }
+        }
+    });
+
+    fsm.ticks = 0;
+    while (fsm.ticks < kNumTicks) {
+        if (fsm.process_events() == 0) {
+            std::this_thread::yield();
+        }
+    }
+
+    producer.join();
+    printf("--- Counted %d ticks\n", fsm.ticks);
+
+    return 0;
+}
@@ -1,11 +1,26 @@
+import io
+import os
+import json
+import pstats
 import unittest
+import unittest.mock
 import subprocess
 import pathlib
 import sys
 import shutil
 import textwrap
+import time
 from typing import List, Union
 
+import plantuml2cpp.parser
+import plantuml2cpp.watcher
+from plantuml2cpp.cache import GenerationCache
+from plantuml2cpp.codegen import CodeGenerator, GeneratorOptions
+from plantuml2cpp.emitter import CodeStyle
+from plantuml2cpp.parser import PlantUmlStateDiagram
+from plantuml2cpp.pipeline import GenerationJob, generate_text, generate_to_stream
+from plantuml2cpp.watcher import FileWatcher
+
 
 class TestMain(unittest.TestCase):
     def __init__(self, *args, **kwargs):
@@ -18,6 +33,12 @@ class TestMain(unittest.TestCase):
         shutil.rmtree(self.out_dir, ignore_errors=True)
         self.out_dir.mkdir(exist_ok=True)
 
+    def setUp(self):
+        # Keep the default cache of all commands run by the tests out of the home directory
+        environ_patcher = unittest.mock.patch.dict(os.environ, XDG_CACHE_HOME=str(self.out_dir / 'xdg_cache'))
+        environ_patcher.start()
+        self.addCleanup(environ_patcher.stop)
+
     def run_command(self, *args, **kwargs) -> str:
         """Runs an external command and returns the output captured from stdout"""
         res = subprocess.run(*args, **kwargs, capture_output=True)
@@ -35,17 +56,20 @@ class TestMain(unittest.TestCase):
     def run_main(self, *args: List[Union[str, pathlib.Path]]):
         """Runs the plantuml2cpp main script"""
         cwd = pathlib.Path(__file__).parent.parent
-        self.run_command([sys.executable, '-m', 'plantuml2cpp'] + list(args), cwd=cwd)
+        has_cache_args = '--cache-dir' in args or '--no-cache' in args
+        cache_args = [] if has_cache_args else ['--cache-dir', self.out_dir / 'default_cache']
+        self.run_command([sys.executable, '-m', 'plantuml2cpp', *cache_args, *args], cwd=cwd)
 
-    def compile(self, cc_file: str):
-        """Compiles the given source file"""
+    def compile(self, cc_file: str, *other_cc_files: List[pathlib.Path]):
+        """Compiles the given source file, linking it with any other given source files"""
         out_file = (self.out_dir / cc_file).with_suffix('')
-        self.run_command(['clang', '-std=c++11', '-Werror', '-Wall', self.tests_dir / cc_file, '-o', out_file])
+        self.run_command(['clang', '-std=c++11', '-Werror', '-Wall', self.tests_dir / cc_file, *other_cc_files, '-o',
+                          out_file])
 
-    def run_main_compile_and_run_executable(self, puml_file: str) -> str:
+    def run_main_compile_and_run_executable(self, puml_file: str, *args: List[str]) -> str:
         """Runs the plantuml2cpp main script, compiles the generated code, runs the created
         executable and returns the output captured from stdout"""
-        self.run_main(self.tests_dir / puml_file, self.out_dir)
+        self.run_main(self.tests_dir / puml_file, self.out_dir, *args)
         self.compile(pathlib.Path(puml_file).with_suffix('.cc'))
         return self.run_compiled_executable(pathlib.Path(puml_file).with_suffix(''))
 
@@ -143,6 +167,900 @@ class TestMain(unittest.TestCase):
             Entered Napping
         ''').lstrip())
 
+    def test_guarded_transitions(self):
+        """Verifies that guarded transitions are prioritized correctly in every dispatch mode"""
+        for dispatch in ['scan', 'flat']:
+            with self.subTest(dispatch=dispatch):
+                output = self.run_main_compile_and_run_executable('guarded_transitions_fsm.puml',
+                                                                  '--dispatch', dispatch)
+                self.assertEqual(output, textwrap.dedent('''
+                    Entered Running
+                    Entered Slow
+                    --- Posting Accelerate with level 0...
+                    --- Posting Accelerate with level 1...
+                    Trans Accelerate (internal)
+                    --- Posting Accelerate with level 2...
+                    Left Slow
+                    Trans Accelerate
+                    Entered Fast
+                    --- Posting Brake with level 2...
+                    Left Fast
+                    Trans Brake
+                    Entered Slow
+                    --- Posting Brake with level 2...
+                    Trans Brake (internal)
+                    --- Posting Start with level -1...
+                    --- Posting Accelerate with level -1...
+                    Left Slow
+                    Left Running
+                    Trans Accelerate (stall)
+                    Entered Stopped
+                    --- Posting Start with level -1...
+                    --- Posting Start with level 1...
+                    Left Stopped
+                    Trans Start
+                    Entered Running
+                    Entered Slow
+                    --- Posting Brake with level -1...
+                    Trans Brake (internal)
+                ''').lstrip())
+
+    def test_flat_dispatch(self):
+        """Verifies that the flattened dispatch table finds inherited transitions in a deep hierarchy"""
+        output = self.run_main_compile_and_run_executable('deep_hierarchy_fsm.puml', '--dispatch', 'flat')
+        self.assertEqual(output, self.run_main_compile_and_run_executable('deep_hierarchy_fsm.puml'))
+
+    def test_strategies(self):
+        """Verifies that all code generation strategies execute the same actions in the same order"""
+        # The queued events FSM requires a queue and gets tested with all strategies in test_queued_events()
+        for puml_file in sorted(x for x in self.tests_dir.glob('*.puml') if x.name != 'queued_events_fsm.puml'):
+            expected_output = self.run_main_compile_and_run_executable(puml_file.name)
+            for strategy in ['switch', 'functions', 'events']:
+                with self.subTest(puml_file=puml_file.name, strategy=strategy):
+                    output = self.run_main_compile_and_run_executable(puml_file.name, '--strategy', strategy)
+                    self.assertEqual(output, expected_output)
+
+    def test_event_methods(self):
+        """Verifies that the on_<Event>() methods of the events strategy can be called instead of posting the events"""
+        with open(self.out_dir / 'event_methods_fsm.cc', 'w') as f:
+            f.write(textwrap.dedent('''
+                #include <stdio.h>
+
+                #include "simple_fsm.h"
+
+                int main() {
+                    SimpleFsm<> fsm;
+
+                    fsm.init();
+                    printf("--- Calling on_JobDone()...\\n");
+                    fsm.on_JobDone();
+                    printf("--- Calling on_JobReceived()...\\n");
+                    fsm.on_JobReceived();
+                    printf("--- Calling on_JobDone()...\\n");
+                    fsm.on_JobDone();
+                    return 0;
+                }
+            '''))
+
+        for args in [[], ['--queue', 'rtc']]:
+            with self.subTest(args=args):
+                self.run_main(self.tests_dir / 'simple_fsm.puml', self.out_dir, '--strategy', 'events', *args)
+
+                executable = self.out_dir / 'event_methods_fsm'
+                self.run_command(['clang++', '-std=c++11', '-Werror', '-Wall', self.out_dir / 'event_methods_fsm.cc',
+                                  '-o', executable])
+
+                output = self.run_command([executable])
+                self.assertEqual(output, textwrap.dedent('''
+                    Entered Idle
+                    --- Calling on_JobDone()...
+                    --- Calling on_JobReceived()...
+                    Left Idle
+                    Job received
+                    Entered Working
+                    --- Calling on_JobDone()...
+                    Left Working
+                    Job done
+                    Entered Idle
+                ''').lstrip())
+
+    def test_split(self):
+        """Verifies that the split output with the non-template core executes the same actions in the same order"""
+        for puml_file in sorted(x for x in self.tests_dir.glob('*.puml') if x.name != 'queued_events_fsm.puml'):
+            expected_output = self.run_main_compile_and_run_executable(puml_file.name)
+            for dispatch in ['scan', 'flat']:
+                with self.subTest(puml_file=puml_file.name, dispatch=dispatch):
+                    self.run_main(puml_file, self.out_dir, '--split', '--dispatch', dispatch)
+                    core_file = self.out_dir / f'{puml_file.stem}_core.cc'
+                    self.compile(puml_file.with_suffix('.cc').name, core_file)
+                    output = self.run_compiled_executable(puml_file.stem)
+                    self.assertEqual(output, expected_output)
+
+    def test_queued_events(self):
+        """Verifies that events posted by actions or pushed from another thread get processed one after another"""
+        for args in [['--strategy', 'table'], ['--strategy', 'switch'], ['--strategy', 'functions'],
+                     ['--strategy', 'events'], ['--split']]:
+            with self.subTest(args=args):
+                self.run_main(self.tests_dir / 'queued_events_fsm.puml', self.out_dir, '--queue', 'spsc',
+                              '--queue-capacity', '8', *args)
+
+                executable = self.out_dir / 'queued_events_fsm'
+                core_files = [self.out_dir / 'queued_events_fsm_core.cc'] if '--split' in args else []
+                self.run_command(['clang++', '-std=c++11', '-Werror', '-Wall', '-pthread',
+                                  self.tests_dir / 'queued_events_fsm.cc', *core_files, '-o', executable])
+
+                output = self.run_command([executable])
+                self.assertEqual(output, textwrap.dedent('''
+                    Entered Idle
+                    --- Posting Start...
+                    Left Idle
+                    Start
+                    Posted Load
+                    Entered Loading
+                    Left Loading
+                    Load
+                    Entered Running
+                    --- Posting Stop, Start...
+                    Left Running
+                    Stop
+                    Entered Idle
+                    Left Idle
+                    Start
+                    Posted Load
+                    Entered Loading
+                    Left Loading
+                    Load
+                    Entered Running
+                    --- Pushing Stop...
+                    --- Processing events...
+                    Left Running
+                    Stop
+                    Entered Idle
+                    --- Processed 1 event(s)
+                    --- Pushed 8 events before the queue was full
+                    Left Idle
+                    Start
+                    Posted Load
+                    Entered Loading
+                    Left Loading
+                    Load
+                    Entered Running
+                    --- Processed 8 event(s)
+                    --- Counted 10000 ticks
+                ''').lstrip())
+
+    def test_trace_and_counters(self):
+        """Verifies that all strategies call the trace hooks and count the transitions in the same way"""
+        with open(self.out_dir / 'traced_fsm.cc', 'w') as f:
+            f.write(textwrap.dedent('''
+                #include <stdio.h>
+
+                static int level = 0;
+
+                struct Tracer {
+                    template <typename Event>
+                    void on_event_dropped(Event event) { printf("Dropped event %d\\n", static_cast<int>(event)); }
+                    void on_transition(int idx) { printf("Transition %d\\n", idx); }
+                    void on_guard_rejected(int idx) { printf("Guard of transition %d rejected\\n", idx); }
+                };
+
+                #include "guarded_transitions_fsm.h"
+
+                int main(int argc, char *argv[])
+                {
+                    typedef GuardedTransitionsFsm<Tracer> Fsm;
+                    Fsm fsm;
+
+                    fsm.init();
+                    const int levels[] = {0, 1, 2, 2, 2, -1, -1, -1, 1, -1};
+                    const Fsm::Event events[] = {Fsm::Event::Accelerate, Fsm::Event::Accelerate, Fsm::Event::Accelerate,
+                                                 Fsm::Event::Brake, Fsm::Event::Brake, Fsm::Event::Start,
+                                                 Fsm::Event::Accelerate, Fsm::Event::Start, Fsm::Event::Start,
+                                                 Fsm::Event::Brake};
+                    for (int i = 0; i < 10; ++i) {
+                        level = levels[i];
+                        fsm.post_event(events[i]);
+                    }
+
+                    fsm.dump_counters(stdout);
+                    return 0;
+                }
+            '''))
+
+        expected_output = None
+        for args in [['--strategy', 'table'], ['--dispatch', 'flat'], ['--strategy', 'switch'],
+                     ['--strategy', 'functions'], ['--strategy', 'events'], ['--split'],
+                     ['--split', '--dispatch', 'flat']]:
+            with self.subTest(args=args):
+                self.run_main(self.tests_dir / 'guarded_transitions_fsm.puml', self.out_dir, '--trace', '--counters',
+                              *args)
+                core_files = [self.out_dir / 'guarded_transitions_fsm_core.cc'] if '--split' in args else []
+                self.compile(self.out_dir / 'traced_fsm.cc', *core_files)
+                output = self.run_compiled_executable('traced_fsm')
+
+                expected_output = expected_output or output
+                self.assertEqual(output, expected_output)
+
+        lines = expected_output.split('\n')
+        self.assertEqual(lines[:4], ['Entered Running', 'Entered Slow', 'Guard of transition 1 rejected',
+                                     'Guard of transition 2 rejected'])
+        self.assertIn('Transition 2', lines)
+        self.assertIn('Dropped event 3', lines)
+        self.assertIn('transition Slow --- Accelerate [level > 1] --> Fast: 1', lines)
+        self.assertIn('transition Running --- Brake --> Running: 2', lines)
+        self.assertIn('state Slow: 3', lines)
+        self.assertIn('dropped Start: 2', lines)
+
+    def test_bank(self):
+        """Verifies that the instances of a bank have their own states but share the actions and guards"""
+        with open(self.out_dir / 'bank_fsm.puml', 'w') as f:
+            f.write(textwrap.dedent('''
+                @startuml
+                [*] --> Idle
+                Idle : entry / printf("%d: Entered Idle\\\\n", static_cast<int>(current_instance()))
+                Working : entry / printf("%d: Entered Working\\\\n", static_cast<int>(current_instance()))
+                Idle --> Working : JobReceived
+                Working --> Idle : JobDone [current_instance() != 1]
+                @enduml
+            '''))
+
+        with open(self.out_dir / 'bank_fsm.cc', 'w') as f:
+            f.write(textwrap.dedent('''
+                #include <stdio.h>
+
+                #include "bank_fsm.h"
+
+                int main(int argc, char *argv[])
+                {
+                    typedef BankFsmBank<>::Event Event;
+                    static_assert(BankFsmBank<>::kNumStates == 2, "The constants are shared by all instances");
+                    BankFsmBank<> bank(3);
+
+                    bank.init();
+                    printf("--- Posting JobReceived to 1...\\n");
+                    bank.post_event(1, Event::JobReceived);
+                    printf("--- Posting JobReceived to 0 and 2...\\n");
+                    const size_t ids[] = {0, 2};
+                    const Event events[] = {Event::JobReceived, Event::JobReceived};
+                    bank.post_events(ids, events, 2);
+                    printf("--- Broadcasting JobDone...\\n");
+                    bank.broadcast(Event::JobDone);
+
+                    for (size_t i = 0; i < bank.size(); ++i) {
+                        printf("%d: %s\\n", static_cast<int>(i), BankFsmBank<>::to_string(bank.current_state(i)));
+                    }
+
+                    return 0;
+                }
+            '''))
+
+        for args in [['--strategy', 'table'], ['--strategy', 'switch'], ['--strategy', 'functions'],
+                     ['--strategy', 'events'], ['--split']]:
+            with self.subTest(args=args):
+                self.run_main(self.out_dir / 'bank_fsm.puml', self.out_dir, '--bank', *args)
+
+                executable = self.out_dir / 'bank_fsm'
+                core_files = [self.out_dir / 'bank_fsm_core.cc'] if '--split' in args else []
+                self.run_command(['clang++', '-std=c++11', '-Werror', '-Wall', self.out_dir / 'bank_fsm.cc',
+                                  *core_files, '-o', executable])
+
+                output = self.run_command([executable])
+                self.assertEqual(output, textwrap.dedent('''
+                    0: Entered Idle
+                    1: Entered Idle
+                    2: Entered Idle
+                    --- Posting JobReceived to 1...
+                    1: Entered Working
+                    --- Posting JobReceived to 0 and 2...
+                    0: Entered Working
+                    2: Entered Working
+                    --- Broadcasting JobDone...
+                    0: Entered Idle
+                    2: Entered Idle
+                    0: Idle
+                    1: Working
+                    2: Idle
+                ''').lstrip())
+
+        # The members of the state machine that depend on the current instance are not accessible through the bank
+        self.run_main(self.out_dir / 'bank_fsm.puml', self.out_dir, '--bank', '--strategy', 'events')
+        for call in ['bank.on_JobReceived()', 'bank.post_event(Event::JobReceived)', 'bank.current_state()',
+                     'bank.current_instance()']:
+            with self.subTest(call=call):
+                with open(self.out_dir / 'bank_misuse.cc', 'w') as f:
+                    f.write(textwrap.dedent(f'''
+                        #include <stdio.h>
+
+                        #include "bank_fsm.h"
+
+                        typedef BankFsmBank<>::Event Event;
+
+                        void post_to_bank(BankFsmBank<>& bank) {{
+                            {call};
+                        }}
+                    '''))
+
+                res = subprocess.run(['clang++', '-std=c++11', '-fsyntax-only', self.out_dir / 'bank_misuse.cc'],
+                                     capture_output=True)
+                self.assertNotEqual(res.returncode, 0)
+                self.assertIn(call.split('.')[1].split('(')[0], res.stderr.decode())
+
+    def test_analyze_and_prune(self):
+        """Verifies that the analysis finds dead states and transitions and that pruning them keeps the behavior"""
+        with open(self.out_dir / 'dead_code_fsm.puml', 'w') as f:
+            f.write(textwrap.dedent('''
+                @startuml
+                [*] --> Idle
+                Idle : entry / printf("Entered Idle\\\\n")
+                Working : entry / printf("Entered Working\\\\n")
+                Orphan : entry / printf("Entered Orphan\\\\n")
+                Idle --> Working : Start
+                Idle --> Idle : Start
+                Working --> Idle : Stop [level > 1]
+                Working --> Working : Stop [level > 1]
+                Orphan --> Idle : Reset
+                @enduml
+            '''))
+
+        with open(self.out_dir / 'dead_code_fsm.cc', 'w') as f:
+            f.write(textwrap.dedent('''
+                #include <stdio.h>
+
+                static int level = 0;
+
+                #include "dead_code_fsm.h"
+
+                int main(int argc, char *argv[])
+                {
+                    typedef DeadCodeFsm<>::Event Event;
+                    DeadCodeFsm<> fsm;
+
+                    fsm.init();
+                    const int levels[] = {0, 0, 0, 2, 0};
+                    const Event events[] = {Event::Reset, Event::Start, Event::Stop, Event::Stop, Event::Start};
+                    for (int i = 0; i < 5; ++i) {
+                        level = levels[i];
+                        fsm.post_event(events[i]);
+                    }
+
+                    return 0;
+                }
+            '''))
+
+        cwd = pathlib.Path(__file__).parent.parent
+        output = self.run_command([sys.executable, '-m', 'plantuml2cpp', '--analyze',
+                                   self.out_dir / 'dead_code_fsm.puml'], cwd=cwd)
+        self.assertEqual(json.loads(output), {
+            'puml_file': str(self.out_dir / 'dead_code_fsm.puml'),
+            'unreachable_states': ['Orphan'],
+            'unhandled_events': ['Reset'],
+            'shadowed_transitions': ['Idle --- Start --> Idle'],
+            'duplicate_guards': ['Working --- Stop [level > 1] --> Working'],
+        })
+
+        expected_output = None
+        for args in [['--strategy', 'table'], ['--dispatch', 'flat'], ['--split'], ['--strategy', 'switch'],
+                     ['--strategy', 'functions'], ['--strategy', 'events']]:
+            with self.subTest(args=args):
+                outputs = []
+                for prune_args in [[], ['--prune']]:
+                    self.run_main(self.out_dir / 'dead_code_fsm.puml', self.out_dir, *args, *prune_args)
+                    core_files = [self.out_dir / 'dead_code_fsm_core.cc'] if '--split' in args else []
+                    self.compile(self.out_dir / 'dead_code_fsm.cc', *core_files)
+                    outputs.append(self.run_compiled_executable('dead_code_fsm'))
+
+                self.assertIn('kNumTransitions = 3,', (self.out_dir / 'dead_code_fsm.h').read_text())
+                self.assertEqual(outputs[1], outputs[0])
+                expected_output = expected_output or outputs[0]
+                self.assertEqual(outputs[0], expected_output)
+
+        self.assertEqual(expected_output, 'Entered Idle\nEntered Working\nEntered Idle\nEntered Working\n')
+
+    def test_many_states(self):
+        """Verifies that the enums and tables get integer types that are large enough for the number of states"""
+        num_states = 300
+        with open(self.out_dir / 'many_states_fsm.puml', 'w') as f:
+            f.write('@startuml\n[*] --> State0\n')
+            f.write(''.join(f'state State{i}\n' for i in range(num_states)))
+            f.write(''.join(f'State{i} --> State{(i + 1) % num_states} : Next\n' for i in range(num_states)))
+
+        with open(self.out_dir / 'many_states_fsm.cc', 'w') as f:
+            f.write(textwrap.dedent('''
+                #include <stdio.h>
+
+                #include "many_states_fsm.h"
+
+                int main(int argc, char *argv[])
+                {
+                    ManyStatesFsm<> fsm;
+                    fsm.init();
+                    for (int i = 0; i < 298; ++i) {
+                        fsm.post_event(ManyStatesFsm<>::Event::Next);
+                    }
+
+                    printf("%s\\n", ManyStatesFsm<>::to_string(fsm.current_state()));
+                    return 0;
+                }
+            '''))
+
+        for optimize, state_type in [('size', 'unsigned short'), ('speed', 'unsigned int')]:
+            with self.subTest(optimize=optimize):
+                self.run_main(self.out_dir / 'many_states_fsm.puml', self.out_dir, '--optimize', optimize)
+                with open(self.out_dir / 'many_states_fsm.h') as f:
+                    self.assertIn(f'enum class State : {state_type} {{', f.read())
+
+                self.compile(self.out_dir / 'many_states_fsm.cc')
+                self.assertEqual(self.run_compiled_executable('many_states_fsm'), 'State298\n')
+
+    def test_native_layout(self):
+        """Verifies that unformatted code is laid out according to the style options and still works"""
+        args = ['--noformat', '--no-cache', '--brace-style', 'allman', '--indent-width', '2', '--column-limit', '80']
+        output = self.run_main_compile_and_run_executable('deep_hierarchy_fsm.puml', *args)
+        with open(self.out_dir / 'deep_hierarchy_fsm.h') as f:
+            lines = f.read().split('\n')
+
+        self.assertIn('class DeepHierarchyFsm : public T', lines)
+        self.assertIn('  void init();', lines)
+        self.assertIn('  switch (transition_idx)', lines)
+        self.assertIn('  {', lines)
+
+        # Lists like the enum members get wrapped; the rows of the transition table stay aligned on one line each
+        self.assertTrue(all(len(x) <= 80 for x in lines if x.endswith(',') and '{' not in x))
+        self.assertIn('    {Event::Glitch,              State::BlackAndWhite, State::BlackAndWhite },', lines)
+
+        # Only code that gets formatted needs to protect the aligned lines from clang-format
+        self.assertFalse(any('clang-format' in x for x in lines))
+
+        self.assertEqual(output, self.run_main_compile_and_run_executable('deep_hierarchy_fsm.puml'))
+        with open(self.out_dir / 'deep_hierarchy_fsm.h') as f:
+            self.assertIn('/* clang-format off */', f.read())
+
+    def test_emit_bench(self):
+        """Verifies that the generated benchmark driver replays recorded event sequences and reports the results"""
+        self.run_main(self.tests_dir / 'simple_fsm.puml', self.out_dir, '--emit-bench')
+
+        executable = self.out_dir / 'simple_fsm_bench'
+        self.run_command(['clang++', '-std=c++11', '-Werror', '-Wall', self.out_dir / 'simple_fsm_bench.cc', '-o',
+                          executable])
+
+        events_file = self.out_dir / 'events.txt'
+        events_file.write_text('JobReceived\nJobReceived\nJobDone\nJobDone\nJobReceived\n')
+        output = self.run_command([executable, '--replay', events_file, '--repeat', '2'])
+
+        results = json.loads(output.splitlines()[-1])
+        self.assertEqual(results['events'], 5)
+        self.assertEqual(results['repeat'], 2)
+        self.assertEqual(results['state_changes'], 3)
+        self.assertIsNone(results['transitions'])  # Cannot be counted without the trace hooks
+        self.assertEqual(results['final_state'], 'Working')
+        self.assertGreater(results['ns_per_event'], 0)
+
+        # With the trace hooks, self transitions get counted as well, and the compile time gets measured
+        cwd = pathlib.Path(__file__).parent.parent
+        with unittest.mock.patch.dict(os.environ, CXX='clang++', CXXFLAGS='-Werror -Wall'):
+            output = self.run_command([sys.executable, '-m', 'plantuml2cpp', '--emit-bench', '--trace', '--timings',
+                                       '--no-cache', self.tests_dir / 'self_transition_fsm.puml', self.out_dir],
+                                      cwd=cwd)
+        [timings] = [json.loads(x) for x in output.splitlines()]
+        self.assertEqual(list(timings['phases'])[-2:], ['write', 'compile'])
+        self.assertGreater(timings['phases']['compile']['wall_time'], 0)
+
+        executable = self.out_dir / 'self_transition_fsm_bench'
+        self.run_command(['clang++', '-std=c++11', '-Werror', '-Wall', self.out_dir / 'self_transition_fsm_bench.cc',
+                          '-o', executable])
+        events_file.write_text('Timeout\nTimeout\n')
+        results = json.loads(self.run_command([executable, '--replay', events_file]).splitlines()[-1])
+        self.assertEqual(results['state_changes'], 0)
+        self.assertEqual(results['transitions'], 2)
+        self.assertGreater(results['transitions_per_sec'], 0)
+
+        with unittest.mock.patch.dict(os.environ, CXXFLAGS='-DPLANTUML2CPP_BENCH_BASE_HEADER=\\"missing.h\\"'):
+            res = subprocess.run([sys.executable, '-m', 'plantuml2cpp', '--emit-bench', '--timings', '--no-cache',
+                                  self.tests_dir / 'self_transition_fsm.puml', self.out_dir], cwd=cwd,
+                                 capture_output=True)
+        self.assertNotEqual(res.returncode, 0)
+        self.assertIn('CalledProcessError', res.stderr.decode())
+
+    def test_batch_mode(self):
+        """Verifies that code can be generated for multiple files and that failures are reported for each file"""
+        bad_puml_file = self.out_dir / 'bad_fsm.puml'
+        with open(bad_puml_file, 'w') as f:
+            f.write('[*] -> Idle\n')
+
+        cwd = pathlib.Path(__file__).parent.parent
+        res = subprocess.run([sys.executable, '-m', 'plantuml2cpp', '-j', '2', '-n', 'batch',
+                              self.tests_dir / '*_transition*.puml', bad_puml_file, self.tests_dir / 'simple_fsm.puml',
+                              self.out_dir], cwd=cwd, capture_output=True)
+
+        self.assertNotEqual(res.returncode, 0)
+        self.assertIn('failed for 1 of 5 files', res.stderr.decode())
+        self.assertIn(f'{bad_puml_file}: The target state "Idle"', res.stderr.decode())
+
+        for name in ['guarded_transitions_fsm', 'internal_transitions_fsm', 'self_transition_fsm', 'simple_fsm']:
+            with open(self.out_dir / f'{name}.h') as f:
+                self.assertIn('namespace batch {', f.read())
+
+    def test_batch_mode_undecodable_input(self):
+        """Verifies that an input file that is not valid UTF-8 fails on its own without stopping the other files"""
+        bad_puml_file = self.out_dir / 'bad_encoding_fsm.puml'
+        bad_puml_file.write_bytes(b'@startuml\n[*] --> Idle\nIdle : entry / printf("\xff\xfe")\n@enduml\n')
+        output_dir = self.out_dir / 'bad_encoding'
+        output_dir.mkdir()
+
+        cwd = pathlib.Path(__file__).parent.parent
+        for num_workers in ['1', '2']:
+            with self.subTest(num_workers=num_workers):
+                res = subprocess.run([sys.executable, '-m', 'plantuml2cpp', '--no-cache', '--noformat', '-j',
+                                      num_workers, self.tests_dir / 'simple_fsm.puml', bad_puml_file, output_dir],
+                                     cwd=cwd, capture_output=True)
+
+                self.assertEqual(res.returncode, 1)
+                self.assertIn('failed for 1 of 2 files', res.stderr.decode())
+                self.assertIn(f'{bad_puml_file}: UnicodeDecodeError', res.stderr.decode())
+                self.assertNotIn('Traceback', res.stderr.decode())
+                self.assertTrue((output_dir / 'simple_fsm.h').exists())
+                (output_dir / 'simple_fsm.h').unlink()
+
+    def test_streaming_emitter(self):
+        """Verifies that the code written section by section is the same as the code generated in one go"""
+        puml_file = self.tests_dir / 'deep_hierarchy_fsm.puml'
+        for args, options in [([], GeneratorOptions(clang_format=False)),
+                              (['--strategy', 'events', '--bank', '--brace-style', 'allman'],
+                               GeneratorOptions(strategy='events', bank=True, clang_format=False,
+                                                style=CodeStyle(brace_style='allman'))),
+                              (['--split', '--counters'],
+                               GeneratorOptions(split=True, counters=True, clang_format=False))]:
+            with self.subTest(args=args):
+                self.run_main(puml_file, self.out_dir, '--noformat', *args)
+                with open(self.out_dir / 'deep_hierarchy_fsm.h') as f:
+                    expected_code = f.read()
+
+                codegen = CodeGenerator(PlantUmlStateDiagram(puml_file), options)
+                stream = io.StringIO()
+                codegen.write_code(stream, '', 'DeepHierarchyFsm')
+
+                self.assertEqual(stream.getvalue(), expected_code)
+                self.assertGreater(len(list(codegen.generate_chunks('', 'DeepHierarchyFsm'))), 10)
+
+    def test_stdio(self):
+        """Verifies that diagrams can be read from stdin and strings and the code written to stdout and streams"""
+        puml_file = self.tests_dir / 'simple_fsm.puml'
+        self.run_main(puml_file, self.out_dir)
+        with open(self.out_dir / 'simple_fsm.h') as f:
+            expected_code = f.read()
+
+        cwd = pathlib.Path(__file__).parent.parent
+        with open(puml_file) as f:
+            puml_text = f.read()
+
+        for args in [['-', '-c', 'SimpleFsm'], [puml_file, '-'], ['-', '-', '-c', 'SimpleFsm', '--noformat']]:
+            with self.subTest(args=args):
+                res = subprocess.run([sys.executable, '-m', 'plantuml2cpp', *args], cwd=cwd, input=puml_text.encode(),
+                                     capture_output=True)
+                self.assertEqual(res.returncode, 0, msg=res.stderr.decode())
+                if '--noformat' in args:
+                    self.assertIn('class SimpleFsm : public T {', res.stdout.decode())
+                else:
+                    self.assertEqual(res.stdout.decode(), expected_code)
+
+        output_file = self.out_dir / 'stdin_fsm.h'
+        res = subprocess.run([sys.executable, '-m', 'plantuml2cpp', '-', output_file, '-c', 'StdinFsm'], cwd=cwd,
+                             input=b'@startuml\n[*] --> Idle\n@enduml\n', capture_output=True)
+        self.assertNotEqual(res.returncode, 0)
+        self.assertIn('in <stdin>:2', res.stderr.decode())
+        self.assertFalse(output_file.exists())
+
+        diagram = PlantUmlStateDiagram(pathlib.Path('<request>'), io.StringIO(puml_text))
+        job = GenerationJob(pathlib.Path('<request>'), self.out_dir / 'simple_fsm.h', '', 'SimpleFsm', False,
+                            GeneratorOptions())
+        self.assertEqual(generate_text(job, diagram), (expected_code, None))
+
+        stream = io.StringIO()
+        generate_to_stream(job, stream, PlantUmlStateDiagram(pathlib.Path('<request>'), puml_text))
+        self.assertEqual(stream.getvalue(), expected_code)
+
+    def test_timings_and_profile(self):
+        """Verifies that the phases of each file are measured and that the whole run gets profiled"""
+        cwd = pathlib.Path(__file__).parent.parent
+        profile_file = self.out_dir / 'plantuml2cpp.prof'
+        cache_dir = self.out_dir / 'cache'
+        for is_cached in [False, True]:
+            with self.subTest(is_cached=is_cached):
+                output = self.run_command([sys.executable, '-m', 'plantuml2cpp', '--timings', '--profile', profile_file,
+                                           '--cache-dir', cache_dir, '-j', '2', self.tests_dir / 'simple_fsm.puml',
+                                           self.tests_dir / 'deep_hierarchy_fsm.puml', self.out_dir], cwd=cwd)
+
+                timings = [json.loads(x) for x in output.splitlines()]
+                self.assertEqual([x['output'] for x in timings],
+                                 [str(self.out_dir / 'simple_fsm.h'), str(self.out_dir / 'deep_hierarchy_fsm.h')])
+                expected_phases = ['cache_lookup', 'write'] if is_cached else \
+                    ['cache_lookup', 'read', 'parse', 'resolve', 'generate', 'clang_format', 'write']
+                for phases in [x['phases'] for x in timings]:
+                    self.assertEqual(list(phases), expected_phases)
+                    for stats in phases.values():
+                        self.assertEqual(sorted(stats), ['cpu_time', 'peak_memory_bytes', 'wall_time'])
+                        self.assertGreater(stats['wall_time'], 0)
+
+                stats = pstats.Stats(str(profile_file))
+                self.assertTrue(any(x[2] == 'run_timed_jobs' for x in stats.stats))
+
+    def test_include(self):
+        """Verifies that included files are expanded in place, reported in errors and tracked as dependencies"""
+        lines = (self.tests_dir / 'simple_fsm.puml').read_text().split('\n')
+        idle_line_idx = next(i for i, x in enumerate(lines) if x.startswith('Idle'))
+        working_line_idx = next(i for i, x in enumerate(lines) if x.startswith('Working'))
+
+        puml_file = self.out_dir / 'include' / 'simple_fsm.puml'
+        (self.out_dir / 'include' / 'states').mkdir(parents=True)
+        puml_file.write_text('\n'.join(lines[:idle_line_idx] + ['!include states/idle.puml', '@enduml']))
+        (puml_file.parent / 'states' / 'idle.puml').write_text(
+            '\n'.join(lines[idle_line_idx:working_line_idx] + ["!include working.puml ' Nested include"]))
+        (puml_file.parent / 'states' / 'working.puml').write_text('\n'.join(lines[working_line_idx:]))
+
+        cache_dir = self.out_dir / 'cache'
+        self.run_main(self.tests_dir / 'simple_fsm.puml', self.out_dir)
+        self.run_main(puml_file, '--depfile', '--cache-dir', cache_dir)
+        self.assertEqual(puml_file.with_suffix('.h').read_text(), (self.out_dir / 'simple_fsm.h').read_text())
+        self.assertEqual(puml_file.with_suffix('.d').read_text(),
+                         f'{puml_file.with_suffix(".h")}: {puml_file} {puml_file.parent / "states" / "idle.puml"}'
+                         f' {puml_file.parent / "states" / "working.puml"}\n')
+
+        # Changing an included file must not reuse the cached code
+        with open(puml_file.parent / 'states' / 'working.puml', 'a') as f:
+            f.write('\nWorking -> Idle : Cancelled\n')
+        self.run_main(puml_file, '--depfile', '--cache-dir', cache_dir)
+        self.assertIn('Cancelled', puml_file.with_suffix('.h').read_text())
+
+        cwd = pathlib.Path(__file__).parent.parent
+        for included_text, error in [('Working : no transition {', 'Invalid transition format in'
+                                      f' {puml_file.parent / "states" / "working.puml"}:'),
+                                     ('!include ../simple_fsm.puml', 'Recursive include of'),
+                                     ('!include missing.puml', 'does not exist')]:
+            with self.subTest(included_text=included_text):
+                with open(puml_file.parent / 'states' / 'working.puml', 'a') as f:
+                    f.write(f'\n{included_text}\n')
+
+                for cache_args in [['--no-cache'], ['--cache-dir', cache_dir]]:
+                    res = subprocess.run([sys.executable, '-m', 'plantuml2cpp', puml_file, *cache_args], cwd=cwd,
+                                         capture_output=True)
+                    self.assertNotEqual(res.returncode, 0)
+                    self.assertIn(error, res.stderr.decode())
+                    self.assertIn(f' in {puml_file.parent / "states" / "working.puml"}:', res.stderr.decode())
+
+                (puml_file.parent / 'states' / 'working.puml').write_text('\n'.join(lines[working_line_idx:]))
+
+        # A long-running process notices changes to nested includes and keeps only the latest version of each file
+        working_file = puml_file.parent / 'states' / 'working.puml'
+        PlantUmlStateDiagram(puml_file)
+        num_cached_fragments = len(plantuml2cpp.parser._fragment_cache)
+        for i in range(3):
+            with open(working_file, 'a') as f:
+                f.write(f'\nWorking -> Idle : Cancelled{i}\n')
+            os.utime(working_file, ns=(i * 1000000000, i * 1000000000))
+            self.assertIn(f'Cancelled{i}', PlantUmlStateDiagram(puml_file).event_names)
+            self.assertEqual(len(plantuml2cpp.parser._fragment_cache), num_cached_fragments)
+
+    def test_server(self):
+        """Verifies that the server answers each request line with the same code as a single run would generate"""
+        self.run_main(self.tests_dir / 'simple_fsm.puml', self.out_dir / 'expected_simple_fsm.h', '-n', 'ns')
+        puml_text = (self.tests_dir / 'internal_transitions_fsm.puml').read_text()
+        requests = [{'id': 1, 'puml_file': str(self.tests_dir / 'simple_fsm.puml'), 'namespace': 'ns',
+                     'output': str(self.out_dir / 'simple_fsm.h')},
+                    {'id': 2, 'puml_file': str(self.tests_dir / 'simple_fsm.puml'), 'namespace': 'ns',
+                     'output': str(self.out_dir / 'simple_fsm.h')},
+                    {'id': 3, 'puml_file': 'internal_transitions_fsm.puml', 'puml_text': puml_text},
+                    {'id': 4, 'puml_file': 'broken_fsm.puml', 'puml_text': '@startuml\n[*] --> Missing\n@enduml\n'}]
+
+        cwd = pathlib.Path(__file__).parent.parent
+        output = self.run_command([sys.executable, '-m', 'plantuml2cpp', '--server'], cwd=cwd,
+                                  input='\n'.join(json.dumps(x) for x in requests).encode() + b'\nnot json\n')
+        responses = [json.loads(x) for x in output.splitlines()]
+
+        self.assertEqual(responses[0], {'id': 1, 'ok': True, 'output': requests[0]['output'], 'written': True})
+        self.assertEqual(responses[1], {'id': 2, 'ok': True, 'output': requests[1]['output'], 'written': False})
+        self.assertEqual((self.out_dir / 'simple_fsm.h').read_text(),
+                         (self.out_dir / 'expected_simple_fsm.h').read_text())
+
+        self.run_main(self.tests_dir / 'internal_transitions_fsm.puml', self.out_dir)
+        self.assertEqual(responses[2], {'id': 3, 'ok': True,
+                                        'code': (self.out_dir / 'internal_transitions_fsm.h').read_text()})
+
+        self.assertEqual(responses[3]['id'], 4)
+        self.assertFalse(responses[3]['ok'])
+        self.assertIn('broken_fsm.puml:2', responses[3]['error'])
+        self.assertEqual(responses[4]['id'], None)
+        self.assertFalse(responses[4]['ok'])
+
+    def test_server_malformed_requests(self):
+        """Verifies that the server answers malformed requests with an error and keeps serving"""
+        puml_file = str(self.tests_dir / 'simple_fsm.puml')
+        bad_puml_file = self.out_dir / 'server_bad_encoding_fsm.puml'
+        bad_puml_file.write_bytes(b'@startuml\n[*] --> Idle : \xff\n@enduml\n')
+        requests = [{'id': 1, 'puml_file': puml_file, 'output': 5},
+                    {'id': 2, 'puml_file': 'fsm.puml', 'puml_text': 7},
+                    {'id': 3, 'puml_file': puml_file, 'classname': None},
+                    {'id': 4, 'puml_file': puml_file, 'classname': 'My Fsm'},
+                    {'id': 5, 'puml_file': puml_file, 'namespace': 'a::'},
+                    {'id': 6, 'puml_file': ['fsm.puml']},
+                    {'id': 7, 'puml_file': 'my-fsm.puml', 'puml_text': '@startuml\n[*] --> A\nstate A\n@enduml\n'},
+                    {'id': 8, 'puml_file': str(bad_puml_file)},
+                    {'id': 9, 'puml_file': puml_file, 'classname': 'MyFsm', 'namespace': 'a::b'}]
+
+        cwd = pathlib.Path(__file__).parent.parent
+        output = self.run_command([sys.executable, '-m', 'plantuml2cpp', '--server', '--noformat'], cwd=cwd,
+                                  input='\n'.join(json.dumps(x) for x in requests).encode() + b'\n')
+        responses = [json.loads(x) for x in output.splitlines()]
+
+        self.assertEqual([x['id'] for x in responses], [x['id'] for x in requests])
+        self.assertEqual([x['ok'] for x in responses], [False] * 8 + [True])
+        self.assertIn('output is not a string', responses[0]['error'])
+        self.assertIn('puml_text is not a string', responses[1]['error'])
+        self.assertIn('classname is not a string', responses[2]['error'])
+        self.assertIn('classname is not a C++ identifier', responses[3]['error'])
+        self.assertIn('namespace is not a C++ namespace name', responses[4]['error'])
+        self.assertIn('puml_file is missing or not a string', responses[5]['error'])
+        self.assertIn('Invalid class name: My-Fsm', responses[6]['error'])
+        self.assertIn('UnicodeDecodeError', responses[7]['error'])
+        self.assertIn('class MyFsm : public T {', responses[8]['code'])
+
+    def test_watch(self):
+        """Verifies that the watch mode regenerates the code only when the generated code of a changed file changes"""
+        puml_file = self.out_dir / 'watched_fsm.puml'
+        output_file = self.out_dir / 'watched_fsm.h'
+        shutil.copy(self.tests_dir / 'simple_fsm.puml', puml_file)
+
+        def wait_for(condition):
+            for _ in range(100):
+                if condition():
+                    return
+                time.sleep(0.1)
+            self.fail('timed out waiting for the watch mode')
+
+        def append_line(line):
+            with open(puml_file, 'a') as f:
+                f.write(f'\n{line}\n')
+
+        cwd = pathlib.Path(__file__).parent.parent
+        process = subprocess.Popen([sys.executable, '-m', 'plantuml2cpp', puml_file, '--watch', '--noformat'], cwd=cwd,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            wait_for(output_file.exists)
+            os.utime(output_file, (0, 0))
+
+            # Comments change the file but not the generated code
+            append_line("' Just a comment")
+            time.sleep(1)
+            self.assertEqual(output_file.stat().st_mtime, 0)
+
+            append_line('Working -> Idle : Cancelled')
+            wait_for(lambda: 'Cancelled' in output_file.read_text())
+
+            append_line('Working : no transition {')
+            time.sleep(1)
+        finally:
+            process.terminate()
+            stdout, stderr = process.communicate()
+
+        self.assertEqual(stdout.decode().splitlines(), [f'Generated {output_file}'] * 2)
+        self.assertIn('Invalid transition format in', stderr.decode())
+
+    def test_watch_rescans_includes_on_change(self):
+        """Verifies that the watch mode only looks up the included files again when a known file has changed"""
+        puml_file = self.out_dir / 'rescanned_fsm.puml'
+        shutil.copy(self.tests_dir / 'simple_fsm.puml', puml_file)
+        watcher = FileWatcher([GenerationJob(puml_file, self.out_dir / 'rescanned_fsm.h', '', 'RescannedFsm', True,
+                                             GeneratorOptions())])
+
+        with unittest.mock.patch('plantuml2cpp.watcher.find_puml_dependencies',
+                                 wraps=plantuml2cpp.watcher.find_puml_dependencies) as find_dependencies:
+            self.assertEqual(len(watcher.poll()), 1)
+            self.assertEqual(watcher.poll(), [])
+            self.assertEqual(find_dependencies.call_count, 1)
+
+            with open(puml_file, 'a') as f:
+                f.write('\nWorking -> Idle : Cancelled\n')
+            os.utime(puml_file, ns=(0, 0))
+            self.assertEqual(len(watcher.poll()), 1)
+            self.assertEqual(find_dependencies.call_count, 2)
+
+        # Saving invalid bytes reports an error and keeps watching
+        puml_file.write_bytes(puml_file.read_bytes() + b'\n\xff\n')
+        [(_, error)] = watcher.poll()
+        self.assertIn('UnicodeDecodeError', str(error))
+        self.assertEqual(watcher.poll(), [])
+
+        puml_file.write_bytes(puml_file.read_bytes()[:-3])
+        self.assertEqual(watcher.poll(), [])  # Same code as before the invalid bytes
+
+    def test_generation_cache(self):
+        """Verifies that cached code is used for unchanged inputs and that unchanged outputs are not re-written"""
+        cache_dir = self.out_dir / 'cache'
+        output_file = self.out_dir / 'self_transition_fsm.h'
+
+        self.run_main(self.tests_dir / 'self_transition_fsm.puml', self.out_dir, '--cache-dir', cache_dir)
+        self.assertTrue(any(cache_dir.rglob('*')))
+
+        os.utime(output_file, (0, 0))
+        self.run_main(self.tests_dir / 'self_transition_fsm.puml', self.out_dir, '--cache-dir', cache_dir)
+        self.assertEqual(output_file.stat().st_mtime, 0)
+
+        for cache_entry in [x for x in cache_dir.rglob('*') if x.is_file()]:
+            cache_entry.write_text('// Cached code')
+        self.run_main(self.tests_dir / 'self_transition_fsm.puml', self.out_dir, '--cache-dir', cache_dir)
+        self.assertEqual(output_file.read_text(), '// Cached code')
+
+    def test_cache_eviction(self):
+        """Verifies that the least recently used cache entries get removed once the cache exceeds its size"""
+        cache = GenerationCache(self.out_dir / 'eviction_cache', max_size=3000)
+        for i, key in enumerate(['a1', 'b2', 'c3']):
+            cache.put(key, 'x' * 1000)
+            os.utime(cache.directory / key[:2] / key, (i, i))
+
+        self.assertEqual(cache.get('a1'), 'x' * 1000)  # Now the most recently used entry
+        cache.put('d4', 'x' * 1000)
+        cache.prune()
+
+        self.assertEqual([x for x in ['a1', 'b2', 'c3', 'd4'] if cache.get(x) is not None], ['a1', 'c3', 'd4'])
+
+    def test_format_cache(self):
+        """Verifies that clang-format is run once per file in a batch and never again for identical code"""
+        fake_bin_dir = self.out_dir / 'fake_bin'
+        fake_bin_dir.mkdir()
+        log_file = self.out_dir / 'clang_format.log'
+        with open(fake_bin_dir / 'clang-format', 'w') as f:
+            f.write(f'#!/bin/sh\necho "$@" >> {log_file}\ncat\n')
+        (fake_bin_dir / 'clang-format').chmod(0o755)
+
+        puml_file = self.out_dir / 'format_cache_fsm.puml'
+        shutil.copy(self.tests_dir / 'simple_fsm.puml', puml_file)
+
+        cwd = pathlib.Path(__file__).parent.parent
+        env = dict(os.environ, PATH=f'{fake_bin_dir}{os.pathsep}{os.environ["PATH"]}')
+        args = [sys.executable, '-m', 'plantuml2cpp', '-j', '2', '--cache-dir', self.out_dir / 'cache',
+                puml_file, self.tests_dir / 'self_transition_fsm.puml', self.tests_dir / 'simple_fsm.puml',
+                self.out_dir]
+        self.run_command(args, cwd=cwd, env=env)
+        self.assertEqual(len(log_file.read_text().splitlines()), 3)
+
+        # Only the comment changes, so the generated code stays the same and does not have to be formatted again
+        with open(puml_file, 'a') as f:
+            f.write("\n' Just a comment\n")
+
+        self.run_command(args, cwd=cwd, env=env)
+        self.assertEqual(len(log_file.read_text().splitlines()), 3)
+
+    def test_benchmarks(self):
+        """Verifies that the benchmark suite runs on small synthetic diagrams and writes its results as JSON"""
+        results_file = self.out_dir / 'benchmark_results.json'
+        self.run_command([sys.executable, self.tests_dir.parent / 'benchmarks' / 'run_benchmarks.py', '--states', '10',
+                          '40', '--repeat', '1', '--no-clang-format', '--output', results_file])
+
+        with open(results_file) as f:
+            results = json.load(f)['results']
+
+        self.assertEqual([x['params']['num_states'] for x in results], [10, 40])
+        self.assertEqual([x['num_transitions'] for x in results], [30, 120])
+        self.assertEqual(len(results[0]['stages']['parse']['runs']), 1)
+        self.assertIsNone(results[0]['stages']['clang_format'])
+        self.assertIsNone(results[0]['runtime'])
+
+    def test_compile_benchmarks(self):
+        """Verifies that the benchmark suite measures the compile time and the runtime of the generated code"""
+        results_file = self.out_dir / 'benchmark_results.json'
+        self.run_command([sys.executable, self.tests_dir.parent / 'benchmarks' / 'run_benchmarks.py', '--states', '20',
+                          '--strategy', 'table', 'switch', 'functions', '--dispatch', 'scan', 'flat',
+                          '--repeat', '1', '--no-clang-format', '--compile', '--compiler', 'clang++',
+                          '--runtime-events', '1000', '--output', results_file])
+
+        with open(results_file) as f:
+            results = json.load(f)['results']
+
+        self.assertEqual([(x['strategy'], x['dispatch']) for x in results],
+                         [('table', 'scan'), ('table', 'flat'), ('switch', None), ('functions', None)])
+        self.assertEqual(len(results[0]['stages']['compile']['runs']), 1)
+        self.assertEqual(results[0]['runtime']['events'], 1000)
+        self.assertEqual(len(set(x['runtime']['transitions'] for x in results)), 1)
+
 
 if __name__ == '__main__':
     unittest.main()